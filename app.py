@@ -5,77 +5,304 @@ Main application for storage validation.
 Ingest files to table storage:
 python app.py -ingest -settings "./exampleinput.json"
 
+See what an ingest would change without writing to table storage:
+python app.py -ingest -settings "./exampleinput.json" -dry-run
+
 Validate files in table storage:
 python app.py -validate -industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON
 
+Validate several industries, or all of them, with one read of the table:
+python app.py -validate -industry INDUSTRY1,INDUSTRY2
+python app.py -validate -industry all
+
+Validate only files changed since they were last validated:
+python app.py -validate -industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON -incremental
+
 Rebase files in table storage
 python app.py -rebase -industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON
 
+Validate files on a schedule until stopped:
+python app.py -watch [-industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON] -interval 3600
+
+Export the recorded hashes of an industry, and the current hashes of its
+blobs, to manifests and compare them without a login:
+python app.py -export-manifest ./baseline.manifest -industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON
+python app.py -export-manifest ./current.manifest -industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON -current
+python app.py -diff-manifests ./baseline.manifest ./current.manifest
+
+Record the hashes in an approved manifest without reading the blobs:
+python app.py -import-manifest ./current.manifest [-dry-run]
+
+Move table records to the key scheme in the configuration
+python app.py -migrate-keys
+
+Journal a long run so it can be resumed where it stopped:
+python app.py -rebase -industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON -checkpoint-file ./rebase.checkpoint
+python app.py -rebase -industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON -checkpoint-file ./rebase.checkpoint -resume
+
+Validate or rebase on an asyncio event loop, with thousands of requests in flight:
+python app.py -validate -industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON -async -workers 1000
+
+Split a validation (or rebase) into shards run as local processes, and
+combine their summaries:
+python app.py -validate -industry all -shards 8 [-shard-by account]
+
+Or run one shard on each of several machines and merge their reports:
+python app.py -validate -industry all -shards 4 -shard-index 0 -shard-report ./shard0.json
+python app.py -merge-shard-reports ./shard0.json ./shard1.json ./shard2.json ./shard3.json
+
+Save request counts and latencies, and a trace, of a run:
+python app.py -validate -industry INDUSTRY_OR_FILTER_IN_CONFIG_JSON -metrics-file ./metrics.json -trace-file ./trace.json
+
 """
 import sys
+import asyncio
+import tempfile
 from microsoft.utils import (
-    AzLoginUtils, 
+    CredentialProvider,
     Configuration,
     ProgramArguments,
     StorageBlobValidationEntry,
-    Context
+    Context,
+    Watcher,
+    IndustrySummary,
+    HashManifest,
+    ManifestDiff,
+    Shard,
+    ShardReport,
+    ShardProcesses,
+    RunMetrics
 )
 
 
+# Collect the arguments and validate them
+app_arguments = ProgramArguments(sys.argv[1:])
+app_arguments.validate_args()
+
+if app_arguments.trace_file:
+    RunMetrics.get().enable_trace()
+
+# With -shard-index only this shard's records are read from the table. 
+# Shards run side by side, each writes its own metrics and trace.
+shard = None
+metrics_file = app_arguments.metrics_file
+trace_file = app_arguments.trace_file
+if app_arguments.shards and app_arguments.shard_index is not None:
+    shard = Shard(app_arguments.shards, app_arguments.shard_index, app_arguments.shard_by)
+    metrics_file = metrics_file and shard.get_path(metrics_file)
+    trace_file = trace_file and shard.get_path(trace_file)
+
+if app_arguments.diff_manifests:
+    """
+    Compare two manifests offline, exits with 1 if they differ.
+    """
+    baseline_manifest, current_manifest = app_arguments.diff_manifests
+    print("\nComparing", current_manifest, "with", baseline_manifest)
+
+    manifest_diff = ManifestDiff()
+    differences = manifest_diff.compare(
+        HashManifest.read(baseline_manifest),
+        HashManifest.read(current_manifest)
+    )
+    for difference, base_record, current_record in differences:
+        if difference != ManifestDiff.UNCHANGED:
+            record = base_record or current_record
+            print(difference, record.industry, record.account, record.blob)
+
+    print("Differences:", manifest_diff.summary())
+    sys.exit(1 if manifest_diff.differences else 0)
+
+def print_summaries(summaries):
+    for summary in summaries:
+        print("Found", summary.records, "records for", summary.industry)
+        print(str(summary))
+
+
+if app_arguments.merge_shard_reports:
+    """
+    Combine the reports of the shards of a validation offline.
+    """
+    print("\nMerging", len(app_arguments.merge_shard_reports), "shard reports")
+    print_summaries(ShardReport.merge(app_arguments.merge_shard_reports))
+    sys.exit(0)
+
+if app_arguments.shards and app_arguments.shard_index is None:
+    """
+    Run each shard as its own process, each logs in and reads only its
+    share of the table. Validation summaries are merged once all are done.
+    """
+    print("\nRunning", app_arguments.action, "as", app_arguments.shards, "shards split by", app_arguments.shard_by)
+
+    with tempfile.TemporaryDirectory() as report_directory:
+        shard_reports, failed_shards = ShardProcesses.run(
+            sys.argv[1:],
+            app_arguments.shards,
+            report_directory if app_arguments.validate else None
+        )
+
+        if app_arguments.validate:
+            print("\nMerged results of", len(shard_reports), "shards")
+            print_summaries(ShardReport.merge(shard_reports))
+
+    sys.exit(1 if failed_shards else 0)
+
 # Load configuration and validate that we have a login
 credentials_file = ".\\credentials.json"
 configuration_file = ".\\configuration.json"
 
 configuration = Configuration(configuration_file)
-script_actor = AzLoginUtils.validate_login(credentials_file)
+credential_provider, script_actor = CredentialProvider.login(credentials_file)
 
-# Collect the arguments, validate them and create context object
-app_arguments = ProgramArguments(sys.argv[1:])
-app_arguments.validate_args()
+# Validate the industry and create context object
 app_arguments.validate_industry(configuration.industries)
 
-application_context = Context(configuration)
+if shard:
+    print("Running shard", str(shard))
+
+# The asyncio core creates its own context when it runs
+application_context = None
+if not app_arguments.use_async:
+    application_context = Context(
+        configuration, 
+        app_arguments.workers,
+        app_arguments.list_hashes,
+        app_arguments.verify_content,
+        credential_provider,
+        shard=shard
+    )
+
+if app_arguments.refresh_snapshot:
+    application_context.refresh_snapshot()
+
+# -industry can name several industries, or all of them
+industries = app_arguments.get_industries(configuration.industries)
+
+# Journal progress so the run can be resumed
+checkpoint = None
+if app_arguments.checkpoint_file:
+    # Every shard keeps its own journal
+    checkpoint_file = app_arguments.checkpoint_file
+    run_key = "{} {}".format(app_arguments.action, ",".join(industries) if industries else app_arguments.settings)
+    if shard:
+        checkpoint_file = shard.get_path(checkpoint_file)
+        run_key = "{} shard {}".format(run_key, str(shard))
+
+    checkpoint = application_context.use_checkpoint(
+        checkpoint_file,
+        run_key,
+        app_arguments.resume
+    )
+
+
+def run_async(handle_result, select=None):
+    """
+    Validate the industries on an asyncio event loop, calling 
+    handle_result(context, result) for each result in table order. Queued
+    table writes are made before the loop ends.
+    """
+    # Only imported when used, aiohttp is needed
+    from microsoft.utils.aio.AsyncContext import AsyncContext
+
+    async def validate_industries():
+        async_context = AsyncContext(configuration, app_arguments.workers, app_arguments.list_hashes, credential_provider)
+        async_context.shard = shard
+        async with async_context:
+            results = async_context.iter_industries_validation_results(
+                industries,
+                select,
+                app_arguments.incremental,
+                app_arguments.full
+            )
+            async for res in results:
+                handle_result(async_context, res)
+
+    asyncio.run(validate_industries())
 
 
 # Now figure out what it is we are doing.
 if app_arguments.validate:
     """
-    Get all records for a given industry and compare the current hash
-    to the last hash that was recorded in the table. 
+    Get all records for the given industries and compare the current hash
+    to the last hash that was recorded in the table. Several industries are
+    read from the table in a single pass.
 
     Only prints out if good or bad for each one. 
     """
-    print("\nValidating current hashes for industry", app_arguments.industry)
+    print("\nValidating current hashes for industries", industries)
 
-    results = application_context.get_industry_validation_result(app_arguments.industry)
+    summaries = {industry: IndustrySummary(industry) for industry in industries}
 
-    print("Found", len(results), "records for", app_arguments.industry)
-    if len(results):
-        for res in results:
+    def report_validation(context, res):
+        summaries[res.validation_entry.industry].add(res)
+        if res.skipped:
+            print("Validation result: ", res.validation_entry.blob, "=", res.validated, "(unchanged since last validated)")
+        else:
             print("Validation result: ", res.validation_entry.blob, "=", res.validated)
+        context.complete(res.validation_entry.account, res.validation_entry.blob)
+
+    if app_arguments.use_async:
+        run_async(report_validation, StorageBlobValidationEntry.VALIDATION_COLUMNS)
+    else:
+        # Results are printed as they are validated
+        results = application_context.iter_industries_validation_results(
+            industries,
+            StorageBlobValidationEntry.VALIDATION_COLUMNS,
+            app_arguments.incremental,
+            app_arguments.full
+        )
+        for res in results:
+            report_validation(application_context, res)
+
+    print_summaries(summaries.values())
+    if app_arguments.shard_report:
+        ShardReport.write(app_arguments.shard_report, shard, list(summaries.values()))
+    if app_arguments.incremental:
+        print("Skipped", sum([x.skipped for x in summaries.values()]), "unchanged blobs")
+        if application_context:
+            application_context.flush_table_records()
+    if checkpoint:
+        print("Skipped", checkpoint.skipped, "blobs validated before the checkpoint")
 
 if app_arguments.rebase:
     """
-    Get all records for a given industry and update the hash if the stored
-    one is different from the the current one. 
+    Get all records for the given industries and update the hash if the
+    stored one is different from the the current one. 
     """
-    print("\nRebasing hashes for industry", app_arguments.industry)
+    print("\nRebasing hashes for industries", industries)
+
+    record_counts = {industry: 0 for industry in industries}
+
+    def rebase_result(context, res):
+        record_counts[res.validation_entry.industry] += 1
+        if res.current_state is None:
+            print("Unable to get the hash of", res.validation_entry.blob, "- not updated")
+        elif not res.validated:
+            print("Update hash for", res.validation_entry.blob)
+            context.set_entry_state(res.validation_entry, res.current_state)
+            res.validation_entry.actor = script_actor
+            res.validation_entry.history.append(
+                context.get_history_entry("rebase", script_actor)
+            )
+            context.add_table_record(res.validation_entry)
+        else:
+            print("Hash unchanged for", res.validation_entry.blob)
 
-    results = application_context.get_industry_validation_result(app_arguments.industry)
+        # Blobs whose hash could not be read are tried again on resume
+        if res.current_state is not None:
+            context.complete(res.validation_entry.account, res.validation_entry.blob)
 
-    print("Found", len(results), "records for", app_arguments.industry)
-    if len(results):
-        for res in results:
-            if not res.validated:
-                print("Update hash for", res.validation_entry.blob)
-                res.validation_entry.md5 = res.current_hash
-                res.validation_entry.actor = script_actor
-                res.validation_entry.history.append(
-                    application_context.get_history_entry("rebase", script_actor)
-                )
-                application_context.add_table_record(res.validation_entry)
-            else:
-                print("Hash unchanged for", res.validation_entry.blob)
+    if app_arguments.use_async:
+        run_async(rebase_result)
+    else:
+        # Updates are queued, and written in batches, while the table is read
+        for res in application_context.iter_industries_validation_results(industries):
+            rebase_result(application_context, res)
+        application_context.flush_table_records()
+
+    for industry, record_count in record_counts.items():
+        print("Found", record_count, "records for", industry)
+    if checkpoint:
+        print("Skipped", checkpoint.skipped, "blobs rebased before the checkpoint")
 
 if app_arguments.ingest:
     """
@@ -86,7 +313,9 @@ if app_arguments.ingest:
     ingest_settings = Configuration(app_arguments.settings)
 
     # Make sure we have what we need
-    if not ingest_settings.industry or not ingest_settings.account or not ingest_settings.subscription or len(ingest_settings.blobs) == 0:
+    ingest_blobs = getattr(ingest_settings, "blobs", None) or []
+    ingest_patterns = getattr(ingest_settings, "patterns", None) or []
+    if not ingest_settings.industry or not ingest_settings.account or not ingest_settings.subscription or len(ingest_blobs) + len(ingest_patterns) == 0:
         print("Settings are incorrect")
         quit()
 
@@ -95,52 +324,85 @@ if app_arguments.ingest:
         print("The only acceptable industries are:")
         print(configuration.industries)
 
-    # Get existing ones so we don't create duplicates
-    results = application_context.search_table_store(ingest_settings.industry)
-
+    # Compare against existing ones so we don't create duplicates
     print("Ingesting blobs for ", ingest_settings.industry, "in", ingest_settings.account )
 
-    for blob in ingest_settings.blobs:
+    ingest_plan = application_context.plan_ingest(ingest_settings)
 
-        existing_entry = [x for x in results if x.account == ingest_settings.account and x.blob == blob]
-        if existing_entry and len(existing_entry) > 0:
-            existing_entry = existing_entry[0]
-        else:
-            existing_entry = None
+    print("\nIngest plan", ingest_plan.summary())
 
-        print("\nEntry for", blob,"in", ingest_settings.account, "exists:" , existing_entry != None)
+    if not app_arguments.dry_run:
+        for item in ingest_plan.unchanged:
+            print("Hash for", item.blob, "in", ingest_settings.account, "unchanged.")
 
-        blob_hash = application_context.get_blob_hash(
-            ingest_settings.account,
-            ingest_settings.subscription,
-            blob
-        )
+        for item in ingest_plan.missing:
+            print("Unable to get the hash of", item.blob, "in", ingest_settings.account, "- not ingested.")
 
-        if existing_entry:
-            if existing_entry.md5 != blob_hash: 
-                print("Updating hash for", blob)
-                existing_entry.md5 = blob_hash
-                existing_entry.actor = script_actor
-                existing_entry.history.append(
-                    application_context.get_history_entry("create_rebase", script_actor)
-                )
-                application_context.add_table_record(existing_entry)
-            else:
-                print("Hash for", blob, "in", ingest_settings.account, "unchanged.")
-        else:
-            print("Creating entry for", blob,"in", ingest_settings.account, "exists:" , existing_entry != None)
-
-            blob_entry = StorageBlobValidationEntry(configuration.historyStorage["table"], blob)
-            blob_entry.account = ingest_settings.account
-            blob_entry.subscription = ingest_settings.subscription
-            blob_entry.industry = ingest_settings.industry
-            blob_entry.md5 = blob_hash
-            blob_entry.actor = script_actor
-            blob_entry.history.append(
-                    application_context.get_history_entry("create", script_actor)
-                )
-
-            print("Adding entry for", blob, "in", ingest_settings.account)
-            application_context.add_table_record(blob_entry)
+        application_context.apply_ingest_plan(ingest_plan, script_actor)
+
+    if checkpoint:
+        print("Skipped", checkpoint.skipped, "blobs ingested before the checkpoint")
+
+if app_arguments.export_manifest:
+    """
+    Write the recorded, or with -current the current, hashes of the
+    industries to a manifest.
+    """
+    print("\nExporting", "current" if app_arguments.current else "recorded", "hashes of", industries, "to", app_arguments.export_manifest)
+    exported = application_context.export_manifest(industries, app_arguments.export_manifest, app_arguments.current)
+    print("Exported", exported, "records")
+
+if app_arguments.import_manifest:
+    """
+    Record the hashes in a manifest as they are, the blobs are not read.
+    """
+    print("\nImporting", app_arguments.import_manifest)
+    import_plans = application_context.import_manifest(app_arguments.import_manifest, script_actor, app_arguments.dry_run)
+    for import_plan in import_plans:
+        print("Import plan", import_plan.summary())
+
+if app_arguments.migrate_keys:
+    """
+    Rewrite the table records using the key scheme in the configuration.
+    Safe to run again if interrupted.
+    """
+    print("\nMigrating", configuration.historyStorage["table"], "to key scheme", application_context.key_scheme.scheme)
+    application_context.migrate_keys()
+
+if app_arguments.watch:
+    """
+    Validate the industry, or all of them, on a schedule re-using the same
+    context (keys, clients, snapshot) for every sweep.
+    """
+    industries = industries or configuration.industries
+    print("\nWatching", industries, "every", app_arguments.interval, "seconds")
+
+    watcher = Watcher(
+        application_context,
+        industries,
+        app_arguments.interval,
+        application_context.get_performance_setting("watchJitterSeconds", app_arguments.interval / 10),
+        application_context.get_performance_setting("watchWorkers", 1),
+        app_arguments.incremental,
+        app_arguments.status_file
+    )
+
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+if checkpoint:
+    # Kept if any writes failed, so they can be retried with -resume
+    application_context.flush_table_records()
+    checkpoint.finish()
+
+if metrics_file:
+    print("\nRequests made:")
+    print(RunMetrics.get().summary())
+    RunMetrics.get().write(metrics_file)
+
+if trace_file:
+    RunMetrics.get().write_trace(trace_file)
 
 print("Tasks complete!")
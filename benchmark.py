@@ -0,0 +1,63 @@
+"""
+Benchmark validate, rebase and ingest against in process fakes of the
+table and blob services, no subscription or login is needed.
+
+Run every scenario at 1000 and 10000 blobs:
+python benchmark.py -scales 1000,10000
+
+Add 5ms to each request to see the effect of workers:
+python benchmark.py -scales 1000 -latency-ms 5 -workers 16
+
+Save results and fail (exit code 1) if a later run is more than 20% slower
+or makes more than 20% more requests:
+python benchmark.py -output baseline.json
+python benchmark.py -baseline baseline.json -tolerance 20
+"""
+import sys
+import json
+import argparse
+from microsoft.utils.Context import Context
+from microsoft.utils.benchmark.StorageBenchmark import StorageBenchmark, BenchmarkResult
+
+parser = argparse.ArgumentParser(description="Benchmark validate, rebase and ingest with in process fakes")
+parser.add_argument("-scales", required=False, default="1000,10000", type=str, help="Comma separated numbers of blobs to run each scenario with")
+parser.add_argument("-scenarios", required=False, default=",".join(StorageBenchmark.SCENARIOS), type=str, help="Comma separated scenarios to run")
+parser.add_argument("-workers", required=False, default=Context.DEFAULT_WORKERS, type=int, help="Number of blob hashes to fetch at once")
+parser.add_argument("-latency-ms", required=False, default=0, type=float, help="Delay added to each request made to the fakes")
+parser.add_argument("-changed", required=False, default=0.1, type=float, help="Fraction of blobs changed after they were recorded")
+parser.add_argument("-list-hashes", action="store_true", help="Get blob hashes from container listings rather than one request per blob")
+parser.add_argument("-output", required=False, default=None, type=str, help="Json file to write the results to")
+parser.add_argument("-baseline", required=False, default=None, type=str, help="Json file of earlier results to compare with")
+parser.add_argument("-tolerance", required=False, default=20, type=float, help="Percent records/second or requests may be worse than the baseline")
+arguments = parser.parse_args(sys.argv[1:])
+
+benchmark = StorageBenchmark(
+    arguments.workers,
+    arguments.latency_ms,
+    arguments.changed,
+    arguments.list_hashes
+)
+
+print(BenchmarkResult.header())
+results = []
+for scale in sorted([int(x) for x in arguments.scales.split(",")]):
+    for scenario in arguments.scenarios.split(","):
+        result = benchmark.run_scenario(scenario, scale)
+        print(str(result))
+        results.append(result)
+
+if arguments.output:
+    with open(arguments.output, "w") as output_file:
+        json.dump([x.to_dict() for x in results], output_file, indent=4)
+
+if arguments.baseline:
+    with open(arguments.baseline, "r") as baseline_file:
+        baseline = json.load(baseline_file)
+
+    regressions = StorageBenchmark.compare(results, baseline, arguments.tolerance / 100)
+    for regression in regressions:
+        print("REGRESSION -", regression)
+
+    if regressions:
+        sys.exit(1)
+    print("No regressions against", arguments.baseline)
@@ -1,55 +1,640 @@
+import atexit
 import datetime
+import os
+import time
+import itertools
 import typing
 from . import (
     Configuration,
     StorageBlobValidationEntry,
-    AzCliStorageUtil,
     AzureBlobStorageUtils,
-    AzureTableStoreUtil
+    AzureTableStoreUtil,
+    StorageAccountCache,
+    HashFetcher,
+    KeyScheme,
+    TableWriteBuffer,
+    IngestPlan,
+    HashManifest,
+    ManifestRecord,
+    BlobState,
+    BandwidthLimiter,
+    CliCredentialProvider,
+    SnapshotCache,
+    RunCheckpoint,
+    StorageThrottle
 )
+from azure.core.exceptions import ClientAuthenticationError, ResourceNotFoundError, ResourceModifiedError
 
 class BlobValidationResult:
     def __init__(self, entry:StorageBlobValidationEntry):
         self.validation_entry = entry
         self.current_hash = None
+        self.current_state = None
         self.validated = False
+        # True when an incremental validation skipped the blob as its ETag 
+        # has not changed since it was last validated.
+        self.skipped = False
 
 class Context:
-    def __init__(self, config: Configuration):
+    DEFAULT_WORKERS = 8
+    DEFAULT_FULL_SWEEP_DAYS = 7
+    DEFAULT_CONTENT_HASH_ALGORITHM = "sha256"
+    DEFAULT_HISTORY_LIMIT = 100
+
+    def __init__(self, config: Configuration, workers: int = None, list_hashes: bool = False, verify_content: bool = False, credential_provider = None, table_store: AzureTableStoreUtil = None, create_blob_utils: typing.Callable = None, shard = None):
+        """
+        Parameters:
+        config - Application configuration
+        workers - Blob hashes fetched at once, defaults to performance.workers
+        list_hashes - Get hashes from container listings
+        verify_content - Read blob content to compute a digest
+        credential_provider - Resolves storage account keys, defaults to the az cli
+        table_store - Store for the validation table, defaults to the table 
+            service of historyStorage.account (i.e. a fake when benchmarking)
+        create_blob_utils - Creates the blob utility for (account, key), 
+            defaults to AzureBlobStorageUtils
+        shard - Optional Sharding.Shard, only its records are read from the
+            table and it keeps its own local snapshot
+        """
         self.configuration = config
+        self.shard = shard
+        # Resolves storage account keys, the az cli unless a provider is given
+        self.credential_provider = credential_provider or CliCredentialProvider()
+        # Get hashes from container listings instead of one request per blob
+        self.list_hashes = list_hashes
+        # Read blob content to compute a digest as well as the Content-MD5
+        self.verify_content = verify_content
+        self.bandwidth_limiter = BandwidthLimiter.from_megabytes(
+            self.get_performance_setting("maxBandwidthMBps", None)
+        )
+
+        if workers is None:
+            workers = self.get_performance_setting("workers", Context.DEFAULT_WORKERS)
+
+        self.hash_fetcher = HashFetcher(
+            workers,
+            self.get_performance_setting("accountConcurrency", None)
+        )
 
-        self.validation_storage_account = AzCliStorageUtil.get_storage_account(
+        # Shared by every table and blob call so calls to a busy account 
+        # back off together.
+        self.throttle = StorageThrottle(
+            self.get_performance_setting("accountConcurrency", None) or max(workers, StorageThrottle.DEFAULT_MAX_CONCURRENCY),
+            self.get_performance_setting("retryAttempts", StorageThrottle.DEFAULT_ATTEMPTS),
+            self.get_performance_setting("retryBaseSeconds", StorageThrottle.DEFAULT_BASE_SECONDS),
+            self.get_performance_setting("retryMaxSeconds", StorageThrottle.DEFAULT_MAX_SECONDS),
+            self.get_performance_setting("accountRequestsPerSecond", None)
+        )
+
+        self.account_cache = StorageAccountCache(
+            self.get_performance_setting("accountCacheTtlSeconds", StorageAccountCache.DEFAULT_TTL_SECONDS),
+            self.credential_provider.get_storage_account,
+            create_blob_utils
+        )
+
+        self.validation_storage_account = self.credential_provider.get_storage_account(
             self.configuration.historyStorage["account"],
             self.configuration.historyStorage["subscription"])
 
-        self.validation_table_store = AzureTableStoreUtil(
-            self.validation_storage_account.name, 
-            self.validation_storage_account.keys[0]
+        self.validation_table_store = table_store
+        if self.validation_table_store is None:
+            self.validation_table_store = AzureTableStoreUtil(
+                self.validation_storage_account.name, 
+                self.validation_storage_account.keys[0],
+                self.throttle
+            )
+
+        self.key_scheme = KeyScheme(
+            self.configuration.historyStorage.get("keyScheme", KeyScheme.BLOB)
+        )
+
+        self.write_buffer = TableWriteBuffer(
+            self.validation_table_store,
+            self.get_performance_setting("writeBatchSize", AzureTableStoreUtil.MAX_BATCH_SIZE),
+            self.get_performance_setting("writeFlushSeconds", 30)
         )
+        atexit.register(self.flush_table_records)
+
+        # Optional local copy of the table records
+        self.snapshot = None
+        snapshot_path = self.get_performance_setting("snapshotPath", None)
+        if snapshot_path:
+            # Shard processes can't share the SQLite file
+            if self.shard is not None:
+                snapshot_path = self.shard.get_path(snapshot_path)
+            self.snapshot = SnapshotCache(snapshot_path)
+
+        # Optional journal of the run, see use_checkpoint()
+        self.checkpoint = None
+
+    def use_checkpoint(self, path: str, run_key: str, resume: bool = False) -> RunCheckpoint:
+        """
+        Journal the run to a local file so it can be resumed. Blobs that are
+        done are skipped by later validations and ingests, and when resuming
+        the table writes that were never made are queued again.
+
+        Parameters:
+        path - Journal file
+        run_key - Description of the run, only the same run can resume it
+        resume - Continue the run in the journal
+        """
+        self.checkpoint = RunCheckpoint(path, run_key, resume)
+        self.write_buffer.on_written = self.checkpoint.remove_pending
+        # Runs before the final flush, which commits whatever it writes
+        atexit.register(self.checkpoint.commit)
+
+        pending = self.checkpoint.get_pending()
+        if pending:
+            print("Replaying", len(pending), "table writes from", path)
+            for table, entity, replaces in pending:
+                self.write_buffer.upsert(table, entity, replaces)
+            self.flush_table_records()
+
+        if self.checkpoint.completed:
+            print("Resuming,", len(self.checkpoint.completed), "blobs already done")
 
-    def get_industry_validation_result(self, industry: str) -> typing.List[BlobValidationResult]:
+        return self.checkpoint
+
+    def is_completed(self, account: str, blob: str) -> bool:
+        """
+        True if the blob was done by an earlier attempt of a checkpointed run.
+        """
+        return self.checkpoint is not None and \
+            self.checkpoint.is_completed(RunCheckpoint.get_key(account, blob))
+
+    def complete(self, account: str, blob: str) -> None:
+        """
+        Mark a blob done in the checkpoint, if there is one. Queue any table
+        write for it first.
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.complete(RunCheckpoint.get_key(account, blob))
+
+    def get_performance_setting(self, setting: str, default=None):
+        """
+        Optional tuning values live in the "performance" section of the
+        configuration, any that are missing fall back to the default.
+        """
+        performance = getattr(self.configuration, "performance", None)
+        if isinstance(performance, dict) and setting in performance:
+            return performance[setting]
+        return default
+
+    def get_industry_validation_result(self, industry: str, select: typing.List[str] = None, incremental: bool = False, full_sweep: bool = False) -> typing.List[BlobValidationResult]:
         return_value = []
-        results = self.search_table_store(industry)
+        results = self.search_table_store(industry, select)
 
         if results and len(results) > 0:
             print("Found",len(results), "results for", industry)
-            for res in results:
-                validation_result = BlobValidationResult(res)
-                validation_result.current_hash = self.get_current_hash(res)
-                validation_result.validated = validation_result.current_hash == res.md5
+            return_value = list(self.iter_validation_results(results, incremental, full_sweep))
+        else:
+            print("Found 0 results for", industry)
+
+        return return_value
+
+    def iter_industry_validation_results(self, industry: str, select: typing.List[str] = None, incremental: bool = False, full_sweep: bool = False) -> typing.Iterator[BlobValidationResult]:
+        """
+        Streams the validation of an industry, records are validated while
+        the table is still being read so results (and any writes made while
+        handling them) start with the first page.
+        """
+        return self.iter_industries_validation_results([industry], select, incremental, full_sweep)
+
+    def iter_industries_validation_results(self, industries: typing.List[str], select: typing.List[str] = None, incremental: bool = False, full_sweep: bool = False) -> typing.Iterator[BlobValidationResult]:
+        """
+        Streams the validation of several industries from a single read of
+        the table, see iter_industries_table_store. Results are in table
+        order, use validation_entry.industry to tell them apart. Blobs done
+        by an earlier attempt of a checkpointed run are left out.
+        """
+        entries = self.iter_industries_table_store(industries, select)
+        if self.checkpoint is not None:
+            entries = (entry for entry in entries if not self.is_completed(entry.account, entry.blob))
+
+        return self.iter_validation_results(entries, incremental, full_sweep)
+
+    def iter_validation_results(self, entries: typing.Iterable[StorageBlobValidationEntry], incremental: bool = False, full_sweep: bool = False) -> typing.Iterator[BlobValidationResult]:
+        """
+        Fetches the current hash for each entry using the hash fetcher and 
+        yields results in the same order as entries as they complete.
 
-                return_value.append(validation_result)
+        When listing hashes, all hashes are collected from the container
+        listings before results are returned.
+
+        Parameters:
+        entries - Entries to validate
+        incremental - Skip blobs whose ETag is the one recorded the last time
+            they were validated, and record the ETag of blobs that validate.
+        full_sweep - With incremental, validate every blob but still record
+            the ETags. Blobs not fully validated for performance.fullSweepDays
+            are always validated.
+        """
+        fetched = self.fetch_blob_states(
+            entries,
+            lambda entry: (entry.account, entry.subscription, entry.blob)
+        )
+
+        full_sweep_before = None
+        if incremental and not full_sweep:
+            full_sweep_before = datetime.datetime.utcnow() - datetime.timedelta(
+                days=self.get_performance_setting("fullSweepDays", Context.DEFAULT_FULL_SWEEP_DAYS)
+            )
+
+        def validate(fetched_state):
+            entry, current_state = fetched_state
+            validation_result = BlobValidationResult(entry)
+            validation_result.current_state = current_state
+            validation_result.current_hash = current_state.md5 if current_state else None
+
+            if full_sweep_before and Context._is_unchanged(entry, current_state, full_sweep_before):
+                validation_result.skipped = True
+                validation_result.validated = True
             else:
-                print("Found 0 results for", industry)
+                # Content is only read for blobs that are not skipped, a blob
+                # whose content can't be read fails
+                if self.verify_content and current_state:
+                    current_state = self.add_content_hash(entry.account, entry.subscription, entry.blob, current_state)
+                    validation_result.current_state = current_state
+                validation_result.validated = entry.matches_state(current_state)
 
+            return validation_result
 
-        return return_value
+        if self.verify_content:
+            # Reading content is slow, validate on the hash fetcher's workers
+            validated = self.hash_fetcher.fetch(fetched, lambda x: x[0].account, validate)
+        else:
+            validated = ((x, validate(x)) for x in fetched)
+
+        for _, validation_result in validated:
+            if incremental and validation_result.validated:
+                self.record_validation(validation_result)
+
+            yield validation_result
+
+    @staticmethod
+    def _is_unchanged(entry: StorageBlobValidationEntry, current_state: BlobState, full_sweep_before: datetime.datetime) -> bool:
+        """
+        True if the blob has the ETag recorded when it was last validated and
+        it has been fully validated since full_sweep_before.
+        """
+        if not entry.etag or current_state is None or entry.etag != current_state.etag:
+            return False
+
+        if not entry.last_full_check:
+            return False
+
+        return datetime.datetime.fromisoformat(entry.last_full_check) >= full_sweep_before
+
+    def record_validation(self, result: BlobValidationResult):
+        """
+        Record the ETag and time of a successful full validation on the entry
+        so the next incremental validation can skip the blob if it is 
+        unchanged. Only the validation columns are written, history is left
+        as is.
+
+        A skipped blob has nothing new to record and is not written, unless
+        performance.recordLastChecked is set to keep the time of every check.
+        """
+        entry = result.validation_entry
+        now = datetime.datetime.utcnow().isoformat()
+
+        if result.skipped:
+            if not self.get_performance_setting("recordLastChecked", False):
+                return
+        else:
+            entry.last_full_check = now
+            self.set_entry_state(entry, result.current_state)
+
+        entry.last_checked = now
+        self.add_table_record(entry)
+
+    def set_entry_state(self, entry: StorageBlobValidationEntry, state: BlobState):
+        """
+        Store a blob's current hash, ETag and last modified time on its entry.
+        """
+        entry.md5 = state.md5 if state else None
+        if state:
+            entry.etag = state.etag
+            entry.last_modified = state.last_modified
+            if state.content_hash is not None:
+                entry.content_hash = state.content_hash
+                entry.content_hash_algorithm = state.content_hash_algorithm
+
+    def search_table_store(self, industry:str, select: typing.List[str] = None) -> typing.List[StorageBlobValidationEntry]:
+        """
+        Get the records for an industry, see iter_table_store.
+        """
+        return list(self.iter_table_store(industry, select))
+
+    def iter_table_store(self, industry:str, select: typing.List[str] = None) -> typing.Iterator[StorageBlobValidationEntry]:
+        """
+        Yields the records for an industry as they are read. With a local 
+        snapshot, only records changed since the last sync are downloaded and
+        the records are read from the snapshot (with all columns, select is 
+        not used). With a shard, only the shard's records are yielded.
+        """
+        table = self.configuration.historyStorage["table"]
+        include = self.shard.owns if self.shard is not None else None
+
+        if self.snapshot is None:
+            yield from self.validation_table_store.iter_records(
+                table, 
+                self.key_scheme.industry_filter(industry),
+                select,
+                include
+                )
+            return
+
+        self.sync_snapshot(industry)
+        for record in self.snapshot.iter_records(table, industry):
+            if include is None or include(record):
+                yield StorageBlobValidationEntry.create_from_record(table, record)
+
+    def iter_industries_table_store(self, industries: typing.List[str], select: typing.List[str] = None) -> typing.Iterator[StorageBlobValidationEntry]:
+        """
+        Yields the records for several industries from a single query. If 
+        the industries need more comparisons than a filter allows the whole
+        table is read once and records of other industries are dropped. 
+
+        With a local snapshot each industry is synced and read in turn, the
+        syncs only download changed records.
+        """
+        if len(industries) == 1 or self.snapshot is not None:
+            for industry in industries:
+                yield from self.iter_table_store(industry, select)
+            return
+
+        wanted = set(industries)
+        for entry in self.validation_table_store.iter_records(
+                self.configuration.historyStorage["table"],
+                self.key_scheme.industries_filter(industries),
+                select,
+                self.shard.owns if self.shard is not None else None):
+            if entry.industry in wanted:
+                yield entry
+
+    def sync_snapshot(self, industry: str) -> int:
+        """
+        Download the industry's records that changed since the last sync into
+        the local snapshot, returns the number downloaded.
+        """
+        table = self.configuration.historyStorage["table"]
+        query_filter = self.key_scheme.industry_filter(industry)
+
+        last_sync = self.snapshot.get_last_sync(table, industry)
+        if last_sync:
+            query_filter = "({}) and {} ge datetime'{}'".format(
+                query_filter,
+                AzureTableStoreUtil.TIMESTAMP_PROPERTY,
+                last_sync
+            )
+
+        entity_records = self.validation_table_store.query_entity_records(table, query_filter)
+        if self.shard is not None:
+            # A shard's snapshot only holds its own records
+            entity_records = (x for x in entity_records if self.shard.owns(x))
+
+        synced = self.snapshot.sync(
+            table,
+            industry,
+            entity_records,
+            AzureTableStoreUtil.TIMESTAMP_PROPERTY
+        )
+        print("Synced", synced, "changed records for", industry, "to the local snapshot")
+        return synced
+
+    def refresh_snapshot(self, industry: str = None):
+        """
+        Drop the local snapshot of an industry (or all of them) so the next
+        search downloads every record, picking up rows deleted by others.
+        """
+        if self.snapshot:
+            self.snapshot.clear(self.configuration.historyStorage["table"], industry)
+
+    def get_table_record(self, industry: str, account: str, blob: str) -> StorageBlobValidationEntry:
+        """
+        Point lookup of the record for a blob, only available when the table
+        uses one of the industry key schemes.
+        """
+        partition_key, row_key = self.key_scheme.get_keys(industry, account, blob)
+        return self.validation_table_store.get_record(
+            self.configuration.historyStorage["table"],
+            partition_key,
+            row_key
+        )
+
+    def migrate_keys(self, report_every: int = AzureTableStoreUtil.MAX_BATCH_SIZE) -> int:
+        """
+        Rewrite every record that is not stored with the configured key scheme
+        into the new layout. New rows are written in batches per partition 
+        before the old rows are deleted, so an interrupted migration can be run
+        again and will continue with the records that have not been moved.
+        If the same blob was recorded more than once the last one read wins.
+
+        Returns the number of records migrated.
+        """
+        if self.key_scheme.is_legacy:
+            raise Exception("Set historyStorage.keyScheme in the configuration to migrate keys")
+
+        table = self.configuration.historyStorage["table"]
+        start_time = time.time()
+        migrated = 0
+        skipped = 0
+
+        for entry in self.validation_table_store.iter_records(table):
+            if not entry.industry or not entry.account or self.key_scheme.is_current(entry):
+                skipped += 1
+                continue
+
+            self.add_table_record(entry)
+            migrated += 1
+
+            if migrated % report_every == 0:
+                Context._print_throughput("Migrated", migrated, start_time)
+
+        failures = self.flush_table_records()
+        migrated -= len(failures)
+        Context._print_throughput("Migrated", migrated, start_time)
+
+        print("Migration complete,", migrated, "records moved,", skipped, "already migrated or skipped")
+        return migrated
+
+    @staticmethod
+    def _print_throughput(activity: str, count: int, start_time: float):
+        elapsed = max(time.time() - start_time, 0.001)
+        print(activity, count, "records in", round(elapsed, 1), "seconds,", round(count / elapsed, 1), "records/second")
+
+    def plan_ingest(self, ingest_settings: Configuration) -> IngestPlan:
+        """
+        Fetch the current hash of every blob in the ingest settings and 
+        compare them with the records already in the table for the industry.
+        """
+        plan = IngestPlan(
+            ingest_settings.industry,
+            ingest_settings.account,
+            ingest_settings.subscription
+        )
+
+        index = IngestPlan.index_entries(self.search_table_store(ingest_settings.industry))
+
+        # Blobs matching the patterns get their state from the listings
+        listed = {}
+        patterns = getattr(ingest_settings, "patterns", None)
+        if patterns:
+            listed = self.list_blob_states(ingest_settings.account, ingest_settings.subscription, patterns)
+
+        # Blobs listed more than once are only ingested once, names are 
+        # compared as container/path the way patterns are split
+        blobs = {}
+        for blob in getattr(ingest_settings, "blobs", None) or []:
+            blobs.setdefault(KeyScheme.normalize_blob(blob), blob)
+        blobs = [blob for name, blob in blobs.items() if name not in listed]
 
-    def search_table_store(self, industry:str) -> typing.List[StorageBlobValidationEntry]:
-        return self.validation_table_store.search_industry(
-            self.configuration.historyStorage["table"], 
-            industry
+        if self.checkpoint is not None:
+            blobs = [blob for blob in blobs if not self.is_completed(ingest_settings.account, blob)]
+            listed = {blob: state for blob, state in listed.items() if not self.is_completed(ingest_settings.account, blob)}
+
+        fetched = self.fetch_blob_states(
+            blobs,
+            lambda blob: (ingest_settings.account, ingest_settings.subscription, blob),
+            self.verify_content
+        )
+
+        for blob, blob_state in fetched:
+            plan.add(blob, blob_state, index)
+
+        listed_states = listed.items()
+        if self.verify_content:
+            listed_states = self.hash_fetcher.fetch(
+                listed_states,
+                lambda _: ingest_settings.account,
+                lambda listed_state: self.add_content_hash(ingest_settings.account, ingest_settings.subscription, *listed_state)
+            )
+            listed_states = ((blob, blob_state) for (blob, _), blob_state in listed_states)
+
+        for blob, blob_state in listed_states:
+            plan.add(blob, blob_state, index)
+
+        return plan
+
+    def list_blob_states(self, account: str, subscription: str, patterns: typing.List[str]) -> typing.Dict[str, BlobState]:
+        """
+        Expand blob patterns, a container and prefix (container/path/) or a
+        glob (container/path/*.bin), into the blobs they match and their 
+        states, taken from the container listings. Patterns are listed in
+        parallel with the hash fetcher.
+
+        Returns a dictionary of blob (container/name) to BlobState.
+        """
+        def list_pattern(pattern):
+            container, prefix, glob = AzureBlobStorageUtils.split_pattern(pattern)
+            container_states = self._call_blob_storage(
+                account,
+                subscription,
+                lambda blob_utils: blob_utils.list_blob_states(container, prefix, glob)
+            )
+            return {"{}/{}".format(container, name): state for name, state in container_states.items()}
+
+        blob_states = {}
+        for pattern, pattern_states in self.hash_fetcher.fetch(list(dict.fromkeys(patterns)), lambda _: account, list_pattern):
+            print("Pattern", pattern, "matched", len(pattern_states), "blobs")
+            blob_states.update(pattern_states)
+
+        return blob_states
+
+    def apply_ingest_plan(self, plan: IngestPlan, actor: str, create_activity: str = "create", update_activity: str = "create_rebase"):
+        """
+        Queue the table writes for the created and updated entries in a plan.
+
+        Parameters:
+        plan - Plan from plan_ingest() or import_manifest()
+        actor - Who is making the change
+        create_activity - History activity of created entries
+        update_activity - History activity of updated entries
+        """
+        for item in plan.update:
+            print("Updating hash for", item.blob)
+            self.set_entry_state(item.entry, item.current_state)
+            item.entry.actor = actor
+            item.entry.history.append(
+                self.get_history_entry(update_activity, actor)
+            )
+            self.add_table_record(item.entry)
+            self.complete(plan.account, item.blob)
+
+        for item in plan.create:
+            print("Adding entry for", item.blob, "in", plan.account)
+            blob_entry = StorageBlobValidationEntry(self.configuration.historyStorage["table"], item.blob)
+            blob_entry.account = plan.account
+            blob_entry.subscription = plan.subscription
+            blob_entry.industry = plan.industry
+            self.set_entry_state(blob_entry, item.current_state)
+            blob_entry.actor = actor
+            blob_entry.history.append(
+                self.get_history_entry(create_activity, actor)
+            )
+            item.entry = blob_entry
+            self.add_table_record(blob_entry)
+            self.complete(plan.account, item.blob)
+
+        for item in plan.unchanged:
+            self.complete(plan.account, item.blob)
+
+        return self.flush_table_records()
+
+    def export_manifest(self, industries: typing.List[str], path: str, current: bool = False) -> int:
+        """
+        Write the hashes recorded for the industries to a manifest, or with
+        current the hashes the blobs have now. Blobs whose state can not be
+        read are left out of a current manifest. Returns the records written.
+        """
+        entries = self.iter_industries_table_store(industries, StorageBlobValidationEntry.VALIDATION_COLUMNS)
+
+        if current:
+            fetched = self.fetch_blob_states(
+                entries,
+                lambda entry: (entry.account, entry.subscription, entry.blob),
+                self.verify_content
             )
+            records = (ManifestRecord.from_state(entry, state) for entry, state in fetched if state is not None)
+        else:
+            records = (ManifestRecord.from_entry(entry) for entry in entries)
+
+        source = "{} hashes of {}".format("current" if current else "recorded", ",".join(industries))
+        return HashManifest.write(path, records, source)
+
+    def import_manifest(self, path: str, actor: str, dry_run: bool = False) -> typing.List[IngestPlan]:
+        """
+        Record the hashes in a manifest as they are, without reading the 
+        blobs. Entries are created or updated as in an ingest, one plan per 
+        industry, account and subscription in the manifest.
+
+        Parameters:
+        path - Manifest to import
+        actor - Who is making the change
+        dry_run - Only plan the changes
+        """
+        plans = []
+
+        # Manifests are sorted on industry first
+        for industry, records in itertools.groupby(HashManifest.read(path), lambda x: x.industry):
+            if industry not in self.configuration.industries:
+                raise Exception("Manifest industry {} is not in the configuration".format(industry))
+
+            index = IngestPlan.index_entries(self.iter_table_store(industry))
+            industry_plans = {}
+            for record in records:
+                plan_key = (record.account, record.subscription)
+                if plan_key not in industry_plans:
+                    industry_plans[plan_key] = IngestPlan(industry, record.account, record.subscription)
+                industry_plans[plan_key].add(record.blob, record.get_state(), index)
+
+            for plan in industry_plans.values():
+                if not dry_run:
+                    self.apply_ingest_plan(plan, actor, "import", "import_rebase")
+                plans.append(plan)
+
+        return plans
 
     def get_history_entry(self, activity: str, actor:str):
         return {
@@ -60,15 +645,118 @@ class Context:
 
 
     def add_table_record(self, entry: StorageBlobValidationEntry):
+        """
+        Queue the entry to be written to the table, writes are sent in batches
+        so call flush_table_records() to be sure it has been written.
+        """
         table = entry.table_name
 
         if not table:
             table = self.configuration.historyStorage["table"]
 
-        self.validation_table_store.add_record(
-                table,
-                entry.get_entity()
+        # Only move records that were fully read, a partial record written to
+        # new keys would lose the columns that were not read.
+        if entry.history_loaded or entry.stored_keys is None:
+            self.key_scheme.apply(entry)
+
+        # History that was never decoded has not changed, so only history
+        # that was used can have grown past the limit.
+        if entry.history_decoded:
+            self._limit_history(entry)
+
+        # If the record moved to the configured key scheme, the old row is
+        # removed once this one is written.
+        entity = entry.get_entity()
+
+        # Journaled first, the upsert may be written straight away
+        if self.checkpoint:
+            self.checkpoint.add_pending(table, entity, entry.stored_keys)
+
+        self.write_buffer.upsert(
+            table,
+            entity,
+            entry.stored_keys
+        )
+
+        if self.snapshot:
+            self.snapshot.merge(table, entity, entry.stored_keys)
+
+        entry.stored_keys = (entry.PartitionKey, entry.RowKey)
+
+    def _limit_history(self, entry: StorageBlobValidationEntry):
+        """
+        Keep at most historyStorage.historyLimit items in the history column. 
+        Older items are queued for historyStorage.auditTable when it is set, 
+        otherwise they are dropped.
+        """
+        limit = self.configuration.historyStorage.get("historyLimit", Context.DEFAULT_HISTORY_LIMIT)
+        if not limit or len(entry.history) <= limit:
+            return
+
+        overflow = entry.history[:-limit]
+        entry.history = entry.history[-limit:]
+
+        audit_table = self.configuration.historyStorage.get("auditTable")
+        if not audit_table:
+            return
+
+        partition_key = self._get_audit_partition(entry.account, entry.blob)
+        for index, item in enumerate(overflow):
+            audit_entity = dict(item)
+            audit_entity["PartitionKey"] = partition_key
+            audit_entity["RowKey"] = "{}_{:04d}".format(
+                KeyScheme.escape_key(str(item.get("timestamp", ""))),
+                index
+            )
+            audit_entity["industry"] = entry.industry
+            audit_entity["account"] = entry.account
+            audit_entity["blob"] = entry.blob
+            self.write_buffer.upsert(audit_table, audit_entity, None)
+
+    @staticmethod
+    def _get_audit_partition(account: str, blob: str) -> str:
+        return KeyScheme.SEPARATOR.join([
+            KeyScheme.escape_key(account),
+            KeyScheme.escape_key(KeyScheme.normalize_blob(blob))
+        ])
+
+    def get_entry_history(self, entry: StorageBlobValidationEntry) -> typing.List[dict]:
+        """
+        Full history of an entry, the items archived to historyStorage.auditTable
+        followed by the items still in the history column.
+        """
+        history = []
+
+        audit_table = self.configuration.historyStorage.get("auditTable")
+        if audit_table:
+            query_filter = "PartitionKey eq {}".format(
+                AzureTableStoreUtil.odata_string(self._get_audit_partition(entry.account, entry.blob))
             )
+            for record in self.validation_table_store.query_entity_records(audit_table, query_filter, ["timestamp", "activity", "actor"]):
+                history.append({
+                    "timestamp" : record.get("timestamp"),
+                    "activity" : record.get("activity"),
+                    "actor" : record.get("actor")
+                })
+            history.sort(key=lambda item: item["timestamp"] or "")
+
+        return history + (entry.history or [])
+
+    def flush_table_records(self):
+        """
+        Write any queued table records, prints and returns the records that
+        could not be written.
+        """
+        failures = self.write_buffer.flush()
+        for failure in failures:
+            print("Failed to write record", str(failure))
+
+        # The snapshot was written through and no longer matches the table
+        if failures and self.snapshot:
+            for table in set([failure.table_name for failure in failures]):
+                self.snapshot.clear(table)
+
+        return failures
 
     def get_current_hash(self, existing_entry: StorageBlobValidationEntry) -> str:
         return self.get_blob_hash(
@@ -78,10 +766,171 @@ class Context:
         )
 
     def get_blob_hash(self, account: str, subscription: str, blob: str):
-        blob_storage = AzCliStorageUtil.get_storage_account(
+        blob_state = self.get_blob_state(account, subscription, blob)
+        return blob_state.md5 if blob_state else None
+
+    def get_blob_state(self, account: str, subscription: str, blob: str) -> BlobState:
+        """
+        Get the state of a blob, None if the blob does not exist or the 
+        service could not be reached after retrying, so one blob does not 
+        stop the run.
+        """
+        try:
+            return self._call_blob_storage(
+                account,
+                subscription,
+                lambda blob_utils: blob_utils.get_blob_state(blob)
+            )
+        except ResourceNotFoundError:
+            print("WARNING - Blob not found:", blob)
+        except Exception as ex:
+            if not StorageThrottle.is_retryable(ex):
+                raise
+            print("WARNING - Unable to get the state of", blob, "-", str(ex).splitlines()[0] if str(ex) else type(ex).__name__)
+
+        return None
+
+    def _call_blob_storage(self, account: str, subscription: str, call: typing.Callable):
+        """
+        Call with the account's blob utility through the throttle.
+        """
+        def throttled_call(blob_storage):
+            return self.throttle.call(
+                "{}.blob".format(account),
+                lambda: call(blob_storage.blob_utils)
+            )
+
+        blob_storage = self.account_cache.get_account(account, subscription)
+        try:
+            return throttled_call(blob_storage)
+        except ClientAuthenticationError:
+            # Keys may have been rotated since they were cached, get them again
+            # (unless another call already has) and retry once. 
+            blob_storage = self.account_cache.refresh(account, subscription, blob_storage)
+            return throttled_call(blob_storage)
+
+    def fetch_hashes(self, items: typing.Iterable, get_blob: typing.Callable) -> typing.Iterator[typing.Tuple[object, str]]:
+        """
+        Yields (item, hash) for each item, in the order of items, see fetch_blob_states
+        """
+        for item, blob_state in self.fetch_blob_states(items, get_blob):
+            yield item, blob_state.md5 if blob_state else None
+
+    def fetch_blob_states(self, items: typing.Iterable, get_blob: typing.Callable, content_hash: bool = False) -> typing.Iterator[typing.Tuple[object, BlobState]]:
+        """
+        Yields (item, BlobState) for each item, in the order of items.
+
+        Parameters:
+        items - Items to get blob states for
+        get_blob - Callable returning (account, subscription, blob) for an item
+        content_hash - Also read the content of each blob to add its digest
+        """
+        if self.list_hashes:
+            items = list(items)
+            blob_states = self.get_blob_states([get_blob(item) for item in items])
+            fetched = ((item, blob_states[get_blob(item)]) for item in items)
+        else:
+            fetched = self.hash_fetcher.fetch(
+                items,
+                lambda item: get_blob(item)[0],
+                lambda item: self.get_blob_state(*get_blob(item))
+            )
+
+        if not content_hash:
+            yield from fetched
+            return
+
+        def add_content_hash(fetched_state):
+            item, blob_state = fetched_state
+            if blob_state:
+                return self.add_content_hash(*get_blob(item), blob_state)
+            return blob_state
+
+        for (item, _), blob_state in self.hash_fetcher.fetch(fetched, lambda x: get_blob(x[0])[0], add_content_hash):
+            yield item, blob_state
+
+    def add_content_hash(self, account: str, subscription: str, blob: str, state: BlobState) -> BlobState:
+        """
+        Read the blob content and set the digest on its state. Returns the 
+        state, or None if the content could not be read (the blob is gone 
+        or the service could not be reached after retrying) so the blob is
+        reported as failed rather than stopping the run.
+        """
+        algorithm = self.get_performance_setting("contentHashAlgorithm", Context.DEFAULT_CONTENT_HASH_ALGORITHM)
+
+        try:
+            state.content_hash = self._call_blob_storage(
+                account,
+                subscription,
+                lambda blob_utils: blob_utils.get_content_hash(
+                    blob,
+                    algorithm=algorithm,
+                    chunk_size=int(self.get_performance_setting("contentHashChunkMB", 4) * 1024 * 1024),
+                    max_concurrency=self.get_performance_setting("contentHashConcurrency", 4),
+                    limiter=self.bandwidth_limiter
+                )
+            )
+        except ResourceNotFoundError:
+            print("WARNING - Blob not found:", blob)
+            state.content_hash = None
+            return None
+        except ResourceModifiedError:
+            print("WARNING - Blob changed while its content was read:", blob)
+            state.content_hash = None
+            return None
+        except Exception as ex:
+            if not StorageThrottle.is_retryable(ex):
+                raise
+            print("WARNING - Unable to read the content of", blob, "-", str(ex).splitlines()[0] if str(ex) else type(ex).__name__)
+            state.content_hash = None
+            return None
+
+        state.content_hash_algorithm = algorithm
+        return state
+
+    def get_blob_states(self, blobs: typing.Iterable[typing.Tuple[str, str, str]]) -> typing.Dict[typing.Tuple[str, str, str], BlobState]:
+        """
+        Get hashes for many blobs by listing each container they are in once.
+        Containers are listed in parallel with the hash fetcher, blobs not 
+        found in a listing are requested individually.
+
+        Parameters:
+        blobs - (account, subscription, blob) for each blob
+
+        Returns a dictionary of (account, subscription, blob) to BlobState.
+        """
+        # (account, subscription, container) -> { name in container : blob }
+        containers = {}
+        for account, subscription, blob in blobs:
+            container, blob_name = AzureBlobStorageUtils._parse_blob_parts(blob)
+            containers.setdefault((account, subscription, container), {})[blob_name] = blob
+
+        fetched = self.hash_fetcher.fetch(
+            list(containers.items()),
+            lambda container: container[0][0],
+            self._get_container_states
+        )
+
+        return_value = {}
+        for (container_key, blob_names), container_states in fetched:
+            for blob_name, blob in blob_names.items():
+                return_value[(container_key[0], container_key[1], blob)] = container_states[blob_name]
+
+        return return_value
+
+    def _get_container_states(self, container: typing.Tuple[typing.Tuple[str, str, str], typing.Dict[str, str]]) -> typing.Dict[str, BlobState]:
+        (account, subscription, container_name), blob_names = container
+        prefix = os.path.commonprefix(list(blob_names.keys()))
+
+        container_states = self._call_blob_storage(
             account,
-            subscription) 
-                 
-        stgutil = AzureBlobStorageUtils(blob_storage.name, blob_storage.keys[0])
+            subscription,
+            lambda blob_utils: blob_utils.get_container_states(container_name, blob_names.keys(), prefix)
+        )
+
+        # Anything not in the listing is requested on its own
+        for blob_name, blob in blob_names.items():
+            if blob_name not in container_states:
+                container_states[blob_name] = self.get_blob_state(account, subscription, blob)
 
-        return stgutil.get_blob_hash(blob)
\ No newline at end of file
+        return container_states
@@ -0,0 +1,62 @@
+import threading
+import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HashFetcher:
+    """
+    Fetches blob hashes on a pool of worker threads.
+
+    Results are yielded in the same order the items were supplied, as soon
+    as the item at the head of the queue is complete, so callers can print
+    or act on results while later ones are still in flight. At most
+    workers * 2 items are outstanding at any time and no more than
+    account_limit requests are made against a single storage account at once.
+    """
+    def __init__(self, workers: int = 1, account_limit: int = None):
+        self.workers = max(1, workers or 1)
+        self.account_limit = max(1, account_limit or self.workers)
+        self.account_locks: typing.Dict[str, threading.BoundedSemaphore] = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, items: typing.Iterable, get_account: typing.Callable, get_hash: typing.Callable) -> typing.Iterator[typing.Tuple[object, str]]:
+        """
+        Yields (item, hash) for each item in items. 
+
+        Parameters:
+        items - Items to get hashes for
+        get_account - Callable returning the storage account name for an item
+        get_hash - Callable returning the hash for an item
+        """
+        if self.workers == 1:
+            for item in items:
+                yield item, get_hash(item)
+            return
+
+        max_pending = self.workers * 2
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for item in items:
+                pending.append(
+                    (item, executor.submit(self._fetch_one, get_account(item), get_hash, item))
+                )
+
+                if len(pending) >= max_pending:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+
+    def _fetch_one(self, account: str, get_hash: typing.Callable, item):
+        with self._get_account_lock(account):
+            return get_hash(item)
+
+    def _get_account_lock(self, account: str) -> threading.BoundedSemaphore:
+        with self.lock:
+            if account not in self.account_locks:
+                self.account_locks[account] = threading.BoundedSemaphore(self.account_limit)
+            return self.account_locks[account]
@@ -0,0 +1,335 @@
+import os
+import json
+import heapq
+import bisect
+import datetime
+import tempfile
+import typing
+from .storage.AzureTableValidationEntry import StorageBlobValidationEntry
+from .storage.AzureBlobStorage import BlobState
+
+
+class ManifestRecord:
+    """
+    The recorded (or current) hash of one blob in a manifest.
+    """
+    __slots__ = (
+        "industry",
+        "account",
+        "blob",
+        "subscription",
+        "md5",
+        "etag",
+        "last_modified",
+        "content_hash",
+        "content_hash_algorithm"
+    )
+
+    # Order of the values in a manifest row, the first three are the sort key
+    COLUMNS = list(__slots__)
+
+    def __init__(self, industry: str, account: str, blob: str, subscription: str = None):
+        self.industry = industry
+        self.account = account
+        self.blob = blob
+        self.subscription = subscription
+        self.md5 = None
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.content_hash_algorithm = None
+
+    @property
+    def key(self) -> typing.Tuple[str, str, str]:
+        return (self.industry or "", self.account or "", self.blob or "")
+
+    @staticmethod
+    def from_entry(entry: StorageBlobValidationEntry) -> object:
+        """
+        The hash recorded in a table entry.
+        """
+        record = ManifestRecord(entry.industry, entry.account, entry.blob, entry.subscription)
+        record.md5 = entry.md5
+        record.etag = entry.etag
+        record.last_modified = entry.last_modified
+        record.content_hash = entry.content_hash
+        record.content_hash_algorithm = entry.content_hash_algorithm
+        return record
+
+    @staticmethod
+    def from_state(entry: StorageBlobValidationEntry, state: BlobState) -> object:
+        """
+        The current state of the blob a table entry tracks.
+        """
+        record = ManifestRecord(entry.industry, entry.account, entry.blob, entry.subscription)
+        record.md5 = state.md5
+        record.etag = state.etag
+        record.last_modified = state.last_modified
+        record.content_hash = state.content_hash
+        record.content_hash_algorithm = state.content_hash_algorithm
+        return record
+
+    def get_state(self) -> BlobState:
+        state = BlobState(self.md5, self.etag, self.last_modified)
+        state.content_hash = self.content_hash
+        state.content_hash_algorithm = self.content_hash_algorithm
+        return state
+
+    def matches(self, other: object) -> bool:
+        """
+        True if the MD5 is the same and, where both have a digest of the
+        content made with the same algorithm, the digests are the same. Two
+        records without an MD5 or a comparable digest do not match.
+        """
+        if self.md5 != other.md5:
+            return False
+
+        if self.content_hash is not None and other.content_hash is not None and \
+                self.content_hash_algorithm == other.content_hash_algorithm:
+            return self.content_hash == other.content_hash
+
+        return self.md5 is not None
+
+    def to_row(self) -> list:
+        return [getattr(self, column) for column in ManifestRecord.COLUMNS]
+
+    @staticmethod
+    def from_row(row: list) -> object:
+        record = ManifestRecord.__new__(ManifestRecord)
+        for column, value in zip(ManifestRecord.COLUMNS, row):
+            setattr(record, column, value)
+        return record
+
+
+class HashManifest:
+    """
+    A file of blob hashes sorted on (industry, account, blob), so two
+    manifests can be compared in a single pass with ManifestDiff.
+
+    The file is newline delimited json, a header object followed by one
+    array per record (values in ManifestRecord.COLUMNS order). A sidecar
+    index (path + ".idx") holds the key and byte offset of every
+    INDEX_EVERY'th record so a single blob can be found with find().
+
+    Records do not have to be written in order, they are sorted in runs of
+    SORT_RUN_SIZE records in temporary files which are then merged. When a
+    key is written more than once the first record is kept.
+    """
+    FORMAT = "hash-manifest"
+    VERSION = 1
+    INDEX_EVERY = 1024
+    SORT_RUN_SIZE = 100000
+    INDEX_SUFFIX = ".idx"
+
+    @staticmethod
+    def write(path: str, records: typing.Iterable[ManifestRecord], source: str = None) -> int:
+        """
+        Write records to a manifest (and its index), returns the number written.
+
+        Parameters:
+        path - Manifest file to write
+        records - Records in any order
+        source - Optional description of where the records came from
+        """
+        work_dir = os.path.dirname(os.path.abspath(path))
+        with tempfile.TemporaryDirectory(dir=work_dir) as run_dir:
+            runs = []
+            run = []
+            for record in records:
+                run.append(record)
+                if len(run) >= HashManifest.SORT_RUN_SIZE:
+                    runs.append(HashManifest._write_run(run_dir, len(runs), run))
+                    run = []
+
+            if not runs:
+                run.sort(key=lambda x: x.key)
+                return HashManifest._write_sorted(path, run, source)
+
+            if run:
+                runs.append(HashManifest._write_run(run_dir, len(runs), run))
+
+            return HashManifest._write_sorted(
+                path,
+                heapq.merge(*[HashManifest._read_run(x) for x in runs], key=lambda x: x.key),
+                source
+            )
+
+    @staticmethod
+    def _write_run(run_dir: str, run_number: int, run: typing.List[ManifestRecord]) -> str:
+        run_path = os.path.join(run_dir, "run_{}.ndjson".format(run_number))
+        run.sort(key=lambda x: x.key)
+        with open(run_path, "w") as run_file:
+            for record in run:
+                run_file.write(json.dumps(record.to_row()) + "\n")
+        return run_path
+
+    @staticmethod
+    def _read_run(run_path: str) -> typing.Iterator[ManifestRecord]:
+        with open(run_path, "r") as run_file:
+            for line in run_file:
+                yield ManifestRecord.from_row(json.loads(line))
+
+    @staticmethod
+    def _write_sorted(path: str, records: typing.Iterable[ManifestRecord], source: str) -> int:
+        header = {
+            "format" : HashManifest.FORMAT,
+            "version" : HashManifest.VERSION,
+            "created" : datetime.datetime.utcnow().isoformat(),
+            "source" : source,
+            "columns" : ManifestRecord.COLUMNS
+        }
+
+        index_keys = []
+        count = 0
+        last_key = None
+        with open(path, "wb") as manifest_file:
+            manifest_file.write((json.dumps(header) + "\n").encode("utf-8"))
+
+            for record in records:
+                key = record.key
+                if key == last_key:
+                    continue
+                last_key = key
+
+                if count % HashManifest.INDEX_EVERY == 0:
+                    index_keys.append(list(key) + [manifest_file.tell()])
+
+                manifest_file.write((json.dumps(record.to_row(), separators=(",", ":")) + "\n").encode("utf-8"))
+                count += 1
+
+        with open(path + HashManifest.INDEX_SUFFIX, "w") as index_file:
+            json.dump({
+                "every" : HashManifest.INDEX_EVERY,
+                "records" : count,
+                "keys" : index_keys
+            }, index_file)
+
+        return count
+
+    @staticmethod
+    def get_header(path: str) -> dict:
+        with open(path, "rb") as manifest_file:
+            return HashManifest._read_header(path, manifest_file)
+
+    @staticmethod
+    def _read_header(path: str, manifest_file) -> dict:
+        line = manifest_file.readline()
+        header = json.loads(line) if line.strip() else {}
+        if header.get("format") != HashManifest.FORMAT:
+            raise Exception("{} is not a hash manifest".format(path))
+        if header.get("version", 0) > HashManifest.VERSION:
+            raise Exception("{} is manifest version {}, only {} and earlier can be read".format(
+                path, header.get("version"), HashManifest.VERSION
+            ))
+        return header
+
+    @staticmethod
+    def read(path: str) -> typing.Iterator[ManifestRecord]:
+        """
+        Yields the records of a manifest in key order.
+        """
+        with open(path, "rb") as manifest_file:
+            HashManifest._read_header(path, manifest_file)
+            for line in manifest_file:
+                yield ManifestRecord.from_row(json.loads(line))
+
+    @staticmethod
+    def find(path: str, industry: str, account: str, blob: str) -> ManifestRecord:
+        """
+        Find a single record using the index, None if it is not in the manifest.
+        """
+        with open(path + HashManifest.INDEX_SUFFIX, "r") as index_file:
+            index = json.load(index_file)
+
+        key = (industry, account, blob)
+        keys = [tuple(x[:3]) for x in index["keys"]]
+        position = bisect.bisect_right(keys, key) - 1
+        if position < 0:
+            return None
+
+        with open(path, "rb") as manifest_file:
+            manifest_file.seek(index["keys"][position][3])
+            for _ in range(index["every"]):
+                line = manifest_file.readline()
+                if not line:
+                    break
+                record = ManifestRecord.from_row(json.loads(line))
+                if record.key == key:
+                    return record
+                if record.key > key:
+                    break
+
+        return None
+
+
+class ManifestDiff:
+    """
+    Compares a baseline manifest with another (i.e. the current hashes) by
+    walking both in key order at once, so memory use does not grow with the
+    size of the manifests. Counts of each kind of difference are kept as
+    the comparison runs.
+    """
+    ADDED = "added"
+    REMOVED = "removed"
+    CHANGED = "changed"
+    UNCHANGED = "unchanged"
+
+    def __init__(self):
+        self.counts = {
+            ManifestDiff.ADDED : 0,
+            ManifestDiff.REMOVED : 0,
+            ManifestDiff.CHANGED : 0,
+            ManifestDiff.UNCHANGED : 0
+        }
+
+    def compare(self, baseline: typing.Iterable[ManifestRecord], current: typing.Iterable[ManifestRecord]) -> typing.Iterator[typing.Tuple[str, ManifestRecord, ManifestRecord]]:
+        """
+        Yields (difference, baseline record, current record) for every key in
+        either manifest, the record missing from one side is None.
+
+        Parameters:
+        baseline - Records in key order, see HashManifest.read()
+        current - Records in key order
+        """
+        baseline = ManifestDiff._check_order(baseline, "baseline")
+        current = ManifestDiff._check_order(current, "current")
+
+        base_record = next(baseline, None)
+        current_record = next(current, None)
+
+        while base_record is not None or current_record is not None:
+            if current_record is None or (base_record is not None and base_record.key < current_record.key):
+                difference = (ManifestDiff.REMOVED, base_record, None)
+                base_record = next(baseline, None)
+            elif base_record is None or current_record.key < base_record.key:
+                difference = (ManifestDiff.ADDED, None, current_record)
+                current_record = next(current, None)
+            else:
+                state = ManifestDiff.UNCHANGED if base_record.matches(current_record) else ManifestDiff.CHANGED
+                difference = (state, base_record, current_record)
+                base_record = next(baseline, None)
+                current_record = next(current, None)
+
+            self.counts[difference[0]] += 1
+            yield difference
+
+    @staticmethod
+    def _check_order(records: typing.Iterable[ManifestRecord], name: str) -> typing.Iterator[ManifestRecord]:
+        last_key = None
+        for record in records:
+            if last_key is not None and record.key < last_key:
+                raise Exception("The {} records are not in key order at {}".format(name, "/".join(record.key)))
+            last_key = record.key
+            yield record
+
+    @property
+    def differences(self) -> int:
+        return self.counts[ManifestDiff.ADDED] + self.counts[ManifestDiff.REMOVED] + self.counts[ManifestDiff.CHANGED]
+
+    def summary(self) -> str:
+        return "{} changed, {} added, {} removed, {} unchanged".format(
+            self.counts[ManifestDiff.CHANGED],
+            self.counts[ManifestDiff.ADDED],
+            self.counts[ManifestDiff.REMOVED],
+            self.counts[ManifestDiff.UNCHANGED]
+        )
@@ -0,0 +1,74 @@
+import typing
+from .storage.AzureTableValidationEntry import StorageBlobValidationEntry
+from .storage.AzureBlobStorage import BlobState
+from .storage.KeyScheme import KeyScheme
+
+
+class IngestItem:
+    """
+    A blob from the ingest settings, its current hash and the table entry
+    already tracking it (None if the blob is not tracked yet).
+    """
+    def __init__(self, blob: str, current_state: BlobState, entry: StorageBlobValidationEntry = None):
+        self.blob = blob
+        self.current_state = current_state
+        self.current_hash = current_state.md5 if current_state else None
+        self.entry = entry
+
+
+class IngestPlan:
+    """
+    The changes an ingest makes to the table, split into blobs that need
+    an entry created, entries whose hash needs updating and entries that
+    are unchanged. Blobs whose state could not be read (missing, or the
+    service could not be reached) are left out of the changes.
+    """
+    def __init__(self, industry: str, account: str, subscription: str):
+        self.industry = industry
+        self.account = account
+        self.subscription = subscription
+        self.create: typing.List[IngestItem] = []
+        self.update: typing.List[IngestItem] = []
+        self.unchanged: typing.List[IngestItem] = []
+        self.missing: typing.List[IngestItem] = []
+
+    @staticmethod
+    def index_entries(entries: typing.Iterable[StorageBlobValidationEntry]) -> typing.Dict[typing.Tuple[str, str], StorageBlobValidationEntry]:
+        """
+        Index existing entries on (account, blob), the first entry found wins
+        as it did when the list was searched. Blobs are normalized, so an
+        entry recorded as /container\\path is found for container/path.
+        """
+        index = {}
+        for entry in entries:
+            index.setdefault((entry.account, KeyScheme.normalize_blob(entry.blob or "")), entry)
+        return index
+
+    def add(self, blob: str, current_state: BlobState, index: typing.Dict[typing.Tuple[str, str], StorageBlobValidationEntry]) -> IngestItem:
+        """
+        Compare a blob's current hash with the indexed entries and record
+        which of the three sets it belongs to.
+        """
+        entry = index.get((self.account, KeyScheme.normalize_blob(blob)))
+        item = IngestItem(blob, current_state, entry)
+
+        if current_state is None:
+            self.missing.append(item)
+        elif entry is None:
+            self.create.append(item)
+        elif not entry.matches_state(current_state):
+            self.update.append(item)
+        else:
+            self.unchanged.append(item)
+
+        return item
+
+    def summary(self) -> str:
+        return "{} in {}: {} to create, {} to update, {} unchanged, {} unavailable".format(
+            self.industry,
+            self.account,
+            len(self.create),
+            len(self.update),
+            len(self.unchanged),
+            len(self.missing)
+        )
@@ -9,8 +9,33 @@ class ProgramArguments:
         self.parser.add_argument("-rebase",action="store_true",help="Rebase stored records, industry required")
         self.parser.add_argument("-validate", action="store_true", help="Validate files for an industry, industry required")
         self.parser.add_argument("-ingest", action="store_true", help="Import files to storage, -settings required")
-        self.parser.add_argument("-industry", required=False, default=None, type=str, help="Industry required for -rebase and -validate")
+        self.parser.add_argument("-watch", action="store_true", help="Keep validating -industry (or every industry) on a schedule until stopped")
+        self.parser.add_argument("-interval", required=False, default=3600, type=float, help="With -watch, seconds between validations of an industry")
+        self.parser.add_argument("-status-file", required=False, default=None, type=str, help="With -watch, json file the latest result of each industry is written to")
+        self.parser.add_argument("-export-manifest", required=False, default=None, type=str, help="Write the hashes recorded for -industry to a manifest file")
+        self.parser.add_argument("-current", action="store_true", help="With -export-manifest, write the current hashes of the blobs instead of the recorded ones")
+        self.parser.add_argument("-import-manifest", required=False, default=None, type=str, help="Record the hashes in a manifest file without reading the blobs")
+        self.parser.add_argument("-diff-manifests", required=False, default=None, nargs=2, type=str, metavar=("BASELINE", "CURRENT"), help="Compare two manifest files, no login is needed")
+        self.parser.add_argument("-migrate-keys", action="store_true", help="Move table records to the historyStorage.keyScheme in the configuration")
+        self.parser.add_argument("-industry", required=False, default=None, type=str, help="Industry required for -rebase and -validate, a comma separated list or all validates several with one read of the table")
         self.parser.add_argument("-settings", required=False, default=None, type=str, help="Json file (exampleinput.json) required for import to table.")
+        self.parser.add_argument("-dry-run", action="store_true", help="With -ingest or -import-manifest, only print what would be created or updated")
+        self.parser.add_argument("-incremental", action="store_true", help="With -validate, skip blobs whose ETag has not changed since they were last validated, hashes come from container listings")
+        self.parser.add_argument("-full", action="store_true", help="With -validate -incremental, validate every blob and record their ETags")
+        self.parser.add_argument("-verify-content", action="store_true", help="Read blob content and check its digest as well as the Content-MD5 property")
+        self.parser.add_argument("-list-hashes", action="store_true", help="Get blob hashes from container listings rather than one request per blob, always used with -incremental")
+        self.parser.add_argument("-refresh-snapshot", action="store_true", help="Download every record again instead of only those changed since the last run (performance.snapshotPath)")
+        self.parser.add_argument("-workers", required=False, default=None, type=int, help="Number of blob hashes to fetch at once, defaults to performance.workers in the configuration")
+        self.parser.add_argument("-async", dest="use_async", action="store_true", help="Run -validate or -rebase on an asyncio event loop, -workers is then the number of requests in flight (needs aiohttp)")
+        self.parser.add_argument("-checkpoint-file", required=False, default=None, type=str, help="With -validate, -rebase or -ingest, journal progress to this file so an interrupted run can be resumed")
+        self.parser.add_argument("-resume", action="store_true", help="With -checkpoint-file, skip the blobs done by the interrupted run and retry its unwritten table records")
+        self.parser.add_argument("-shards", required=False, default=None, type=int, help="Split -validate or -rebase into this many shards, run as local processes unless -shard-index is given")
+        self.parser.add_argument("-shard-index", required=False, default=None, type=int, help="With -shards, run only this shard (0 to shards - 1), for example on one of several machines")
+        self.parser.add_argument("-shard-by", required=False, default="record", choices=["record", "account"], help="With -shards, split records by a hash of their PartitionKey and RowKey or of their storage account")
+        self.parser.add_argument("-shard-report", required=False, default=None, type=str, help="With -validate -shards -shard-index, json file the shard's summaries are written to")
+        self.parser.add_argument("-merge-shard-reports", required=False, default=None, nargs="+", type=str, metavar="REPORT", help="Combine the -shard-report files of every shard into one summary, no login is needed")
+        self.parser.add_argument("-metrics-file", required=False, default=None, type=str, help="File to write request counts and latencies to at the end of the run, Prometheus text if it ends with .prom otherwise json")
+        self.parser.add_argument("-trace-file", required=False, default=None, type=str, help="File to write a Chrome trace (chrome://tracing) of the run to")
         
         self.arguments = self.parser.parse_args(args)
 
@@ -30,13 +55,142 @@ class ProgramArguments:
     def settings(self):
         return self.arguments.settings
 
+    @property
+    def watch(self):
+        return self.arguments.watch
+
+    @property
+    def interval(self):
+        return self.arguments.interval
+
+    @property
+    def status_file(self):
+        return self.arguments.status_file
+
+    @property
+    def migrate_keys(self):
+        return self.arguments.migrate_keys
+
+    @property
+    def export_manifest(self):
+        return self.arguments.export_manifest
+
+    @property
+    def current(self):
+        return self.arguments.current
+
+    @property
+    def import_manifest(self):
+        return self.arguments.import_manifest
+
+    @property
+    def diff_manifests(self):
+        return self.arguments.diff_manifests
+
+    @property
+    def dry_run(self):
+        return self.arguments.dry_run
+
+    @property
+    def incremental(self):
+        return self.arguments.incremental
+
+    @property
+    def full(self):
+        return self.arguments.full
+
+    @property
+    def verify_content(self):
+        return self.arguments.verify_content
+
+    @property
+    def list_hashes(self):
+        # Incremental runs only need ETags, listings give them without a
+        # request per unchanged blob
+        return self.arguments.list_hashes or self.arguments.incremental
+
+    @property
+    def refresh_snapshot(self):
+        return self.arguments.refresh_snapshot
+
+    @property
+    def workers(self):
+        return self.arguments.workers
+
+    @property
+    def use_async(self):
+        return self.arguments.use_async
+
+    @property
+    def checkpoint_file(self):
+        return self.arguments.checkpoint_file
+
+    @property
+    def resume(self):
+        return self.arguments.resume
+
+    @property
+    def shards(self):
+        return self.arguments.shards
+
+    @property
+    def shard_index(self):
+        return self.arguments.shard_index
+
+    @property
+    def shard_by(self):
+        return self.arguments.shard_by
+
+    @property
+    def shard_report(self):
+        return self.arguments.shard_report
+
+    @property
+    def merge_shard_reports(self):
+        return self.arguments.merge_shard_reports
+
+    @property
+    def action(self) -> str:
+        """
+        Name of the action being run.
+        """
+        for action in ["rebase", "validate", "ingest", "migrate_keys", "watch", "export_manifest", "import_manifest", "diff_manifests", "merge_shard_reports"]:
+            if getattr(self.arguments, action):
+                return action.replace("_", "-")
+        return None
+
+    @property
+    def metrics_file(self):
+        return self.arguments.metrics_file
+
+    @property
+    def trace_file(self):
+        return self.arguments.trace_file
+
     @property
     def ingest(self):
         return self.arguments.ingest
 
+    ALL_INDUSTRIES = "all"
+
+    def get_industries(self, industries: typing.List[str]) -> typing.List[str]:
+        """
+        Industries named by -industry, all of the configured industries for
+        "all" and None if -industry was not given.
+        """
+        if not self.industry:
+            return None
+
+        if self.industry == ProgramArguments.ALL_INDUSTRIES:
+            return list(industries)
+
+        named = [x.strip() for x in self.industry.split(",") if x.strip()]
+        return list(dict.fromkeys(named))
+
     def validate_industry(self, industries: typing.List[str]):
         if self.industry:
-            if self.industry not in industries:
+            named = self.get_industries(industries)
+            if not named or len([x for x in named if x not in industries]):
                 print("The only acceptable industries are:")
                 print(industries)
                 quit()
@@ -50,15 +204,78 @@ class ProgramArguments:
             count += 1
         if self.arguments.ingest:
             count += 1
+        if self.arguments.migrate_keys:
+            count += 1
+        if self.arguments.watch:
+            count += 1
+        if self.arguments.export_manifest:
+            count += 1
+        if self.arguments.import_manifest:
+            count += 1
+        if self.arguments.diff_manifests:
+            count += 1
+        if self.arguments.merge_shard_reports:
+            count += 1
 
         if count != 1:
-            raise Exception("You must identify one: -rebase, -validate, -ingest")
+            raise Exception("You must identify one: -rebase, -validate, -ingest, -migrate-keys, -watch, -export-manifest, -import-manifest, -diff-manifests, -merge-shard-reports")
 
-        if (self.arguments.rebase or self.arguments.validate) and not self.arguments.industry:
-            raise Exception("-industry required for -rebase and -validate")
+        if (self.arguments.rebase or self.arguments.validate or self.arguments.export_manifest) and not self.arguments.industry:
+            raise Exception("-industry required for -rebase, -validate and -export-manifest")
+
+        if self.arguments.current and not self.arguments.export_manifest:
+            raise Exception("-current is only used with -export-manifest")
+
+        for manifest in [self.arguments.import_manifest] + (self.arguments.diff_manifests or []):
+            if manifest and not os.path.exists(manifest):
+                raise Exception("Manifest {} does not exist".format(manifest))
+
+        for report in self.arguments.merge_shard_reports or []:
+            if not os.path.exists(report):
+                raise Exception("Shard report {} does not exist".format(report))
 
         if self.arguments.ingest:
             if not self.arguments.settings:
                 raise Exception("-settings required for -ingest")
             if not os.path.exists(self.arguments.settings):
                 raise Exception("-settings does not point to valid file")
+
+        if self.arguments.dry_run and not (self.arguments.ingest or self.arguments.import_manifest):
+            raise Exception("-dry-run is only used with -ingest or -import-manifest")
+
+        if self.arguments.incremental and not (self.arguments.validate or self.arguments.watch):
+            raise Exception("-incremental is only used with -validate or -watch")
+
+        if self.arguments.checkpoint_file and not (self.arguments.validate or self.arguments.rebase or self.arguments.ingest):
+            raise Exception("-checkpoint-file is only used with -validate, -rebase or -ingest")
+
+        if self.arguments.resume and not self.arguments.checkpoint_file:
+            raise Exception("-resume requires -checkpoint-file")
+
+        if self.arguments.use_async:
+            if not (self.arguments.validate or self.arguments.rebase):
+                raise Exception("-async is only used with -validate or -rebase")
+            if self.arguments.verify_content or self.arguments.checkpoint_file or self.arguments.refresh_snapshot:
+                raise Exception("-async can not be used with -verify-content, -checkpoint-file or -refresh-snapshot")
+
+        if self.arguments.shards is not None:
+            if not (self.arguments.validate or self.arguments.rebase):
+                raise Exception("-shards is only used with -validate or -rebase")
+            if self.arguments.shards < 1:
+                raise Exception("-shards must be 1 or more")
+            if self.arguments.shard_index is not None and not 0 <= self.arguments.shard_index < self.arguments.shards:
+                raise Exception("-shard-index must be from 0 to {}".format(self.arguments.shards - 1))
+        elif self.arguments.shard_index is not None or self.arguments.shard_report:
+            raise Exception("-shard-index and -shard-report require -shards")
+
+        if self.arguments.shard_report and not (self.arguments.validate and self.arguments.shard_index is not None):
+            raise Exception("-shard-report is only used with -validate -shard-index")
+
+        if self.arguments.watch and self.arguments.interval <= 0:
+            raise Exception("-interval must be greater than 0")
+
+        if self.arguments.full and not (self.arguments.validate and self.arguments.incremental):
+            raise Exception("-full is only used with -validate -incremental")
+
+        if self.arguments.workers is not None and self.arguments.workers < 1:
+            raise Exception("-workers must be 1 or more")
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import hashlib
+import subprocess
+import typing
+from .Watcher import IndustrySummary
+
+
+class Shard:
+    """
+    One of count shards of a validation. Records are assigned to a shard by
+    a stable hash of their keys or storage account, so every process (or
+    machine) given the same count agrees which records are its own.
+
+    Sharding by record hashes PartitionKey and RowKey together, which spreads
+    the records evenly with any key scheme (with the industry scheme every
+    record of an industry shares one PartitionKey). Sharding by account keeps
+    all requests to an account in one process.
+    """
+    BY_RECORD = "record"
+    BY_ACCOUNT = "account"
+    SHARD_KEYS = [BY_RECORD, BY_ACCOUNT]
+
+    def __init__(self, count: int, index: int, by: str = BY_RECORD):
+        if count < 1 or index < 0 or index >= count:
+            raise Exception("Shard index must be from 0 to {}, not {}".format(count - 1, index))
+        if by not in Shard.SHARD_KEYS:
+            raise Exception("Shards are split by one of {}".format(Shard.SHARD_KEYS))
+
+        self.count = count
+        self.index = index
+        self.by = by
+
+    @staticmethod
+    def get_shard(value: str, count: int) -> int:
+        """
+        Shard a value belongs to, the same in every process (unlike hash()).
+        """
+        digest = hashlib.md5((value or "").encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % count
+
+    def owns(self, record: dict) -> bool:
+        """
+        True if a record (SDK entity or dictionary) belongs to this shard,
+        checked before the record is converted to an entry.
+        """
+        if self.by == Shard.BY_ACCOUNT:
+            return Shard.get_shard(record.get("account"), self.count) == self.index
+
+        partition_key = record.get("PartitionKey")
+        if partition_key is None:
+            # Older records without a PartitionKey, see create_from_record
+            partition_key = str(record.get("blob")).replace("/", "_")
+        value = "{}|{}".format(partition_key, record.get("RowKey"))
+        return Shard.get_shard(value, self.count) == self.index
+
+    def get_path(self, path: str) -> str:
+        """
+        Path of a local file (checkpoint, snapshot, metrics) for this shard,
+        the shard index goes before the extension, i.e. run.shard2.json
+        """
+        root, extension = os.path.splitext(path)
+        return "{}.shard{}{}".format(root, self.index, extension)
+
+    def __str__(self):
+        return "{} of {} by {}".format(self.index, self.count, self.by)
+
+
+class ShardReport:
+    """
+    Validation summaries of one shard written to a json file, and the merge
+    of the files of every shard into a single set of summaries.
+    """
+    @staticmethod
+    def write(path: str, shard: Shard, summaries: typing.List[IndustrySummary]):
+        with open(path, "w") as report_file:
+            json.dump({
+                "shard" : shard.index,
+                "shards" : shard.count,
+                "by" : shard.by,
+                "industries" : [summary.to_dict() for summary in summaries]
+            }, report_file, indent=4)
+
+    @staticmethod
+    def merge(paths: typing.List[str]) -> typing.List[IndustrySummary]:
+        """
+        Combine the summaries of each industry across the shard reports. A
+        WARNING is printed if reports are missing, or repeated, for the
+        number of shards the reports were written with.
+        """
+        merged: typing.Dict[str, IndustrySummary] = {}
+        shard_indexes = []
+        shard_counts = set()
+
+        for path in paths:
+            with open(path, "r") as report_file:
+                report = json.load(report_file)
+
+            shard_indexes.append(report["shard"])
+            shard_counts.add(report["shards"])
+
+            for values in report["industries"]:
+                summary = merged.get(values["industry"])
+                if summary is None:
+                    summary = merged[values["industry"]] = IndustrySummary(values["industry"])
+                    summary.started = values["started"]
+                    summary.finished = values["finished"]
+
+                ShardReport._add(summary, values)
+
+        if len(shard_counts) > 1:
+            print("WARNING - Shard reports were written for different numbers of shards:", sorted(shard_counts))
+        elif shard_counts:
+            expected = list(range(shard_counts.pop()))
+            if sorted(shard_indexes) != expected:
+                print("WARNING - Expected one report for each of shards {}, found {}".format(expected, sorted(shard_indexes)))
+
+        return list(merged.values())
+
+    @staticmethod
+    def _add(summary: IndustrySummary, values: dict):
+        summary.records += values["records"]
+        summary.validated += values["validated"]
+        summary.skipped += values["skipped"]
+        summary.failed_blobs.extend(values["failed_blobs"])
+
+        # Shards run side by side, the merged run spans all of them
+        summary.started = min(summary.started, values["started"])
+        if values["finished"] and summary.finished:
+            summary.finished = max(summary.finished, values["finished"])
+        else:
+            summary.finished = None
+
+        if values.get("error"):
+            summary.error = values["error"] if not summary.error else "{}; {}".format(summary.error, values["error"])
+
+
+class ShardProcesses:
+    """
+    Runs every shard of a command at once, each as its own process with its
+    own login, clients and connections, so record handling is spread over
+    the machine's cores rather than one interpreter. Running the same
+    command with -shard-index on separate machines splits the work the same
+    way.
+    """
+    @staticmethod
+    def run(arguments: typing.List[str], count: int, report_directory: str = None) -> typing.Tuple[typing.List[str], typing.List[int]]:
+        """
+        Run app.py with arguments once for each shard and wait for all of
+        them. A WARNING is printed for each shard that failed.
+
+        Returns (report files of the shards that finished, indexes of the shards that failed)
+
+        Parameters:
+        arguments - Command line of the run, without the shard index
+        count - Number of shards
+        report_directory - If given, each shard writes its -shard-report here
+        """
+        processes = []
+        for index in range(count):
+            shard_arguments = arguments + ["-shard-index", str(index)]
+
+            report = None
+            if report_directory:
+                report = os.path.join(report_directory, "shard{}.json".format(index))
+                shard_arguments += ["-shard-report", report]
+
+            processes.append((index, report, subprocess.Popen([sys.executable, sys.argv[0]] + shard_arguments)))
+
+        reports = []
+        failed = []
+        for index, report, process in processes:
+            return_code = process.wait()
+            if return_code != 0:
+                print("WARNING - Shard {} exited with {}".format(index, return_code))
+                failed.append(index)
+            elif report:
+                reports.append(report)
+
+        return reports, failed
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import heapq
+import queue
+import random
+import datetime
+import threading
+import typing
+from .storage.AzureTableValidationEntry import StorageBlobValidationEntry
+
+
+class IndustrySummary:
+    """
+    Result of the latest sweep of an industry.
+    """
+    def __init__(self, industry: str):
+        self.industry = industry
+        self.started = datetime.datetime.utcnow().isoformat()
+        self.finished = None
+        self.records = 0
+        self.validated = 0
+        self.skipped = 0
+        self.failed_blobs = []
+        self.error = None
+
+    def add(self, result) -> None:
+        """
+        Count a BlobValidationResult for the industry.
+        """
+        self.records += 1
+        if result.skipped:
+            self.skipped += 1
+        if result.validated:
+            self.validated += 1
+        else:
+            self.failed_blobs.append(result.validation_entry.blob)
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    def __str__(self):
+        if self.error:
+            return "{} - sweep failed: {}".format(self.industry, self.error)
+
+        return "{} - {} records, {} validated ({} unchanged), {} failed".format(
+            self.industry,
+            self.records,
+            self.validated,
+            self.skipped,
+            len(self.failed_blobs)
+        )
+
+
+class Watcher:
+    """
+    Keeps one Context alive and validates industries on a schedule, so the 
+    login, account keys, clients and (optionally) local snapshot are reused
+    across sweeps.
+
+    Each industry is validated every interval_seconds, +/- a random 
+    jitter_seconds (at most half the interval) so industries do not all run
+    at once. Due industries go on a bounded queue worked by workers threads,
+    when it is full scheduling waits, and an industry is never queued again
+    while it is still queued or being validated.
+    """
+    def __init__(self, context, industries: typing.List[str], interval_seconds: float, jitter_seconds: float = 0, workers: int = 1, incremental: bool = False, status_file: str = None):
+        self.context = context
+        self.industries = industries
+        self.interval_seconds = interval_seconds
+        # Larger jitter would let consecutive sweeps of an industry overlap
+        self.jitter_seconds = max(0, min(jitter_seconds, interval_seconds / 2))
+        self.workers = max(1, workers)
+        self.incremental = incremental
+        self.status_file = status_file
+
+        self.work_queue = queue.Queue(maxsize=self.workers * 2)
+        self.active = set()
+        self.latest_results: typing.Dict[str, IndustrySummary] = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self, max_sweeps: int = None):
+        """
+        Run until stop() is called, interrupted, or every industry has been
+        swept max_sweeps times.
+        """
+        threads = []
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        # First sweeps are spread over the jitter window
+        schedule = [(time.monotonic() + random.uniform(0, self.jitter_seconds), industry) for industry in self.industries]
+        heapq.heapify(schedule)
+        sweeps = {industry: 0 for industry in self.industries}
+
+        try:
+            while schedule and not self.stopped.is_set():
+                next_run, industry = schedule[0]
+                wait = next_run - time.monotonic()
+                if wait > 0:
+                    self.stopped.wait(min(wait, 1))
+                    continue
+
+                heapq.heappop(schedule)
+
+                with self.lock:
+                    queued = industry in self.active
+                    if not queued:
+                        self.active.add(industry)
+
+                if not queued:
+                    # Blocks while the workers are behind
+                    self.work_queue.put(industry)
+                    sweeps[industry] += 1
+
+                if max_sweeps is None or sweeps[industry] < max_sweeps:
+                    heapq.heappush(schedule, (self._next_run(), industry))
+
+            self.work_queue.join()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _next_run(self) -> float:
+        jitter = random.uniform(-self.jitter_seconds, self.jitter_seconds)
+        return time.monotonic() + max(0, self.interval_seconds + jitter)
+
+    def _work(self):
+        while True:
+            industry = self.work_queue.get()
+            try:
+                summary = self.sweep(industry)
+                print(str(summary))
+                for blob in summary.failed_blobs:
+                    print("    Validation failed:", blob)
+            finally:
+                with self.lock:
+                    self.active.discard(industry)
+                self.work_queue.task_done()
+
+    def sweep(self, industry: str) -> IndustrySummary:
+        """
+        Validate one industry and record the summary as its latest result.
+        """
+        summary = IndustrySummary(industry)
+
+        try:
+            results = self.context.iter_industry_validation_results(
+                industry,
+                StorageBlobValidationEntry.VALIDATION_COLUMNS,
+                self.incremental
+            )
+            for result in results:
+                summary.add(result)
+
+            if self.incremental:
+                self.context.flush_table_records()
+        except Exception as ex:
+            summary.error = str(ex).splitlines()[0] if str(ex) else type(ex).__name__
+
+        summary.finished = datetime.datetime.utcnow().isoformat()
+
+        with self.lock:
+            self.latest_results[industry] = summary
+            self._write_status()
+
+        return summary
+
+    def _write_status(self):
+        if not self.status_file:
+            return
+
+        status = {
+            "updated" : datetime.datetime.utcnow().isoformat(),
+            "industries" : {industry: self.latest_results[industry].to_dict() for industry in self.latest_results}
+        }
+
+        # Replace the file in one step so readers never see a partial file
+        temp_file = self.status_file + ".tmp"
+        with open(temp_file, "w") as output:
+            json.dump(status, output, indent=4)
+        os.replace(temp_file, self.status_file)
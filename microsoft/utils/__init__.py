@@ -1,9 +1,23 @@
 from .Config import Configuration
+from .metrics.RunMetrics import RunMetrics
 from .cli.AzLoginUtils import AzLoginUtils
 from .cli.CmdUtils import CmdUtils
 from .storage.AzCliStorage import AzCliStorageUtil
 from .storage.AzureTableStorage import AzureTableStoreUtil
 from .storage.AzureTableValidationEntry import StorageBlobValidationEntry
-from .storage.AzureBlobStorage import AzureBlobStorageUtils
+from .storage.AzureBlobStorage import AzureBlobStorageUtils, BlobState
+from .storage.StorageAccountCache import StorageAccountCache
+from .storage.BandwidthLimiter import BandwidthLimiter
+from .storage.StorageThrottle import StorageThrottle, AccountThrottle
+from .storage.KeyScheme import KeyScheme
+from .storage.TableWriteBuffer import TableWriteBuffer, TableWriteFailure
+from .storage.SnapshotCache import SnapshotCache
+from .storage.RunCheckpoint import RunCheckpoint
+from .identity.CredentialProvider import CredentialProvider, CliCredentialProvider, SdkCredentialProvider
 from .ProgramArgs import ProgramArguments
-from .Context import Context
\ No newline at end of file
+from .HashFetcher import HashFetcher
+from .IngestPlan import IngestPlan, IngestItem
+from .HashManifest import HashManifest, ManifestRecord, ManifestDiff
+from .Context import Context
+from .Watcher import Watcher, IndustrySummary
+from .Sharding import Shard, ShardReport, ShardProcesses
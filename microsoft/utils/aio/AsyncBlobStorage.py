@@ -0,0 +1,80 @@
+import typing
+import aiohttp
+from ..storage.AzureBlobStorage import AzureBlobStorageUtils, BlobState
+from ..metrics.RunMetrics import RunMetrics
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
+
+
+class AsyncAzureBlobStorageUtils:
+    """
+    AzureBlobStorageUtils for coroutines, reading blob states through the
+    azure.storage.blob.aio clients. Requests go out on an aiohttp session
+    shared with the other clients of the run, which is not closed with
+    this instance.
+    """
+    def __init__(self, account: str, key: str, session: aiohttp.ClientSession):
+        self.account_name = account
+        self.connection_string = AzureBlobStorageUtils.CONN_STR.format(account, key)
+        self.session = session
+        self.blob_service_client = None
+        self.container_clients = {}
+
+    def get_container_client(self, container: str) -> ContainerClient:
+        if self.blob_service_client is None:
+            self.blob_service_client = BlobServiceClient.from_connection_string(
+                self.connection_string,
+                transport=AioHttpTransport(session=self.session, session_owner=False),
+                **RunMetrics.get().get_client_hooks()
+            )
+
+        if container not in self.container_clients:
+            self.container_clients[container] = self.blob_service_client.get_container_client(container)
+
+        return self.container_clients[container]
+
+    async def close(self):
+        if self.blob_service_client is not None:
+            await self.blob_service_client.close()
+
+        self.blob_service_client = None
+        self.container_clients = {}
+
+    async def get_blob_state(self, blob: str, container: str = None) -> BlobState:
+        """
+        Get the hash, ETag and last modified time of a blob. If container is
+        none then parse the blob to get the container from it (first part)
+        """
+        container, blob = AzureBlobStorageUtils._parse_blob_parts(blob, container)
+
+        blob_client = self.get_container_client(container).get_blob_client(blob)
+        with RunMetrics.get().measure("blob.properties", self.account_name):
+            blob_props = await blob_client.get_blob_properties()
+
+        return BlobState.from_properties(blob_props)
+
+    async def get_container_states(self, container: str, blobs: typing.Iterable[str], name_prefix: str = None) -> typing.Dict[str, BlobState]:
+        """
+        Get the states of a set of blobs in a container from the container
+        listing, see AzureBlobStorageUtils.get_container_states.
+        """
+        wanted = set(blobs)
+        blob_states = {}
+        if not wanted:
+            return blob_states
+
+        # Listings are in name order, stop once past the last wanted blob
+        last_wanted = max(wanted)
+
+        container_client = self.get_container_client(container)
+        with RunMetrics.get().measure("blob.list", self.account_name):
+            async for blob_props in container_client.list_blobs(name_starts_with=name_prefix or None):
+                if blob_props.name in wanted:
+                    blob_states[blob_props.name] = BlobState.from_properties(blob_props)
+                    if len(blob_states) == len(wanted):
+                        break
+
+                if blob_props.name > last_wanted:
+                    break
+
+        return blob_states
@@ -0,0 +1,341 @@
+import asyncio
+import datetime
+import os
+import typing
+from collections import deque
+import aiohttp
+from .AsyncThrottle import AsyncThrottle
+from .AsyncBlobStorage import AsyncAzureBlobStorageUtils
+from .AsyncTableStorage import AsyncAzureTableStoreUtil
+from .AsyncTableWriteBuffer import AsyncTableWriteBuffer
+from ..Config import Configuration
+from ..Context import Context, BlobValidationResult
+from ..identity.CredentialProvider import CliCredentialProvider
+from ..storage.AzCliStorage import AzStorageAccount
+from ..storage.AzureBlobStorage import AzureBlobStorageUtils, BlobState
+from ..storage.AzureTableStorage import AzureTableStoreUtil
+from ..storage.AzureTableValidationEntry import StorageBlobValidationEntry
+from ..storage.KeyScheme import KeyScheme
+from ..storage.StorageThrottle import StorageThrottle
+from azure.core.exceptions import ClientAuthenticationError, ResourceNotFoundError
+
+
+class AsyncContext:
+    """
+    Context for validate and rebase on an asyncio event loop. Table pages,
+    blob requests to any number of accounts and table transactions are all
+    in flight at once on a single thread, sharing one aiohttp session.
+
+    Up to concurrency blob states are requested at once (at most
+    performance.accountConcurrency against one account), results are still
+    yielded in table order. Local snapshots, checkpoints and content
+    verification are only available with Context.
+
+    Use as an async context manager:
+        async with AsyncContext(configuration) as context:
+            async for result in context.iter_industries_validation_results(industries):
+                ...
+    """
+    DEFAULT_CONCURRENCY = 256
+
+    # Record handling is the same as Context, these only use the
+    # configuration, key scheme and write buffer.
+    get_performance_setting = Context.get_performance_setting
+    set_entry_state = Context.set_entry_state
+    get_history_entry = Context.get_history_entry
+    record_validation = Context.record_validation
+    add_table_record = Context.add_table_record
+    complete = Context.complete
+    _limit_history = Context._limit_history
+    _get_audit_partition = staticmethod(Context._get_audit_partition)
+
+    def __init__(self, config: Configuration, concurrency: int = None, list_hashes: bool = False, credential_provider = None):
+        """
+        Parameters:
+        config - Application configuration
+        concurrency - Blob states requested at once, defaults to performance.asyncConcurrency
+        list_hashes - Get hashes from container listings
+        credential_provider - Resolves storage account keys, defaults to the az cli
+        """
+        self.configuration = config
+        self.credential_provider = credential_provider or CliCredentialProvider()
+        self.list_hashes = list_hashes
+        self.concurrency = max(1, concurrency or self.get_performance_setting("asyncConcurrency", AsyncContext.DEFAULT_CONCURRENCY))
+
+        self.throttle = AsyncThrottle(
+            self.get_performance_setting("accountConcurrency", None) or self.concurrency,
+            self.get_performance_setting("retryAttempts", StorageThrottle.DEFAULT_ATTEMPTS),
+            self.get_performance_setting("retryBaseSeconds", StorageThrottle.DEFAULT_BASE_SECONDS),
+            self.get_performance_setting("retryMaxSeconds", StorageThrottle.DEFAULT_MAX_SECONDS)
+        )
+
+        self.key_scheme = KeyScheme(
+            self.configuration.historyStorage.get("keyScheme", KeyScheme.BLOB)
+        )
+
+        # Context features not available here
+        self.snapshot = None
+        self.checkpoint = None
+
+        # Optional Sharding.Shard, see Context
+        self.shard = None
+
+        # Created on the event loop by open()
+        self.session = None
+        self.validation_table_store = None
+        self.write_buffer = None
+        self.storage_accounts: typing.Dict[typing.Tuple[str, str], asyncio.Future] = {}
+        self.blob_utils: typing.Dict[typing.Tuple[str, str], AsyncAzureBlobStorageUtils] = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        """
+        Create the aiohttp session and the table store for historyStorage.
+        """
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency)
+        )
+
+        validation_storage_account = await self.get_storage_account(
+            self.configuration.historyStorage["account"],
+            self.configuration.historyStorage["subscription"]
+        )
+
+        self.validation_table_store = AsyncAzureTableStoreUtil(
+            validation_storage_account.name,
+            validation_storage_account.keys[0],
+            self.session,
+            self.throttle
+        )
+
+        self.write_buffer = AsyncTableWriteBuffer(
+            self.validation_table_store,
+            self.get_performance_setting("writeBatchSize", AzureTableStoreUtil.MAX_BATCH_SIZE),
+            self.get_performance_setting("writeFlushSeconds", 30)
+        )
+
+    async def close(self):
+        """
+        Write any queued records and close every client and the session.
+        """
+        if self.write_buffer is not None:
+            await self.flush_table_records()
+
+        for blob_utils in self.blob_utils.values():
+            await blob_utils.close()
+        self.blob_utils = {}
+
+        if self.validation_table_store is not None:
+            await self.validation_table_store.close()
+
+        if self.session is not None:
+            await self.session.close()
+        self.session = None
+
+    async def get_storage_account(self, account: str, subscription: str, refresh: bool = False) -> AzStorageAccount:
+        """
+        Resolve an account's keys once, the credential provider is called on
+        the default executor so the loop is not blocked. A lookup that fails
+        is not cached, the next blob of the account tries again.
+        """
+        cache_key = (account, subscription)
+        if refresh or cache_key not in self.storage_accounts:
+            self.storage_accounts[cache_key] = asyncio.get_running_loop().run_in_executor(
+                None,
+                self.credential_provider.get_storage_account,
+                account,
+                subscription
+            )
+
+        lookup = self.storage_accounts[cache_key]
+        try:
+            return await lookup
+        except Exception:
+            # Only drop the failed lookup, a refresh may already have replaced it
+            if self.storage_accounts.get(cache_key) is lookup:
+                del self.storage_accounts[cache_key]
+            raise
+
+    async def _get_blob_utils(self, account: str, subscription: str, refresh: bool = False) -> AsyncAzureBlobStorageUtils:
+        cache_key = (account, subscription)
+        if refresh and cache_key in self.blob_utils:
+            await self.blob_utils.pop(cache_key).close()
+
+        storage_account = await self.get_storage_account(account, subscription, refresh)
+        if cache_key not in self.blob_utils:
+            self.blob_utils[cache_key] = AsyncAzureBlobStorageUtils(
+                storage_account.name,
+                storage_account.keys[0],
+                self.session
+            )
+        return self.blob_utils[cache_key]
+
+    async def _call_blob_storage(self, account: str, subscription: str, call: typing.Callable):
+        """
+        Await call(blob utils) for the account through the throttle, keys are
+        resolved again once if authentication fails.
+        """
+        throttle_key = "{}.blob".format(account)
+        blob_utils = await self._get_blob_utils(account, subscription)
+        try:
+            return await self.throttle.call(throttle_key, lambda: call(blob_utils))
+        except ClientAuthenticationError:
+            blob_utils = await self._get_blob_utils(account, subscription, True)
+            return await self.throttle.call(throttle_key, lambda: call(blob_utils))
+
+    async def get_blob_state(self, account: str, subscription: str, blob: str) -> BlobState:
+        """
+        Get the state of a blob, None if it does not exist or the service
+        could not be reached after retrying.
+        """
+        try:
+            return await self._call_blob_storage(
+                account,
+                subscription,
+                lambda blob_utils: blob_utils.get_blob_state(blob)
+            )
+        except ResourceNotFoundError:
+            print("WARNING - Blob not found:", blob)
+        except Exception as ex:
+            if not StorageThrottle.is_retryable(ex):
+                raise
+            print("WARNING - Unable to get the state of", blob, "-", str(ex).splitlines()[0] if str(ex) else type(ex).__name__)
+
+        return None
+
+    async def get_blob_states(self, blobs: typing.Iterable[typing.Tuple[str, str, str]]) -> typing.Dict[typing.Tuple[str, str, str], BlobState]:
+        """
+        Get the states of many blobs by listing each container they are in
+        once, all containers are listed at once. Blobs not found in a listing
+        are requested individually.
+
+        Returns a dictionary of (account, subscription, blob) to BlobState.
+        """
+        # (account, subscription, container) -> { name in container : blob }
+        containers = {}
+        for account, subscription, blob in blobs:
+            container, blob_name = AzureBlobStorageUtils._parse_blob_parts(blob)
+            containers.setdefault((account, subscription, container), {})[blob_name] = blob
+
+        async def get_container_states(container_key, blob_names):
+            account, subscription, container_name = container_key
+            prefix = os.path.commonprefix(list(blob_names.keys()))
+            container_states = await self._call_blob_storage(
+                account,
+                subscription,
+                lambda blob_utils: blob_utils.get_container_states(container_name, blob_names.keys(), prefix)
+            )
+
+            missing = [blob_name for blob_name in blob_names if blob_name not in container_states]
+            missing_states = await asyncio.gather(
+                *[self.get_blob_state(account, subscription, blob_names[x]) for x in missing]
+            )
+            container_states.update(zip(missing, missing_states))
+
+            return {(account, subscription, blob_names[x]): container_states[x] for x in blob_names}
+
+        return_value = {}
+        for container_states in await asyncio.gather(*[get_container_states(*x) for x in containers.items()]):
+            return_value.update(container_states)
+        return return_value
+
+    async def iter_industries_table_store(self, industries: typing.List[str], select: typing.List[str] = None) -> typing.AsyncIterator[StorageBlobValidationEntry]:
+        """
+        Yields the records for several industries from a single query, see
+        Context.iter_industries_table_store.
+        """
+        table = self.configuration.historyStorage["table"]
+        wanted = set(industries)
+
+        include = self.shard.owns if self.shard is not None else None
+
+        async for entry in self.validation_table_store.iter_records(table, self.key_scheme.industries_filter(industries), select, include):
+            if entry.industry in wanted:
+                yield entry
+
+    async def iter_industries_validation_results(self, industries: typing.List[str], select: typing.List[str] = None, incremental: bool = False, full_sweep: bool = False) -> typing.AsyncIterator[BlobValidationResult]:
+        """
+        Streams the validation of several industries, see Context.iter_industries_validation_results.
+        """
+        async for validation_result in self.iter_validation_results(
+                self.iter_industries_table_store(industries, select),
+                incremental,
+                full_sweep):
+            yield validation_result
+
+    async def iter_validation_results(self, entries: typing.AsyncIterator[StorageBlobValidationEntry], incremental: bool = False, full_sweep: bool = False) -> typing.AsyncIterator[BlobValidationResult]:
+        """
+        Requests the state of each entry's blob, up to concurrency at once
+        while the table is still being read, and yields results in the same
+        order as entries. See Context.iter_validation_results for incremental
+        and full_sweep.
+        """
+        full_sweep_before = None
+        if incremental and not full_sweep:
+            full_sweep_before = datetime.datetime.utcnow() - datetime.timedelta(
+                days=self.get_performance_setting("fullSweepDays", Context.DEFAULT_FULL_SWEEP_DAYS)
+            )
+
+        if self.list_hashes:
+            listed_entries = [entry async for entry in entries]
+            blob_states = await self.get_blob_states([(x.account, x.subscription, x.blob) for x in listed_entries])
+            for entry in listed_entries:
+                yield self._get_validation_result(
+                    entry,
+                    blob_states[(entry.account, entry.subscription, entry.blob)],
+                    incremental,
+                    full_sweep_before
+                )
+            return
+
+        pending = deque()
+        try:
+            async for entry in entries:
+                pending.append((entry, asyncio.ensure_future(self.get_blob_state(entry.account, entry.subscription, entry.blob))))
+
+                if len(pending) >= self.concurrency:
+                    entry, fetch = pending.popleft()
+                    yield self._get_validation_result(entry, await fetch, incremental, full_sweep_before)
+
+            while pending:
+                entry, fetch = pending.popleft()
+                yield self._get_validation_result(entry, await fetch, incremental, full_sweep_before)
+        finally:
+            # The consumer stopped early or a fetch failed, don't leave
+            # requests running (or their errors unretrieved)
+            fetches = [fetch for entry, fetch in pending]
+            for fetch in fetches:
+                fetch.cancel()
+            await asyncio.gather(*fetches, return_exceptions=True)
+
+    def _get_validation_result(self, entry: StorageBlobValidationEntry, current_state: BlobState, incremental: bool, full_sweep_before: datetime.datetime) -> BlobValidationResult:
+        validation_result = BlobValidationResult(entry)
+        validation_result.current_state = current_state
+        validation_result.current_hash = current_state.md5 if current_state else None
+
+        if full_sweep_before and Context._is_unchanged(entry, current_state, full_sweep_before):
+            validation_result.skipped = True
+            validation_result.validated = True
+        else:
+            validation_result.validated = entry.matches_state(current_state)
+
+        if incremental and validation_result.validated:
+            self.record_validation(validation_result)
+
+        return validation_result
+
+    async def flush_table_records(self):
+        """
+        Write any queued table records, prints and returns the records that
+        could not be written.
+        """
+        failures = await self.write_buffer.flush()
+        for failure in failures:
+            print("Failed to write record", str(failure))
+        return failures
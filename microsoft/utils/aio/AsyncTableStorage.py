@@ -0,0 +1,170 @@
+import time
+import typing
+import aiohttp
+from .AsyncThrottle import AsyncThrottle
+from ..storage.AzureTableStorage import AzureTableStoreUtil
+from ..storage.AzureTableValidationEntry import StorageBlobValidationEntry
+from ..metrics.RunMetrics import RunMetrics
+from azure.data.tables import UpdateMode
+from azure.data.tables.aio import TableServiceClient, TableClient
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
+
+
+class AsyncAzureTableStoreUtil:
+    """
+    AzureTableStoreUtil for coroutines, using the azure.data.tables.aio
+    clients on an aiohttp session shared with the other clients of the run.
+    Pages, lookups and transactions go through an AsyncThrottle.
+    """
+    def __init__(self, account_name: str, account_key: str, session: aiohttp.ClientSession, throttle: AsyncThrottle = None):
+        """
+        Parameters:
+        account_name - Storage account with the tables
+        account_key - Key for the account
+        session - aiohttp session the requests are made on, not closed by close()
+        throttle - Retries and limits calls to the account
+        """
+        self.account_name = account_name
+        self.throttle = throttle or AsyncThrottle()
+        self.throttle_key = "{}.table".format(account_name)
+        self.connection_string = AzureTableStoreUtil.CONN_STR.format(account_name, account_key)
+        self.session = session
+        self.table_service = None
+        self.table_clients = {}
+        self.known_tables = set()
+
+    async def iter_records(self, table_name: str, query_filter: str = None, select: typing.List[str] = None, include: typing.Callable[[dict], bool] = None) -> typing.AsyncIterator[StorageBlobValidationEntry]:
+        """
+        Yields the records matching an OData filter as the service returns
+        them, the next page is only requested once the records are used.
+
+        Parameters:
+        table_name - Name of table to search
+        query_filter - OData filter, None returns every record in the table
+        select - Optional list of columns to return, None returns all columns.
+        include - Optional check of each entity, see AzureTableStoreUtil.iter_records
+        """
+        table_client = self._get_table_client(table_name)
+
+        if query_filter:
+            results = table_client.query_entities(query_filter, select=select)
+        else:
+            results = table_client.list_entities(select=select)
+
+        pages = results.by_page()
+
+        async def next_page():
+            try:
+                return await pages.__anext__()
+            except StopAsyncIteration:
+                return None
+
+        metrics = RunMetrics.get()
+        try:
+            while True:
+                start = time.perf_counter()
+                # A failed page is requested again with the same continuation
+                page = await self.throttle.call(self.throttle_key, next_page)
+                if page is None:
+                    break
+
+                metrics.record("table.query", self.account_name, start, time.perf_counter())
+                async for result in page:
+                    if include is not None and not include(result):
+                        continue
+                    yield StorageBlobValidationEntry.create_from_record(table_name, result)
+        except ResourceNotFoundError as ex:
+            if not AzureTableStoreUtil._is_table_not_found(ex):
+                raise
+            self.known_tables.discard(table_name)
+            print("WARNING - Table {} not found".format(table_name))
+
+    async def get_record(self, table_name: str, partition_key: str, row_key: str) -> StorageBlobValidationEntry:
+        """
+        Point lookup of a single record, None if it does not exist.
+        """
+        table_client = self._get_table_client(table_name)
+
+        async def get_entity():
+            with RunMetrics.get().measure("table.get", self.account_name):
+                return await table_client.get_entity(partition_key=partition_key, row_key=row_key)
+
+        try:
+            result = await self.throttle.call(self.throttle_key, get_entity)
+        except ResourceNotFoundError:
+            return None
+
+        return StorageBlobValidationEntry.create_from_record(table_name, result)
+
+    async def upsert_batch(self, table_name: str, entities: typing.List[dict], mode: UpdateMode = UpdateMode.MERGE) -> None:
+        """
+        Insert or update entities that all share a PartitionKey, in
+        transactions of up to MAX_BATCH_SIZE entities.
+        """
+        await self._submit_batches(
+            table_name,
+            [("upsert", entity, {"mode" : mode}) for entity in entities]
+        )
+
+    async def delete_batch(self, table_name: str, records: typing.List[typing.Tuple[str, str]]) -> None:
+        """
+        Delete records, (RowKey, PartitionKey), that all share a PartitionKey.
+        """
+        await self._submit_batches(
+            table_name,
+            [("delete", {"PartitionKey" : pair[1], "RowKey" : pair[0]}) for pair in records]
+        )
+
+    async def _submit_batches(self, table_name: str, operations: typing.List[tuple]) -> None:
+        for idx in range(0, len(operations), AzureTableStoreUtil.MAX_BATCH_SIZE):
+            batch = operations[idx:idx + AzureTableStoreUtil.MAX_BATCH_SIZE]
+            await self._write_table(table_name, batch)
+
+    async def _write_table(self, table_name: str, batch: typing.List[tuple]):
+        """
+        Submit a transaction, creating the table the first time it is written.
+        """
+        async def attempt_write():
+            table_client = await self._create_table(table_name)
+            with RunMetrics.get().measure("table.write", self.account_name):
+                return await table_client.submit_transaction(batch)
+
+        try:
+            return await self.throttle.call(self.throttle_key, attempt_write)
+        except Exception as ex:
+            if not AzureTableStoreUtil._is_table_not_found(ex):
+                raise
+            self.known_tables.discard(table_name)
+            return await self.throttle.call(self.throttle_key, attempt_write)
+
+    async def _create_table(self, table_name: str) -> TableClient:
+        if table_name not in self.known_tables:
+            try:
+                await self._get_table_service().create_table(table_name)
+            except ResourceExistsError:
+                pass
+            self.known_tables.add(table_name)
+
+        return self._get_table_client(table_name)
+
+    def _get_table_client(self, table_name: str) -> TableClient:
+        if table_name not in self.table_clients:
+            self.table_clients[table_name] = self._get_table_service().get_table_client(table_name)
+        return self.table_clients[table_name]
+
+    def _get_table_service(self) -> TableServiceClient:
+        if self.table_service is None:
+            self.table_service = TableServiceClient.from_connection_string(
+                conn_str=self.connection_string,
+                transport=AioHttpTransport(session=self.session, session_owner=False),
+                **RunMetrics.get().get_client_hooks()
+            )
+        return self.table_service
+
+    async def close(self) -> None:
+        if self.table_service is not None:
+            await self.table_service.close()
+        self.table_service = None
+        self.table_clients = {}
+        self.known_tables = set()
@@ -0,0 +1,144 @@
+import time
+import asyncio
+import typing
+from azure.data.tables import TableTransactionError
+from .AsyncTableStorage import AsyncAzureTableStoreUtil
+from ..storage.AzureTableStorage import AzureTableStoreUtil
+from ..storage.TableWriteBuffer import TableWriteBuffer, TableWriteFailure
+
+
+class AsyncTableWriteBuffer:
+    """
+    TableWriteBuffer for coroutines. Upserts are collected per (table,
+    PartitionKey) and a partition's transaction is started as a task as
+    soon as it is full, so writes overlap with reading the table and
+    fetching hashes. Every partition is started once flush_seconds have
+    passed since the last full flush. flush() writes everything left and
+    waits for the transactions still in flight.
+
+    An upsert can name the keys of a row it replaces, that row is deleted
+    once the upsert has been written.
+    """
+    def __init__(self, table_store: AsyncAzureTableStoreUtil, max_batch_size: int = AzureTableStoreUtil.MAX_BATCH_SIZE, flush_seconds: float = 30):
+        self.table_store = table_store
+        self.max_batch_size = max(1, min(max_batch_size, AzureTableStoreUtil.MAX_BATCH_SIZE))
+        self.flush_seconds = flush_seconds
+        # (table, PartitionKey) -> {RowKey : (entity, [replaced (PartitionKey, RowKey)])}
+        self.pending_upserts: typing.Dict[typing.Tuple[str, str], typing.Dict[str, tuple]] = {}
+        # (table, PartitionKey) -> [(RowKey, PartitionKey)]
+        self.pending_deletes: typing.Dict[typing.Tuple[str, str], list] = {}
+        self.tasks = set()
+        self.failures: typing.List[TableWriteFailure] = []
+        self.written = 0
+        self.requests = 0
+        self.last_flush = time.monotonic()
+
+    def upsert(self, table_name: str, entity: dict, replaces: typing.Tuple[str, str] = None) -> None:
+        """
+        Queue an insert or merge of an entity, called on the event loop.
+
+        Parameters:
+        table_name - Table to write to
+        entity - Entity to write
+        replaces - Optional (PartitionKey, RowKey) of a row to delete once the entity is written
+        """
+        partition = (table_name, entity["PartitionKey"])
+        pending = self.pending_upserts.setdefault(partition, {})
+
+        # A transaction may only touch an entity once, last write wins
+        replaced = pending[entity["RowKey"]][1] if entity["RowKey"] in pending else []
+        if replaces and replaces != (entity["PartitionKey"], entity["RowKey"]):
+            replaced = replaced + [replaces]
+        pending[entity["RowKey"]] = (entity, replaced)
+
+        if len(pending) >= self.max_batch_size:
+            self._start(self._flush_upserts(partition, self.pending_upserts.pop(partition)))
+
+        if self.flush_seconds is not None and (time.monotonic() - self.last_flush) >= self.flush_seconds:
+            # Failures are kept for the caller's next flush()
+            self._start_all()
+
+    def pending_count(self) -> int:
+        return sum([len(x) for x in self.pending_upserts.values()]) + \
+            sum([len(x) for x in self.pending_deletes.values()])
+
+    async def flush(self) -> typing.List[TableWriteFailure]:
+        """
+        Write everything that is pending and wait for the writes in flight,
+        returns the failures since the last time flush was called.
+        """
+        while self.pending_upserts or self.pending_deletes or self.tasks:
+            self._start_all()
+            # Written upserts can queue the deletes of the rows they replace
+            await asyncio.gather(*list(self.tasks))
+
+        failures = self.failures
+        self.failures = []
+        return failures
+
+    def _start_all(self):
+        for partition in list(self.pending_upserts.keys()):
+            self._start(self._flush_upserts(partition, self.pending_upserts.pop(partition)))
+
+        for partition in list(self.pending_deletes.keys()):
+            self._start(self._flush_deletes(partition, self.pending_deletes.pop(partition)))
+
+        self.last_flush = time.monotonic()
+
+    def _start(self, write: typing.Awaitable):
+        task = asyncio.ensure_future(write)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _flush_upserts(self, partition: typing.Tuple[str, str], upserts: typing.Dict[str, tuple]):
+        """
+        Write a partition's upserts. If the transaction fails because of a
+        single entity, that entity is recorded as a failure and the rest are
+        sent again. If it fails as a whole every entity is a failure.
+        """
+        pending = list(upserts.values())
+
+        while pending:
+            try:
+                self.requests += 1
+                await self.table_store.upsert_batch(partition[0], [x[0] for x in pending])
+                self.written += len(pending)
+            except TableTransactionError as ex:
+                failed_index = TableWriteBuffer.get_failed_index(ex, len(pending))
+                if failed_index is not None:
+                    self.failures.append(TableWriteFailure(partition[0], pending[failed_index][0], ex))
+                    del pending[failed_index]
+                    continue
+
+                for entity, replaced in pending:
+                    self.failures.append(TableWriteFailure(partition[0], entity, ex))
+                break
+            except Exception as ex:
+                for entity, replaced in pending:
+                    self.failures.append(TableWriteFailure(partition[0], entity, ex))
+                break
+
+            for entity, replaced in pending:
+                for keys in replaced:
+                    self._queue_delete(partition[0], keys)
+            break
+
+    def _queue_delete(self, table_name: str, keys: typing.Tuple[str, str]):
+        partition = (table_name, keys[0])
+        self.pending_deletes.setdefault(partition, []).append((keys[1], keys[0]))
+
+        if len(self.pending_deletes[partition]) >= self.max_batch_size:
+            self._start(self._flush_deletes(partition, self.pending_deletes.pop(partition)))
+
+    async def _flush_deletes(self, partition: typing.Tuple[str, str], records: list):
+        if not records:
+            return
+
+        try:
+            self.requests += 1
+            await self.table_store.delete_batch(partition[0], records)
+        except Exception as ex:
+            for record in records:
+                self.failures.append(
+                    TableWriteFailure(partition[0], {"PartitionKey": record[1], "RowKey": record[0]}, ex)
+                )
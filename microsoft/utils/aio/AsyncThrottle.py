@@ -0,0 +1,90 @@
+import time
+import asyncio
+import typing
+from ..storage.StorageThrottle import StorageThrottle
+
+
+class AsyncAccountThrottle:
+    """
+    AccountThrottle for coroutines, the same additive increase and
+    multiplicative decrease of the calls made against one account at once.
+    """
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.active = 0
+        self.last_decrease = 0
+        # Created on the running loop
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> float:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        return time.monotonic()
+
+    async def release(self, started: float, throttled: bool = False) -> None:
+        async with self.condition:
+            self.active -= 1
+
+            if throttled:
+                if started >= self.last_decrease:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = time.monotonic()
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+
+class AsyncThrottle:
+    """
+    StorageThrottle for coroutines. Calls are retried with the same backoff
+    and errors, and limited per account by an AsyncAccountThrottle, waiting
+    with asyncio.sleep so other calls carry on in the meantime.
+
+    The optional requests per second limit of StorageThrottle is not used.
+    """
+    def __init__(self, max_concurrency: int = StorageThrottle.DEFAULT_MAX_CONCURRENCY, attempts: int = StorageThrottle.DEFAULT_ATTEMPTS, base_seconds: float = StorageThrottle.DEFAULT_BASE_SECONDS, max_seconds: float = StorageThrottle.DEFAULT_MAX_SECONDS):
+        """
+        Parameters:
+        max_concurrency - Most calls made against one account at once
+        attempts - Times a call is made before its error is raised
+        base_seconds - Backoff before the first retry, doubled for each retry
+        max_seconds - Longest backoff
+        """
+        self.backoff = StorageThrottle(max_concurrency, attempts, base_seconds, max_seconds)
+        self.accounts: typing.Dict[str, AsyncAccountThrottle] = {}
+
+    def get_account(self, account: str) -> AsyncAccountThrottle:
+        # Only called on the loop, no lock needed
+        if account not in self.accounts:
+            self.accounts[account] = AsyncAccountThrottle(self.backoff.max_concurrency)
+        return self.accounts[account]
+
+    async def call(self, account: str, call: typing.Callable[[], typing.Awaitable]):
+        """
+        Await a call against an account, retrying it if it fails with an
+        error the service says can be retried.
+
+        Parameters:
+        account - Account (or account and service) the call is made against
+        call - Callable with no arguments returning the awaitable to retry
+        """
+        account_throttle = self.get_account(account)
+        attempt = 1
+
+        while True:
+            started = await account_throttle.acquire()
+            throttled = False
+            try:
+                return await call()
+            except Exception as ex:
+                throttled = StorageThrottle.is_throttled(ex)
+                if attempt >= self.backoff.attempts or not StorageThrottle.is_retryable(ex):
+                    raise
+            finally:
+                await account_throttle.release(started, throttled)
+
+            await asyncio.sleep(self.backoff.get_backoff(attempt))
+            attempt += 1
@@ -0,0 +1,460 @@
+import re
+import time
+import hashlib
+import datetime
+import threading
+import typing
+from collections import Counter
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+from azure.data.tables import TableEntity, UpdateMode
+from azure.data.tables._deserialize import TablesEntityDatetime
+from ..storage.AzCliStorage import AzStorageAccount
+from ..storage.AzureBlobStorage import AzureBlobStorageUtils
+from ..storage.AzureTableStorage import AzureTableStoreUtil
+from ..storage.AzureTableValidationEntry import StorageBlobValidationEntry
+
+
+class RequestCounter:
+    """
+    Counts the requests made against the fake services, and optionally adds
+    a fixed delay to each to stand in for the service round trip.
+    """
+    def __init__(self, latency_seconds: float = 0):
+        self.latency_seconds = latency_seconds
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def request(self, operation: str):
+        with self.lock:
+            self.counts[operation] += 1
+
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def total(self) -> int:
+        with self.lock:
+            return sum(self.counts.values())
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+
+class FakeCredentialProvider:
+    """
+    Credential provider that resolves every account to a dummy key.
+    """
+    name = "fake"
+
+    def __init__(self, counter: RequestCounter):
+        self.counter = counter
+
+    def validate_login(self) -> str:
+        return "benchmark"
+
+    def get_storage_account(self, storage_account: str, subscription: str) -> AzStorageAccount:
+        self.counter.request("account.keys")
+        return AzStorageAccount(storage_account, ["fake-key"], subscription)
+
+
+class FakeBlob:
+    def __init__(self, content: bytes):
+        self.set_content(content)
+
+    def set_content(self, content: bytes):
+        self.content = content
+        self.content_md5 = bytearray(hashlib.md5(content).digest())
+        self.etag = "0x{}".format(hashlib.sha1(content).hexdigest()[:16].upper())
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakeBlobProperties:
+    """
+    The parts of azure.storage.blob.BlobProperties that are used.
+    """
+    class ContentSettings:
+        def __init__(self, content_md5: bytearray):
+            self.content_md5 = content_md5
+
+    def __init__(self, name: str, blob: FakeBlob, quoted_etag: bool):
+        self.name = name
+        self.etag = '"{}"'.format(blob.etag) if quoted_etag else blob.etag
+        self.last_modified = blob.last_modified
+        self.size = len(blob.content)
+        self.content_settings = FakeBlobProperties.ContentSettings(blob.content_md5)
+
+
+class FakeBlobDownloader:
+    def __init__(self, data: bytes, chunk_size: int = 4 * 1024 * 1024):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def readall(self) -> bytes:
+        return self.data
+
+    def chunks(self) -> typing.Iterator[bytes]:
+        for offset in range(0, len(self.data), self.chunk_size):
+            yield self.data[offset:offset + self.chunk_size]
+
+
+class FakeBlobClient:
+    def __init__(self, container_client, name: str):
+        self.container_client = container_client
+        self.name = name
+
+    def _get_blob(self) -> FakeBlob:
+        blob = self.container_client.blobs.get(self.name)
+        if blob is None:
+            raise ResourceNotFoundError("Blob not found: {}/{}".format(self.container_client.container, self.name))
+        return blob
+
+    def get_blob_properties(self) -> FakeBlobProperties:
+        self.container_client.counter.request("blob.properties")
+        return FakeBlobProperties(self.name, self._get_blob(), True)
+
+    def download_blob(self, offset: int = None, length: int = None, etag: str = None, match_condition: MatchConditions = None) -> FakeBlobDownloader:
+        self.container_client.counter.request("blob.download")
+        blob = self._get_blob()
+        if match_condition == MatchConditions.IfNotModified and etag.strip('"') != blob.etag:
+            raise ResourceModifiedError("The condition specified using HTTP conditional header(s) is not met.")
+
+        content = blob.content
+        if offset is not None:
+            content = content[offset:offset + length]
+        return FakeBlobDownloader(content)
+
+
+class FakeContainerClient:
+    # Service limit on blobs returned per listing request
+    LIST_PAGE_SIZE = 5000
+
+    def __init__(self, container: str, blobs: typing.Dict[str, FakeBlob], counter: RequestCounter):
+        self.container = container
+        self.blobs = blobs
+        self.counter = counter
+
+    def get_blob_client(self, blob: str) -> FakeBlobClient:
+        return FakeBlobClient(self, blob)
+
+    def list_blobs(self, name_starts_with: str = None) -> typing.Iterator[FakeBlobProperties]:
+        names = sorted([name for name in self.blobs if not name_starts_with or name.startswith(name_starts_with)])
+        for idx, name in enumerate(names):
+            if idx % FakeContainerClient.LIST_PAGE_SIZE == 0:
+                self.counter.request("blob.list")
+            yield FakeBlobProperties(name, self.blobs[name], False)
+
+
+class FakeBlobService:
+    """
+    In memory blobs for any number of accounts, blobs are stored by account
+    and then container/path.
+    """
+    def __init__(self, counter: RequestCounter):
+        self.counter = counter
+        self.accounts: typing.Dict[str, typing.Dict[str, typing.Dict[str, FakeBlob]]] = {}
+        self.lock = threading.Lock()
+
+    def put_blob(self, account: str, blob: str, content: bytes):
+        container, blob = AzureBlobStorageUtils._parse_blob_parts(blob)
+        with self.lock:
+            containers = self.accounts.setdefault(account, {})
+            blobs = containers.setdefault(container, {})
+            if blob in blobs:
+                blobs[blob].set_content(content)
+            else:
+                blobs[blob] = FakeBlob(content)
+
+    def get_blob(self, account: str, blob: str) -> FakeBlob:
+        container, blob = AzureBlobStorageUtils._parse_blob_parts(blob)
+        with self.lock:
+            return self.accounts[account][container][blob]
+
+    def create_blob_utils(self, account: str, key: str) -> AzureBlobStorageUtils:
+        """
+        Use as Context(create_blob_utils=...)
+        """
+        return FakeBlobStorageUtils(self, account, key)
+
+
+class FakeBlobStorageUtils(AzureBlobStorageUtils):
+    """
+    AzureBlobStorageUtils with its container clients served from a FakeBlobService.
+    """
+    def __init__(self, service: FakeBlobService, account: str, key: str):
+        super().__init__(account, key)
+        self.service = service
+
+    def get_container_client(self, container: str) -> FakeContainerClient:
+        with self.service.lock:
+            blobs = self.service.accounts.setdefault(self.account_name, {}).setdefault(container, {})
+        return FakeContainerClient(container, blobs, self.service.counter)
+
+    def close(self):
+        pass
+
+
+class FakeTablePages:
+    """
+    The by_page() iterator of an SDK query, each page is a request for up
+    to QUERY_PAGE_SIZE entities. Matching entities are found when the
+    first page is requested, as a query starts when it is first iterated.
+    """
+    def __init__(self, table_store, table_name: str, query_filter: str, select: typing.List[str]):
+        self.table_store = table_store
+        self.table_name = table_name
+        self.matches = FakeTableStoreUtil._parse_filter(query_filter)
+        self.select = select
+        self.rows = None
+        self.offset = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> typing.List[TableEntity]:
+        if self.rows is None:
+            with self.table_store.lock:
+                rows = list(self.table_store.tables.get(self.table_name, {}).values())
+            rows.sort(key=lambda row: (row[0]["PartitionKey"], row[0]["RowKey"]))
+            self.rows = [row for row in rows if self.matches(*row)]
+        elif self.offset >= len(self.rows):
+            # No continuation token, the service has nothing more to send
+            raise StopIteration
+
+        self.table_store.counter.request("table.query")
+        page = self.rows[self.offset:self.offset + FakeTableStoreUtil.QUERY_PAGE_SIZE]
+        self.offset += FakeTableStoreUtil.QUERY_PAGE_SIZE
+        return [FakeTableStoreUtil._to_table_entity(entity, timestamp, self.select) for entity, timestamp in page]
+
+
+class FakeTableQuery:
+    """
+    The ItemPaged returned by query_entities and list_entities.
+    """
+    def __init__(self, table_store, table_name: str, query_filter: str = None, select: typing.List[str] = None):
+        self.table_store = table_store
+        self.table_name = table_name
+        self.query_filter = query_filter
+        self.select = select
+
+    def by_page(self) -> FakeTablePages:
+        return FakeTablePages(self.table_store, self.table_name, self.query_filter, self.select)
+
+    def __iter__(self) -> typing.Iterator[TableEntity]:
+        for page in self.by_page():
+            yield from page
+
+
+class FakeTableClient:
+    """
+    The queries of azure.data.tables.TableClient over a FakeTableStoreUtil's tables.
+    """
+    def __init__(self, table_store, table_name: str):
+        self.table_store = table_store
+        self.table_name = table_name
+
+    def query_entities(self, query_filter: str, select: typing.List[str] = None) -> FakeTableQuery:
+        return FakeTableQuery(self.table_store, self.table_name, query_filter, select)
+
+    def list_entities(self, select: typing.List[str] = None) -> FakeTableQuery:
+        return FakeTableQuery(self.table_store, self.table_name, None, select)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeTableService:
+    """
+    The parts of azure.data.tables.TableServiceClient the store uses to find
+    and create tables.
+    """
+    class Table:
+        def __init__(self, name: str):
+            self.name = name
+
+    def __init__(self, table_store):
+        self.table_store = table_store
+
+    def query_tables(self, query_filter: str) -> typing.List["FakeTableService.Table"]:
+        self.table_store.counter.request("table.tables")
+        matches = FakeTableStoreUtil._parse_filter(query_filter)
+        with self.table_store.lock:
+            names = list(self.table_store.tables)
+        return [FakeTableService.Table(name) for name in names if matches({"TableName" : name}, None)]
+
+    def create_table(self, table_name: str):
+        self.table_store.counter.request("table.create")
+        with self.table_store.lock:
+            self.table_store.tables.setdefault(table_name, {})
+
+    def get_table_client(self, table_name: str) -> FakeTableClient:
+        return FakeTableClient(self.table_store, table_name)
+
+    def close(self):
+        pass
+
+
+class FakeTableStoreUtil(AzureTableStoreUtil):
+    """
+    AzureTableStoreUtil with the tables held in memory. Queries are served by
+    a fake TableServiceClient, so they go through the store's own paging,
+    throttling and metrics, and records go through the same entry and
+    entity conversion as the real store.
+
+    Filters support comparisons (eq, ne, gt, ge, lt, le) of string and
+    datetime values joined with "and" and "or", grouped with parentheses,
+    which covers the filters this application creates. Anything else
+    raises rather than matching the wrong rows.
+    """
+    # Service limit on entities returned per query request
+    QUERY_PAGE_SIZE = 1000
+    FILTER_TOKEN = re.compile(r"\s*(?:(\()|(\))|(and|or)\b|(\w+) (eq|ne|gt|ge|lt|le) (?:datetime)?'((?:[^']|'')*)')\s*")
+    COMPARISONS = {
+        "eq" : lambda a, b: a == b,
+        "ne" : lambda a, b: a != b,
+        "gt" : lambda a, b: a > b,
+        "ge" : lambda a, b: a >= b,
+        "lt" : lambda a, b: a < b,
+        "le" : lambda a, b: a <= b
+    }
+
+    def __init__(self, counter: RequestCounter):
+        super().__init__("fake", "fake-key")
+        self.counter = counter
+        self.tables: typing.Dict[str, typing.Dict[typing.Tuple[str, str], typing.Tuple[dict, str]]] = {}
+
+    def put_entity(self, table_name: str, entity: dict, mode: UpdateMode = UpdateMode.MERGE):
+        """
+        Insert or update an entity without counting a request, used to seed tables.
+        """
+        with self.lock:
+            table = self.tables.setdefault(table_name, {})
+            keys = (entity["PartitionKey"], entity["RowKey"])
+            stored = dict(entity)
+            if mode == UpdateMode.MERGE and keys in table:
+                stored = dict(table[keys][0])
+                stored.update(entity)
+
+            # Service timestamps are fixed width, compare as text
+            table[keys] = (stored, datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+
+    def _get_table_service(self) -> "FakeTableService":
+        return FakeTableService(self)
+
+    @staticmethod
+    def _parse_filter(query_filter: str) -> typing.Callable[[dict, str], bool]:
+        """
+        Parse a filter into a check of (entity, timestamp), "and" binds
+        tighter than "or" as it does in OData.
+        """
+        tokens = []
+        position = 0
+        query_filter = query_filter or ""
+        while position < len(query_filter):
+            match = FakeTableStoreUtil.FILTER_TOKEN.match(query_filter, position)
+            if match is None or match.end() == position:
+                raise Exception("Filter not supported by the fake table store: {}".format(query_filter))
+            position = match.end()
+
+            open_group, close_group, join, prop, op, value = match.groups()
+            if prop:
+                tokens.append((prop, FakeTableStoreUtil.COMPARISONS[op], value.replace("''", "'")))
+            else:
+                tokens.append(open_group or close_group or join)
+
+        if not tokens:
+            return lambda entity, timestamp: True
+
+        def parse(index: int, joins: typing.List[str]) -> typing.Tuple[typing.Callable, int]:
+            # joins is ["or", "and"], each level parses groups joined by its first word
+            if not joins:
+                token = tokens[index] if index < len(tokens) else None
+                if token == "(":
+                    check, index = parse(index + 1, ["or", "and"])
+                    if index >= len(tokens) or tokens[index] != ")":
+                        raise Exception("Unbalanced parentheses in filter: {}".format(query_filter))
+                    return check, index + 1
+                if isinstance(token, tuple):
+                    return (lambda entity, timestamp: FakeTableStoreUtil._matches(entity, timestamp, token)), index + 1
+                raise Exception("Filter not supported by the fake table store: {}".format(query_filter))
+
+            checks = []
+            check, index = parse(index, joins[1:])
+            checks.append(check)
+            while index < len(tokens) and tokens[index] == joins[0]:
+                check, index = parse(index + 1, joins[1:])
+                checks.append(check)
+
+            if len(checks) == 1:
+                return checks[0], index
+            if joins[0] == "or":
+                return (lambda entity, timestamp: any(x(entity, timestamp) for x in checks)), index
+            return (lambda entity, timestamp: all(x(entity, timestamp) for x in checks)), index
+
+        check, index = parse(0, ["or", "and"])
+        if index != len(tokens):
+            raise Exception("Filter not supported by the fake table store: {}".format(query_filter))
+        return check
+
+    @staticmethod
+    def _matches(entity: dict, timestamp: str, condition: tuple) -> bool:
+        prop, compare, value = condition
+        if prop == AzureTableStoreUtil.TIMESTAMP_PROPERTY:
+            return compare(timestamp, value)
+
+        actual = entity.get(prop)
+        return actual is not None and compare(actual, value)
+
+    @staticmethod
+    def _to_table_entity(entity: dict, timestamp: str, select: typing.List[str] = None) -> TableEntity:
+        result = TableEntity()
+        for key in (select or entity.keys()):
+            if key in entity:
+                result[key] = entity[key]
+
+        parsed = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+        timestamp_value = TablesEntityDatetime(
+            parsed.year, parsed.month, parsed.day,
+            parsed.hour, parsed.minute, parsed.second, parsed.microsecond,
+            tzinfo=datetime.timezone.utc
+        )
+        timestamp_value._service_value = timestamp
+        result._metadata = {"timestamp" : timestamp_value}
+        return result
+
+    def get_record(self, table_name: str, partition_key: str, row_key: str) -> StorageBlobValidationEntry:
+        self.counter.request("table.get")
+        with self.lock:
+            stored = self.tables.get(table_name, {}).get((partition_key, row_key))
+
+        if stored is None:
+            return None
+        return StorageBlobValidationEntry.create_from_record(
+            table_name,
+            FakeTableStoreUtil._to_table_entity(*stored)
+        )
+
+    def upsert_batch(self, table_name: str, entities: typing.List[dict], mode: UpdateMode = UpdateMode.MERGE) -> None:
+        for idx in range(0, len(entities), AzureTableStoreUtil.MAX_BATCH_SIZE):
+            self.counter.request("table.batch")
+            for entity in entities[idx:idx + AzureTableStoreUtil.MAX_BATCH_SIZE]:
+                self.put_entity(table_name, entity, mode)
+
+    def delete_batch(self, table_name: str, records: typing.List[typing.Tuple[str, str]]) -> None:
+        for idx in range(0, len(records), AzureTableStoreUtil.MAX_BATCH_SIZE):
+            self.counter.request("table.batch")
+            with self.lock:
+                table = self.tables.get(table_name, {})
+                # Records are (RowKey, PartitionKey), the table is keyed (PartitionKey, RowKey)
+                for keys in records[idx:idx + AzureTableStoreUtil.MAX_BATCH_SIZE]:
+                    table.pop((keys[1], keys[0]), None)
+
+    def delete_records(self, table_name: str, records: typing.List[typing.Tuple[str, str]]) -> None:
+        self.delete_batch(table_name, records)
+
+    def add_record(self, table_name: str, entity: dict):
+        self.counter.request("table.upsert")
+        self.put_entity(table_name, entity)
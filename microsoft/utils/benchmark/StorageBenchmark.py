@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import tempfile
+import contextlib
+import typing
+from ..Config import Configuration
+from ..Context import Context
+from ..storage.AzureBlobStorage import AzureBlobStorageUtils
+from ..storage.AzureTableValidationEntry import StorageBlobValidationEntry
+from .FakeStorage import RequestCounter, FakeCredentialProvider, FakeBlobService, FakeTableStoreUtil
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is not reported
+    resource = None
+
+
+class BenchmarkResult:
+    """
+    Measurements of a single scenario at a single scale.
+    """
+    def __init__(self, scenario: str, scale: int):
+        self.scenario = scenario
+        self.scale = scale
+        self.records = 0
+        self.seconds = 0
+        self.requests = 0
+        self.request_counts = {}
+        self.peak_rss_mb = None
+
+    @property
+    def records_per_second(self) -> float:
+        return round(self.records / max(self.seconds, 0.000001), 1)
+
+    def to_dict(self) -> dict:
+        values = dict(self.__dict__)
+        values["records_per_second"] = self.records_per_second
+        return values
+
+    def __str__(self):
+        return "{:<10}{:>10}{:>10}{:>10.2f}{:>12}{:>14}".format(
+            self.scenario,
+            self.scale,
+            self.records,
+            self.seconds,
+            self.records_per_second,
+            self.requests
+        ) + ("{:>14.1f}".format(self.peak_rss_mb) if self.peak_rss_mb is not None else "")
+
+    @staticmethod
+    def header() -> str:
+        return "{:<10}{:>10}{:>10}{:>10}{:>12}{:>14}{:>14}".format(
+            "scenario", "scale", "records", "seconds", "records/s", "requests", "peak RSS MB"
+        )
+
+
+class StorageBenchmark:
+    """
+    Runs validate, rebase and ingest through a Context backed by in process
+    fakes of the table and blob services, so the cost of the application
+    code and the number of requests it makes can be measured without a
+    subscription.
+
+    Each scenario seeds scale blobs and a table record for each (for ingest
+    only half of them are recorded, the rest are new). A fraction
+    (changed_fraction) of the blobs are then changed so rebase has updates
+    to write and ingest sees a mix of new, changed and unchanged blobs.
+    Requests can be given a fixed latency to show the effect of workers.
+
+    Peak RSS is the high water mark of the process, run scales smallest first.
+    """
+    SCENARIOS = ["validate", "rebase", "ingest"]
+    INDUSTRY = "benchmark"
+    ACCOUNT = "benchmarkaccount"
+    SUBSCRIPTION = "benchmark-subscription"
+    TABLE = "benchmark"
+    CONTAINER = "benchmark"
+    ACTOR = "benchmark"
+
+    def __init__(self, workers: int = Context.DEFAULT_WORKERS, latency_ms: float = 0, changed_fraction: float = 0.1, list_hashes: bool = False, performance: dict = None):
+        """
+        Parameters:
+        workers - Workers used by the context
+        latency_ms - Delay added to each fake request
+        changed_fraction - Fraction of blobs changed after seeding
+        list_hashes - Get hashes from container listings
+        performance - Optional performance section for the configuration
+        """
+        self.workers = workers
+        self.latency_ms = latency_ms
+        self.changed_fraction = changed_fraction
+        self.list_hashes = list_hashes
+        self.performance = performance or {}
+
+    def run_scenario(self, scenario: str, scale: int) -> BenchmarkResult:
+        if scenario not in StorageBenchmark.SCENARIOS:
+            raise Exception("Unknown benchmark scenario: {}".format(scenario))
+
+        counter = RequestCounter(self.latency_ms / 1000)
+        table_store = FakeTableStoreUtil(counter)
+        blob_service = FakeBlobService(counter)
+
+        recorded = scale // 2 if scenario == "ingest" else scale
+        blobs = self._seed(scale, recorded, table_store, blob_service)
+
+        with tempfile.TemporaryDirectory() as work_dir, open(os.devnull, "w") as devnull:
+            context = self._create_context(work_dir, counter, table_store, blob_service)
+            counter.reset()
+
+            result = BenchmarkResult(scenario, scale)
+            start_time = time.perf_counter()
+
+            # The context reports each record, keep that out of the results
+            with contextlib.redirect_stdout(devnull):
+                result.records = getattr(self, "_run_" + scenario)(context, blobs, work_dir)
+                context.flush_table_records()
+
+            result.seconds = time.perf_counter() - start_time
+            result.request_counts = dict(counter.counts)
+            result.requests = counter.total()
+            result.peak_rss_mb = StorageBenchmark._get_peak_rss_mb()
+
+            context.account_cache.clear()
+
+        return result
+
+    def _seed(self, scale: int, recorded: int, table_store: FakeTableStoreUtil, blob_service: FakeBlobService) -> typing.List[str]:
+        blobs = []
+        for idx in range(scale):
+            blob = "{}/data/{:03d}/blob_{:08d}.bin".format(StorageBenchmark.CONTAINER, idx % 100, idx)
+            blob_service.put_blob(StorageBenchmark.ACCOUNT, blob, "{}".format(idx).encode())
+            blobs.append(blob)
+
+            if idx >= recorded:
+                continue
+
+            state = blob_service.get_blob(StorageBenchmark.ACCOUNT, blob)
+            entry = StorageBlobValidationEntry(StorageBenchmark.TABLE, blob)
+            entry.RowKey = "{:08d}".format(idx)
+            entry.industry = StorageBenchmark.INDUSTRY
+            entry.account = StorageBenchmark.ACCOUNT
+            entry.subscription = StorageBenchmark.SUBSCRIPTION
+            entry.actor = StorageBenchmark.ACTOR
+            entry.md5 = AzureBlobStorageUtils._encode_md5(state.content_md5)
+            entry.etag = state.etag
+            entry.history = [{"timestamp" : entry.RowKey, "activity" : "create", "actor" : StorageBenchmark.ACTOR}]
+            table_store.put_entity(StorageBenchmark.TABLE, entry.get_entity())
+
+        # Change a share of the blobs after they were recorded
+        if self.changed_fraction:
+            step = max(int(1 / self.changed_fraction), 1)
+            for blob in blobs[::step]:
+                blob_service.put_blob(StorageBenchmark.ACCOUNT, blob, "{}-changed".format(blob).encode())
+
+        return blobs
+
+    def _create_context(self, work_dir: str, counter: RequestCounter, table_store: FakeTableStoreUtil, blob_service: FakeBlobService) -> Context:
+        config_path = os.path.join(work_dir, "configuration.json")
+        with open(config_path, "w") as config_file:
+            json.dump({
+                "historyStorage" : {
+                    "account" : StorageBenchmark.ACCOUNT,
+                    "subscription" : StorageBenchmark.SUBSCRIPTION,
+                    "table" : StorageBenchmark.TABLE
+                },
+                "industries" : [StorageBenchmark.INDUSTRY],
+                "performance" : self.performance
+            }, config_file)
+
+        return Context(
+            Configuration(config_path),
+            self.workers,
+            self.list_hashes,
+            False,
+            FakeCredentialProvider(counter),
+            table_store,
+            blob_service.create_blob_utils
+        )
+
+    def _run_validate(self, context: Context, blobs: typing.List[str], work_dir: str) -> int:
+        records = 0
+        for _ in context.iter_industry_validation_results(StorageBenchmark.INDUSTRY, StorageBlobValidationEntry.VALIDATION_COLUMNS):
+            records += 1
+        return records
+
+    def _run_rebase(self, context: Context, blobs: typing.List[str], work_dir: str) -> int:
+        # Same steps as app.py -rebase
+        records = 0
+        for res in context.iter_industry_validation_results(StorageBenchmark.INDUSTRY):
+            records += 1
+            if res.current_state is not None and not res.validated:
+                context.set_entry_state(res.validation_entry, res.current_state)
+                res.validation_entry.actor = StorageBenchmark.ACTOR
+                res.validation_entry.history.append(
+                    context.get_history_entry("rebase", StorageBenchmark.ACTOR)
+                )
+                context.add_table_record(res.validation_entry)
+        return records
+
+    def _run_ingest(self, context: Context, blobs: typing.List[str], work_dir: str) -> int:
+        # Same steps as app.py -ingest
+        settings_path = os.path.join(work_dir, "ingest.json")
+        with open(settings_path, "w") as settings_file:
+            json.dump({
+                "industry" : StorageBenchmark.INDUSTRY,
+                "account" : StorageBenchmark.ACCOUNT,
+                "subscription" : StorageBenchmark.SUBSCRIPTION,
+                "blobs" : blobs
+            }, settings_file)
+
+        plan = context.plan_ingest(Configuration(settings_path))
+        context.apply_ingest_plan(plan, StorageBenchmark.ACTOR)
+        return len(blobs)
+
+    @staticmethod
+    def _get_peak_rss_mb() -> float:
+        if resource is None:
+            return None
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, macOS bytes
+        if os.uname().sysname == "Darwin":
+            return peak / (1024 * 1024)
+        return peak / 1024
+
+    @staticmethod
+    def compare(results: typing.List[BenchmarkResult], baseline: typing.List[dict], tolerance: float) -> typing.List[str]:
+        """
+        Compare results with a baseline (BenchmarkResult.to_dict() of an
+        earlier run) and return a description of each regression: records
+        per second lower, or more requests made, than the baseline by more
+        than tolerance (i.e. 0.2 for 20%).
+        """
+        baseline_results = {(x["scenario"], x["scale"]): x for x in baseline}
+        regressions = []
+
+        for result in results:
+            expected = baseline_results.get((result.scenario, result.scale))
+            if expected is None:
+                continue
+
+            if result.records_per_second < expected["records_per_second"] * (1 - tolerance):
+                regressions.append("{} at {}: {} records/s, baseline {}".format(
+                    result.scenario, result.scale, result.records_per_second, expected["records_per_second"]
+                ))
+
+            if result.requests > expected["requests"] * (1 + tolerance):
+                regressions.append("{} at {}: {} requests, baseline {}".format(
+                    result.scenario, result.scale, result.requests, expected["requests"]
+                ))
+
+        return regressions
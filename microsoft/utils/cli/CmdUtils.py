@@ -1,5 +1,6 @@
 import json
 import subprocess
+from ..metrics.RunMetrics import RunMetrics
 
 class CmdUtils:
     LAST_STD_ERR = None
@@ -21,7 +22,10 @@ class CmdUtils:
 
     @staticmethod
     def get_command_output(command_list, as_json=True):
-        result = subprocess.run(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        # i.e. cli.storage.account for az storage account keys list
+        operation = ".".join(["cli"] + [x for x in command_list[1:3] if not x.startswith("-")])
+        with RunMetrics.get().measure(operation):
+            result = subprocess.run(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
 
         CmdUtils.LAST_STD_ERR = result.stderr
 
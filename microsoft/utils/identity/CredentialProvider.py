@@ -0,0 +1,198 @@
+import os
+import json
+import base64
+import threading
+from ..Config import Configuration
+from ..cli.AzLoginUtils import AzLoginUtils
+from ..storage.AzCliStorage import AzCliStorageUtil, AzStorageAccount
+from ..metrics.RunMetrics import RunMetrics
+
+
+class CliCredentialProvider:
+    """
+    Login and storage account keys through the az cli, each call starts
+    an az process.
+    """
+    name = "cli"
+
+    def __init__(self, credentials_json: str = None):
+        self.credentials_json = credentials_json
+
+    def validate_login(self) -> str:
+        return AzLoginUtils.validate_login(self.credentials_json)
+
+    def get_storage_account(self, storage_account: str, subscription: str) -> AzStorageAccount:
+        return AzCliStorageUtil.get_storage_account(storage_account, subscription)
+
+
+class SdkCredentialProvider:
+    """
+    Login and storage account keys through azure-identity and the storage
+    management SDK, in process.
+
+    With usePrincipal the service principal in the credentials file is used, 
+    otherwise DefaultAzureCredential (environment, managed identity, az login...)
+
+    The resource group of every account in a subscription is read from one
+    listing of the subscription's accounts, after that a key lookup is a 
+    single list_keys call. With cli_fallback, keys the SDK can't get (i.e.
+    no listKeys permission) are looked up with the az cli.
+    """
+    name = "sdk"
+    MANAGEMENT_SCOPE = "https://management.azure.com/.default"
+
+    def __init__(self, creds: Configuration = None, cli_fallback: bool = False):
+        # Optional packages, only needed for this provider
+        from azure.identity import ClientSecretCredential, DefaultAzureCredential
+        from azure.mgmt.storage import StorageManagementClient
+
+        self.storage_management_client = StorageManagementClient
+        self.creds = creds
+
+        if creds and getattr(creds, "usePrincipal", False):
+            self.credential = ClientSecretCredential(
+                tenant_id=creds.tenent,
+                client_id=creds.application,
+                client_secret=creds.credential
+            )
+        else:
+            self.credential = DefaultAzureCredential()
+
+        self.cli_fallback = cli_fallback
+        self.management_clients = {}
+        # subscription -> {account name : resource group}
+        self.resource_groups = {}
+        self.subscription_locks = {}
+        self.lock = threading.Lock()
+
+    def validate_login(self) -> str:
+        """
+        Get a token to prove the credential works and return the name of
+        who it is acting as.
+        """
+        token = self.credential.get_token(SdkCredentialProvider.MANAGEMENT_SCOPE)
+        actor = SdkCredentialProvider._get_token_actor(token.token)
+
+        if self.creds and getattr(self.creds, "usePrincipal", False):
+            actor = self.creds.application
+
+        if not actor:
+            raise Exception("Unable to identify the logged in user")
+
+        print("Acting as -", actor)
+        return actor
+
+    def get_storage_account(self, storage_account: str, subscription: str) -> AzStorageAccount:
+        try:
+            with RunMetrics.get().measure("mgmt.storage_account", storage_account):
+                return self._get_storage_account(storage_account, subscription)
+        except Exception as ex:
+            if not self.cli_fallback:
+                raise
+            print("WARNING - SDK key lookup for {} failed ({}), using az cli".format(
+                storage_account,
+                str(ex).splitlines()[0] if str(ex) else type(ex).__name__
+            ))
+
+        return AzCliStorageUtil.get_storage_account(storage_account, subscription)
+
+    def _get_storage_account(self, storage_account: str, subscription: str) -> AzStorageAccount:
+        client = self._get_management_client(subscription)
+        resource_group = self._get_resource_group(client, storage_account, subscription)
+
+        keys = client.storage_accounts.list_keys(resource_group, storage_account)
+        return AzStorageAccount(storage_account, [key.value for key in keys.keys], subscription)
+
+    def _get_resource_group(self, client, storage_account: str, subscription: str) -> str:
+        """
+        Resource group of an account, the subscription's accounts are listed
+        once and listed again only for an account created since.
+        """
+        with self.lock:
+            subscription_lock = self.subscription_locks.setdefault(subscription, threading.Lock())
+
+        with subscription_lock:
+            resource_groups = self.resource_groups.get(subscription)
+            if resource_groups is None or storage_account not in resource_groups:
+                resource_groups = {}
+                for account in client.storage_accounts.list():
+                    # /subscriptions/{sub}/resourceGroups/{group}/providers/...
+                    id_parts = account.id.split("/")
+                    resource_groups[account.name] = id_parts[id_parts.index("resourceGroups") + 1]
+                self.resource_groups[subscription] = resource_groups
+
+        if storage_account not in resource_groups:
+            raise Exception("Storage account {} not found in {}".format(storage_account, subscription))
+
+        return resource_groups[storage_account]
+
+    def _get_management_client(self, subscription: str):
+        with self.lock:
+            if subscription not in self.management_clients:
+                self.management_clients[subscription] = self.storage_management_client(self.credential, subscription)
+            return self.management_clients[subscription]
+
+    @staticmethod
+    def _get_token_actor(token: str) -> str:
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            claims = json.loads(base64.urlsafe_b64decode(payload))
+        except Exception:
+            return None
+
+        for claim in ["upn", "unique_name", "email", "appid", "oid"]:
+            if claim in claims:
+                return claims[claim]
+        return None
+
+
+class CredentialProvider:
+    """
+    Chooses the credential provider named by "provider" in the credentials 
+    file.
+
+    auto (default) - sdk, falling back to cli if the sdk packages are not
+                     installed or the login fails, and for any account
+                     keys the sdk can't get
+    sdk            - azure-identity / azure-mgmt-storage only
+    cli            - az cli only
+    """
+    AUTO = "auto"
+
+    @staticmethod
+    def login(credentials_json: str = None) -> tuple:
+        """
+        Create the provider and validate the login with it.
+
+        Returns (provider, actor)
+        """
+        creds = None
+        if credentials_json:
+            if not os.path.exists(credentials_json):
+                raise Exception("Credentials file invalid", credentials_json)
+            creds = Configuration(credentials_json)
+
+        provider = getattr(creds, "provider", CredentialProvider.AUTO)
+
+        if provider == CliCredentialProvider.name:
+            cli_provider = CliCredentialProvider(credentials_json)
+            return cli_provider, cli_provider.validate_login()
+
+        if provider == SdkCredentialProvider.name:
+            sdk_provider = SdkCredentialProvider(creds)
+            return sdk_provider, sdk_provider.validate_login()
+
+        if provider != CredentialProvider.AUTO:
+            raise Exception("Unknown credential provider", provider)
+
+        try:
+            sdk_provider = SdkCredentialProvider(creds, cli_fallback=True)
+            return sdk_provider, sdk_provider.validate_login()
+        except ImportError as ex:
+            print("SDK credentials unavailable ({}), using az cli".format(str(ex)))
+        except Exception as ex:
+            print("SDK login failed ({}), using az cli".format(str(ex).splitlines()[0] if str(ex) else type(ex).__name__))
+
+        cli_provider = CliCredentialProvider(credentials_json)
+        return cli_provider, cli_provider.validate_login()
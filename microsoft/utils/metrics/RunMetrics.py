@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+import typing
+from urllib.parse import urlparse
+from ..storage.StorageThrottle import StorageThrottle
+
+
+class LatencyHistogram:
+    """
+    Count of observations in fixed latency buckets (upper bounds in seconds)
+    along with their count and sum.
+    """
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        # Last bucket is everything above the largest bound
+        self.buckets = [0] * (len(LatencyHistogram.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(LatencyHistogram.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self) -> dict:
+        bounds = [str(x) for x in LatencyHistogram.BUCKETS] + ["+Inf"]
+        return {
+            "count" : self.count,
+            "sum_seconds" : round(self.sum, 6),
+            "mean_seconds" : round(self.sum / self.count, 6) if self.count else 0,
+            "buckets" : dict(zip(bounds, self.buckets))
+        }
+
+
+class OperationStats:
+    """
+    Calls to one application operation (i.e. blob.properties) on one account.
+    """
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.errors = 0
+        self.throttled = 0
+        self.bytes = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "latency" : self.latency.to_dict(),
+            "errors" : self.errors,
+            "throttled" : self.throttled,
+            "bytes" : self.bytes
+        }
+
+
+class RequestStats:
+    """
+    HTTP requests made by the SDK clients to one service of one account,
+    every attempt is counted including those the SDK retried. Responses
+    with a status the SDK may retry are counted in retryable_responses,
+    whether or not the request was retried.
+    """
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.status_codes = {}
+        self.retryable_responses = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "latency" : self.latency.to_dict(),
+            "status_codes" : dict(self.status_codes),
+            "retryable_responses" : self.retryable_responses,
+            "throttled" : self.throttled,
+            "bytes_sent" : self.bytes_sent,
+            "bytes_received" : self.bytes_received
+        }
+
+
+class RunMetrics:
+    """
+    Counts and latencies of the operations and HTTP requests made during a
+    run, shared by the whole process (see get()).
+
+    Operations are timed with measure(). HTTP requests are recorded by the
+    raw request/response hooks the storage clients are created with (see
+    get_client_hooks()), so requests retried inside the SDK are counted.
+    Throttling (429/503) and other retryable status codes (the lists in
+    StorageThrottle) are counted separately.
+
+    At the end of a run write() saves a summary as json, or as Prometheus
+    text if the file ends with .prom, and write_trace() saves a Chrome trace
+    (chrome://tracing or Perfetto) if tracing was enabled.
+    """
+    MAX_TRACE_EVENTS = 1000000
+    PROMETHEUS_PREFIX = "storage_validation"
+    START_CONTEXT_KEY = "run_metrics_start"
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.operations: typing.Dict[typing.Tuple[str, str], OperationStats] = {}
+        self.requests: typing.Dict[typing.Tuple[str, str], RequestStats] = {}
+        # Chrome trace events, None unless tracing is enabled
+        self.trace_events = None
+        self.trace_start = time.perf_counter()
+
+    @staticmethod
+    def get() -> object:
+        """
+        The metrics of this process.
+        """
+        with RunMetrics._instance_lock:
+            if RunMetrics._instance is None:
+                RunMetrics._instance = RunMetrics()
+            return RunMetrics._instance
+
+    def enable_trace(self):
+        with self.lock:
+            if self.trace_events is None:
+                self.trace_events = []
+
+    @contextlib.contextmanager
+    def measure(self, operation: str, account: str = None):
+        """
+        Time the block as a call to an operation on an account. Exceptions
+        are counted as errors (and as throttled for 429/503) and re-raised.
+        """
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as ex:
+            error = ex
+            raise
+        finally:
+            self.record(operation, account, start, time.perf_counter(), error)
+
+    def record(self, operation: str, account: str, start: float, end: float, error: Exception = None):
+        """
+        Record a call to an operation timed with time.perf_counter().
+        """
+        with self.lock:
+            stats = self.operations.get((operation, account))
+            if stats is None:
+                stats = self.operations[(operation, account)] = OperationStats()
+
+            stats.latency.observe(end - start)
+            if error is not None:
+                stats.errors += 1
+                if getattr(error, "status_code", None) in StorageThrottle.THROTTLE_STATUS:
+                    stats.throttled += 1
+
+            self._add_trace_event(operation, account or "", start, end)
+
+    def add_bytes(self, operation: str, account: str, transferred: int):
+        """
+        Count bytes read or written by an operation.
+        """
+        with self.lock:
+            stats = self.operations.get((operation, account))
+            if stats is None:
+                stats = self.operations[(operation, account)] = OperationStats()
+            stats.bytes += transferred
+
+    def get_client_hooks(self) -> dict:
+        """
+        Keyword arguments for creating a storage SDK client so its HTTP
+        requests are recorded.
+        """
+        return {
+            "raw_request_hook" : self._on_request,
+            "raw_response_hook" : self._on_response
+        }
+
+    def _on_request(self, request):
+        request.context[RunMetrics.START_CONTEXT_KEY] = time.perf_counter()
+
+    def _on_response(self, response):
+        end = time.perf_counter()
+        start = response.context.get(RunMetrics.START_CONTEXT_KEY, end)
+
+        http_request = response.http_request
+        http_response = response.http_response
+
+        # Hosts are account.service.core.windows.net
+        host_parts = (urlparse(http_request.url).hostname or "").split(".")
+        account = host_parts[0]
+        service = host_parts[1] if len(host_parts) > 1 else ""
+
+        status = http_response.status_code
+        body = http_request.body
+        sent = len(body) if isinstance(body, (bytes, str)) else 0
+        received = int(http_response.headers.get("Content-Length", 0) or 0)
+
+        with self.lock:
+            stats = self.requests.get((service, account))
+            if stats is None:
+                stats = self.requests[(service, account)] = RequestStats()
+
+            stats.latency.observe(end - start)
+            stats.status_codes[status] = stats.status_codes.get(status, 0) + 1
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            if status in StorageThrottle.RETRY_STATUS:
+                stats.retryable_responses += 1
+            if status in StorageThrottle.THROTTLE_STATUS:
+                stats.throttled += 1
+
+            self._add_trace_event(
+                "{} {}".format(http_request.method, status),
+                "{}.{}".format(account, service),
+                start,
+                end
+            )
+
+    def _add_trace_event(self, name: str, category: str, start: float, end: float):
+        # Called with the lock held
+        if self.trace_events is None or len(self.trace_events) >= RunMetrics.MAX_TRACE_EVENTS:
+            return
+
+        self.trace_events.append({
+            "name" : name,
+            "cat" : category,
+            "ph" : "X",
+            "ts" : round((start - self.trace_start) * 1000000),
+            "dur" : round((end - start) * 1000000),
+            "pid" : os.getpid(),
+            "tid" : threading.get_ident()
+        })
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "started" : self.started,
+                "seconds" : round(time.time() - self.started, 3),
+                "operations" : [
+                    dict(operation=key[0], account=key[1], **self.operations[key].to_dict())
+                    for key in sorted(self.operations, key=lambda x: (x[0], x[1] or ""))
+                ],
+                "requests" : [
+                    dict(service=key[0], account=key[1], **self.requests[key].to_dict())
+                    for key in sorted(self.requests)
+                ]
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Summary in the Prometheus text exposition format.
+        """
+        prefix = RunMetrics.PROMETHEUS_PREFIX
+        lines = []
+
+        with self.lock:
+            lines.append("# TYPE {}_operation_seconds histogram".format(prefix))
+            for (operation, account), stats in sorted(self.operations.items(), key=lambda x: (x[0][0], x[0][1] or "")):
+                labels = 'operation="{}",account="{}"'.format(operation, account or "")
+                lines.extend(RunMetrics._prometheus_histogram(prefix + "_operation_seconds", labels, stats.latency))
+
+            for name, attribute in [("errors", "errors"), ("throttled", "throttled"), ("bytes", "bytes")]:
+                lines.append("# TYPE {}_operation_{}_total counter".format(prefix, name))
+                for (operation, account), stats in sorted(self.operations.items(), key=lambda x: (x[0][0], x[0][1] or "")):
+                    lines.append('{}_operation_{}_total{{operation="{}",account="{}"}} {}'.format(
+                        prefix, name, operation, account or "", getattr(stats, attribute)
+                    ))
+
+            lines.append("# TYPE {}_request_seconds histogram".format(prefix))
+            for (service, account), stats in sorted(self.requests.items()):
+                labels = 'service="{}",account="{}"'.format(service, account)
+                lines.extend(RunMetrics._prometheus_histogram(prefix + "_request_seconds", labels, stats.latency))
+
+            lines.append("# TYPE {}_requests_total counter".format(prefix))
+            for (service, account), stats in sorted(self.requests.items()):
+                for status in sorted(stats.status_codes):
+                    lines.append('{}_requests_total{{service="{}",account="{}",status="{}"}} {}'.format(
+                        prefix, service, account, status, stats.status_codes[status]
+                    ))
+
+            for name in ["retryable_responses", "throttled", "bytes_sent", "bytes_received"]:
+                lines.append("# TYPE {}_request_{}_total counter".format(prefix, name))
+                for (service, account), stats in sorted(self.requests.items()):
+                    lines.append('{}_request_{}_total{{service="{}",account="{}"}} {}'.format(
+                        prefix, name, service, account, getattr(stats, name)
+                    ))
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _prometheus_histogram(name: str, labels: str, histogram: LatencyHistogram) -> typing.List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(LatencyHistogram.BUCKETS + ["+Inf"], histogram.buckets):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative))
+        lines.append("{}_sum{{{}}} {}".format(name, labels, round(histogram.sum, 6)))
+        lines.append("{}_count{{{}}} {}".format(name, labels, histogram.count))
+        return lines
+
+    def write(self, path: str):
+        """
+        Write the summary, Prometheus text if path ends with .prom otherwise json.
+        """
+        with open(path, "w") as output:
+            if path.endswith(".prom"):
+                output.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), output, indent=4)
+
+    def write_trace(self, path: str):
+        """
+        Write the Chrome trace of the run, tracing must have been enabled.
+        """
+        with self.lock:
+            events = list(self.trace_events or [])
+
+        with open(path, "w") as output:
+            json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, output)
+
+    def summary(self) -> str:
+        """
+        One line per operation for printing at the end of a run.
+        """
+        lines = []
+        with self.lock:
+            for (operation, account), stats in sorted(self.operations.items(), key=lambda x: (x[0][0], x[0][1] or "")):
+                lines.append("{} {}: {} calls, {} ms mean, {} errors, {} throttled".format(
+                    operation,
+                    account or "",
+                    stats.latency.count,
+                    round(1000 * stats.latency.sum / max(stats.latency.count, 1), 1),
+                    stats.errors,
+                    stats.throttled
+                ))
+        return "\n".join(lines)
@@ -1,4 +1,13 @@
 import base64
+import fnmatch
+import hashlib
+import threading
+import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .BandwidthLimiter import BandwidthLimiter
+from ..metrics.RunMetrics import RunMetrics
+from azure.core import MatchConditions
 from azure.storage.blob import (
     generate_blob_sas, 
     BlobServiceClient, 
@@ -9,11 +18,43 @@ from azure.storage.blob import (
 )
 
 
+class BlobState:
+    """
+    The hash and version information of a blob. ETag and last modified are 
+    kept as strings, the form they are stored in the table.
+    """
+    def __init__(self, md5:str = None, etag:str = None, last_modified:str = None):
+        self.md5 = md5
+        self.etag = etag
+        self.last_modified = last_modified
+        # Digest of the blob content, only set when the content is read
+        self.content_hash = None
+        self.content_hash_algorithm = None
+
+    @staticmethod
+    def from_properties(blob_props:BlobProperties) -> object:
+        etag = blob_props.etag
+        if etag:
+            # Headers quote the ETag, listings do not
+            etag = etag.strip('"')
+
+        last_modified = blob_props.last_modified
+        if last_modified:
+            last_modified = last_modified.isoformat()
+
+        return BlobState(
+            AzureBlobStorageUtils._encode_md5(blob_props.content_settings.content_md5),
+            etag,
+            last_modified
+        )
+
+
 class AzureBlobStorageUtils:
     """
         Helper class for Azure Storage Functionlity.
     """
     CONN_STR = "DefaultEndpointsProtocol=https;AccountName={};AccountKey={};EndpointSuffix=core.windows.net"
+    GLOB_CHARACTERS = "*?["
 
     def __init__(self, account: str, key: str):
         """
@@ -28,34 +69,228 @@ class AzureBlobStorageUtils:
             self.account_name,
             self.account_key
         )
+        self.blob_service_client = None
+        self.container_clients = {}
+        self.lock = threading.Lock()
+
+    def get_container_client(self, container: str) -> ContainerClient:
+        """
+        Returns a container client for the container, re-using the service
+        client and any container client already created by this instance.
+        """
+        with self.lock:
+            if self.blob_service_client is None:
+                self.blob_service_client = BlobServiceClient.from_connection_string(
+                    self.connection_string,
+                    **RunMetrics.get().get_client_hooks()
+                )
+
+            if container not in self.container_clients:
+                self.container_clients[container] = self.blob_service_client.get_container_client(container)
+
+            return self.container_clients[container]
+
+    def close(self):
+        """
+        Release the clients held by this instance.
+        """
+        with self.lock:
+            if self.blob_service_client is not None:
+                self.blob_service_client.close()
+
+            self.blob_service_client = None
+            self.container_clients = {}
 
     def get_blob_hash(self, blob:str, container:str = None):
         """
         If container is none then parse the blob to get the container 
         from it (first part)
         """
-        blob_hash = None
+        blob_state = self.get_blob_state(blob, container)
+        return blob_state.md5 if blob_state else None
 
-        container, blob = AzureBlobStorageUtils._parse_blob_parts(blob, container)
+    def get_blob_state(self, blob:str, container:str = None) -> BlobState:
+        """
+        Get the hash, ETag and last modified time of a blob. If container is
+        none then parse the blob to get the container from it (first part)
+        """
+        blob_state = None
 
+        container, blob = AzureBlobStorageUtils._parse_blob_parts(blob, container)
 
-        blob_srv_client = BlobServiceClient.from_connection_string(self.connection_string)
-        container_client = blob_srv_client.get_container_client(container)
+        container_client = self.get_container_client(container)
 
         if container_client:
             blob_client = container_client.get_blob_client(blob)
             if blob_client:
-                blob_props = blob_client.get_blob_properties()
-                blob_hash = base64.b64encode(blob_props.content_settings.content_md5)
-                blob_hash = blob_hash.decode('ascii')
+                with RunMetrics.get().measure("blob.properties", self.account_name):
+                    blob_props = blob_client.get_blob_properties()
+                blob_state = BlobState.from_properties(blob_props)
                 
-        return blob_hash
+        return blob_state
+
+    def get_container_hashes(self, container:str, blobs:typing.Iterable[str], name_prefix:str = None) -> typing.Dict[str, str]:
+        """
+        Get the hashes for a set of blobs in a container from the container
+        listing, see get_container_states.
+        """
+        blob_states = self.get_container_states(container, blobs, name_prefix)
+        return {name: blob_states[name].md5 for name in blob_states}
+
+    def get_container_states(self, container:str, blobs:typing.Iterable[str], name_prefix:str = None) -> typing.Dict[str, BlobState]:
+        """
+        Get the hash, ETag and last modified time for a set of blobs in a 
+        container from the container listing, which returns up to 5000 blobs
+        per request, rather than requesting the properties of each blob.
+
+        Params:
+        container - Container the blobs are in
+        blobs - Blob names (without the container) to get states for
+        name_prefix - Optional prefix to narrow the listing, should be common to all blobs
+
+        Returns a dictionary of blob name to state for the blobs found in the 
+        listing, blobs not found are not in the dictionary.
+        """
+        wanted = set(blobs)
+        blob_states = {}
+        if not wanted:
+            return blob_states
+
+        # Listings are in name order, stop once past the last wanted blob
+        last_wanted = max(wanted)
+
+        container_client = self.get_container_client(container)
+        with RunMetrics.get().measure("blob.list", self.account_name):
+            for blob_props in container_client.list_blobs(name_starts_with=name_prefix or None):
+                if blob_props.name in wanted:
+                    blob_states[blob_props.name] = BlobState.from_properties(blob_props)
+                    if len(blob_states) == len(wanted):
+                        break
+
+                if blob_props.name > last_wanted:
+                    break
+
+        return blob_states
+
+    def list_blob_states(self, container:str, name_prefix:str = None, pattern:str = None) -> typing.Dict[str, BlobState]:
+        """
+        Get the hash, ETag and last modified time of every blob in a container
+        listing (up to 5000 blobs per request).
+
+        Params:
+        container - Container to list
+        name_prefix - Optional prefix the blob names start with
+        pattern - Optional glob (fnmatch, * also matches /) the blob names must match
+
+        Returns a dictionary of blob name to state.
+        """
+        blob_states = {}
+
+        container_client = self.get_container_client(container)
+        with RunMetrics.get().measure("blob.list", self.account_name):
+            for blob_props in container_client.list_blobs(name_starts_with=name_prefix or None):
+                if pattern is None or fnmatch.fnmatchcase(blob_props.name, pattern):
+                    blob_states[blob_props.name] = BlobState.from_properties(blob_props)
+
+        return blob_states
+
+    @staticmethod
+    def split_pattern(pattern:str) -> typing.Tuple[str, str, str]:
+        """
+        Split a blob pattern, a container and a prefix (i.e. container/path/)
+        or glob (i.e. container/path/*.bin or container/2021-*/), into the container, the prefix
+        to list and the glob to match (None for a prefix).
+        """
+        container, blob = AzureBlobStorageUtils._parse_blob_parts(pattern)
+        if not container or any([x in container for x in AzureBlobStorageUtils.GLOB_CHARACTERS]):
+            raise Exception("Blob patterns must start with a container name: {}".format(pattern))
+
+        glob_start = min([blob.find(x) for x in AzureBlobStorageUtils.GLOB_CHARACTERS if x in blob], default=-1)
+        if glob_start == -1:
+            return container, blob, None
+
+        # A glob ending in / matches everything under the folders it matches
+        if blob.endswith("/"):
+            blob += "*"
+
+        return container, blob[:glob_start], blob
+
+    def get_content_hash(self, blob:str, container:str = None, algorithm:str = "sha256", chunk_size:int = 4 * 1024 * 1024, max_concurrency:int = 1, limiter:BandwidthLimiter = None) -> str:
+        """
+        Read the blob content and return its base64 encoded digest. The 
+        Content-MD5 property is not always set (blobs uploaded in blocks) and 
+        can be changed by anyone with write access, the content can't.
+
+        Memory is bounded to chunk_size * max_concurrency. With max_concurrency
+        above 1, ranges of large blobs are read in parallel and hashed in order.
+        Every range is read only if the blob still has the ETag it had when
+        the read started, a blob written during the read raises
+        ResourceModifiedError rather than hashing a mix of old and new content.
+
+        Params:
+        blob - Blob, with the container if container is None
+        container - Optional container
+        algorithm - Any hashlib algorithm, i.e. md5 or sha256
+        chunk_size - Bytes read per request
+        max_concurrency - Ranges read at the same time
+        limiter - Optional BandwidthLimiter shared across downloads
+        """
+        container, blob = AzureBlobStorageUtils._parse_blob_parts(blob, container)
+        blob_client = self.get_container_client(container).get_blob_client(blob)
+        digest = hashlib.new(algorithm)
+        metrics = RunMetrics.get()
+
+        with metrics.measure("blob.content", self.account_name):
+            blob_props = blob_client.get_blob_properties()
+            blob_size = blob_props.size
+
+            def read_range(offset):
+                data = blob_client.download_blob(
+                    offset=offset,
+                    length=min(chunk_size, blob_size - offset),
+                    etag=blob_props.etag,
+                    match_condition=MatchConditions.IfNotModified
+                ).readall()
+                if limiter:
+                    limiter.consume(len(data))
+                metrics.add_bytes("blob.content", self.account_name, len(data))
+                return data
+
+            offsets = range(0, blob_size, chunk_size)
+            if max_concurrency <= 1:
+                for offset in offsets:
+                    digest.update(read_range(offset))
+            else:
+                pending = deque()
+                with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                    for offset in offsets:
+                        pending.append(executor.submit(read_range, offset))
+                        if len(pending) >= max_concurrency:
+                            digest.update(pending.popleft().result())
+
+                    while pending:
+                        digest.update(pending.popleft().result())
+
+        return base64.b64encode(digest.digest()).decode('ascii')
+
+    @staticmethod
+    def _encode_md5(content_md5:bytearray) -> str:
+        """
+        Content-MD5 is not set on every blob (i.e. uploaded in blocks), None
+        is returned and the blob can only be validated by its content, see
+        StorageBlobValidationEntry.matches_state
+        """
+        if not content_md5:
+            return None
+        blob_hash = base64.b64encode(content_md5)
+        return blob_hash.decode('ascii')
 
 
     @staticmethod
     def _parse_blob_parts(blob:str, container:str = None ):
-        blob_path = blob.replace("\\", "/")
-        if blob.startswith("/"):
+        # Same rule as KeyScheme.normalize_blob
+        blob = blob.replace("\\", "/")
+        while blob.startswith("/"):
             blob = blob[1:]
 
         if container is None:
@@ -1,45 +1,244 @@
+import time
 import typing
 import datetime
+import threading
+import requests
 from .AzureTableValidationEntry import StorageBlobValidationEntry
-from azure.data.tables import TableServiceClient, TableClient
+from .StorageThrottle import StorageThrottle
+from ..metrics.RunMetrics import RunMetrics
+from azure.data.tables import TableServiceClient, TableClient, UpdateMode, TableErrorCode
 from azure.data.tables._entity import EntityProperty
 from azure.data.tables._deserialize import TablesEntityDatetime
-from azure.core.exceptions import ResourceExistsError
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 
 class AzureTableStoreUtil:
     CONN_STR = "DefaultEndpointsProtocol=https;AccountName={};AccountKey={};EndpointSuffix=core.windows.net"
+    # Service limit on operations in a single transaction
+    MAX_BATCH_SIZE = 100
+    CONNECTION_POOL_SIZE = 32
+    TIMESTAMP_PROPERTY = "Timestamp"
 
-    def __init__(self, account_name:str, account_key:str):
+    def __init__(self, account_name:str, account_key:str, throttle:StorageThrottle = None):
+        """
+        Parameters:
+        account_name - Storage account with the tables
+        account_key - Key for the account
+        throttle - Retries and limits calls to the account, shared with other
+            storage calls of the run if given.
+        """
+        self.account_name = account_name
+        self.throttle = throttle or StorageThrottle()
+        # Tables have their own limits, separate from the account's blobs
+        self.throttle_key = "{}.table".format(account_name)
         self.connection_string = AzureTableStoreUtil.CONN_STR.format(
             account_name,
             account_key
         )
+        self.table_service = None
+        self.table_clients = {}
+        self.known_tables = set()
+        self.lock = threading.RLock()
 
-    def search_industry(self, table_name:str, industry:str):
-        return_records = []
-        with self._get_table_client(table_name) as table_client:
-            results = table_client.list_entities()
-            for result in results:
-                entity_record = {}
-                
-                for key in result:
-                    value = result[key]
-
-                    if isinstance(result[key], EntityProperty): 
-                        value = result[key].value
-                    if isinstance(result[key], TablesEntityDatetime):
-                        value = datetime.datetime.fromisoformat(str(result[key]))
-
-                    entity_record[key] = value
-
-                if "industry" in entity_record and industry in entity_record["industry"]:
-                    return_records.append(
-                        StorageBlobValidationEntry.create_from_record(
-                            table_name,
-                            entity_record)
-                        )
-        
-        return return_records
+    def search_industry(self, table_name:str, industry:str, select:typing.List[str] = None):
+        """
+        Find all records for an industry. The industry filter is applied by the
+        service so only records for the industry are returned.
+
+        Parameters:
+        table_name - Name of table to search
+        industry - Industry to find records for
+        select - Optional list of columns to return, None returns all columns.
+        """
+        return self.query_records(
+            table_name,
+            "industry eq {}".format(AzureTableStoreUtil.odata_string(industry)),
+            select
+        )
+
+    def query_records(self, table_name:str, query_filter:str = None, select:typing.List[str] = None):
+        """
+        Find all records matching an OData filter.
+
+        Parameters:
+        table_name - Name of table to search
+        query_filter - OData filter, None returns every record in the table
+        select - Optional list of columns to return, None returns all columns.
+        """
+        return list(self.iter_records(table_name, query_filter, select))
+
+    def iter_records(self, table_name:str, query_filter:str = None, select:typing.List[str] = None, include:typing.Callable[[dict], bool] = None) -> typing.Iterator[StorageBlobValidationEntry]:
+        """
+        Yields the records matching an OData filter as the service returns
+        them, pages are only requested as the records are used.
+
+        Parameters:
+        table_name - Name of table to search
+        query_filter - OData filter, None returns every record in the table
+        select - Optional list of columns to return, None returns all columns.
+        include - Optional check of each SDK entity, entities it rejects are
+                  dropped before an entry is built for them
+        """
+        # Entries are built directly from the SDK entities, no copy is made
+        for result in self._query_entities(table_name, query_filter, select):
+            if include is None or include(result):
+                yield StorageBlobValidationEntry.create_from_record(table_name, result)
+
+    def query_entity_records(self, table_name:str, query_filter:str = None, select:typing.List[str] = None) -> typing.Iterator[dict]:
+        """
+        Yields a plain dictionary for each entity matching an OData filter, 
+        including the service Timestamp (as the string the service returned)
+        in TIMESTAMP_PROPERTY.
+
+        Parameters:
+        table_name - Name of table to search
+        query_filter - OData filter, None returns every record in the table
+        select - Optional list of columns to return, None returns all columns.
+        """
+        for result in self._query_entities(table_name, query_filter, select):
+            entity_record = AzureTableStoreUtil._get_entity_record(result)
+
+            timestamp = result.metadata.get("timestamp")
+            if isinstance(timestamp, TablesEntityDatetime):
+                entity_record[AzureTableStoreUtil.TIMESTAMP_PROPERTY] = timestamp.tables_service_value
+
+            yield entity_record
+
+    def _query_entities(self, table_name:str, query_filter:str = None, select:typing.List[str] = None) -> typing.Iterator[dict]:
+        """
+        Yields the SDK entities matching an OData filter, nothing if the 
+        table does not exist.
+        """
+        table_client = self._get_table_client(table_name)
+        if table_client is None:
+            return
+
+        if query_filter:
+            results = table_client.query_entities(query_filter, select=select)
+        else:
+            results = table_client.list_entities(select=select)
+
+        # Only the time spent fetching pages is measured, not the time the
+        # caller takes with the records.
+        metrics = RunMetrics.get()
+        try:
+            pages = results.by_page()
+            while True:
+                start = time.perf_counter()
+                # A failed page is requested again with the same continuation
+                page = self.throttle.call(self.throttle_key, lambda: next(pages, None))
+                if page is None:
+                    break
+
+                metrics.record("table.query", self.account_name, start, time.perf_counter())
+                yield from page
+        except ResourceNotFoundError as ex:
+            if not AzureTableStoreUtil._is_table_not_found(ex):
+                raise
+            self._forget_table(table_name)
+            print("WARNING - Table {} not found".format(table_name))
+
+    def get_record(self, table_name:str, partition_key:str, row_key:str) -> StorageBlobValidationEntry:
+        """
+        Point lookup of a single record, None if it does not exist.
+        """
+        table_client = self._get_table_client(table_name)
+        if table_client is None:
+            return None
+
+        def get_entity():
+            with RunMetrics.get().measure("table.get", self.account_name):
+                return table_client.get_entity(partition_key=partition_key, row_key=row_key)
+
+        try:
+            result = self.throttle.call(self.throttle_key, get_entity)
+        except ResourceNotFoundError as ex:
+            if AzureTableStoreUtil._is_table_not_found(ex):
+                self._forget_table(table_name)
+            return None
+
+        return StorageBlobValidationEntry.create_from_record(table_name, result)
+
+    def upsert_batch(self, table_name:str, entities:typing.List[dict], mode:UpdateMode = UpdateMode.MERGE) -> None:
+        """
+        Insert or update entities that all share a PartitionKey, in 
+        transactions of up to MAX_BATCH_SIZE entities. As with add_record
+        existing entities are merged by default.
+        """
+        self._submit_batches(
+            table_name,
+            [("upsert", entity, {"mode" : mode}) for entity in entities]
+        )
+
+    def delete_batch(self, table_name:str, records:typing.List[typing.Tuple[str,str]]) -> None:
+        """
+        Delete records that all share a PartitionKey, in transactions of up
+        to MAX_BATCH_SIZE records.
+
+        Parameters:
+        table_name - name of table
+        records - List of tuples that are (RowKey,PartitionKey)
+        """
+        self._submit_batches(
+            table_name,
+            [("delete", {"PartitionKey" : pair[1], "RowKey" : pair[0]}) for pair in records]
+        )
+
+    def _submit_batches(self, table_name:str, operations:typing.List[tuple]) -> None:
+        for idx in range(0, len(operations), AzureTableStoreUtil.MAX_BATCH_SIZE):
+            batch = operations[idx:idx + AzureTableStoreUtil.MAX_BATCH_SIZE]
+            self._write_table(
+                table_name,
+                lambda table_client: table_client.submit_transaction(batch)
+            )
+
+    def _write_table(self, table_name:str, write:typing.Callable):
+        """
+        Call write with a client for the table, creating the table if needed.
+        If the table was deleted since it was last seen it is created again
+        and the write retried once. Writes the service was too busy for are
+        retried by the throttle.
+        """
+        def attempt_write():
+            with RunMetrics.get().measure("table.write", self.account_name):
+                return write(self._create_table(table_name))
+
+        try:
+            return self.throttle.call(self.throttle_key, attempt_write)
+        except Exception as ex:
+            if not AzureTableStoreUtil._is_table_not_found(ex):
+                raise
+            self._forget_table(table_name)
+            return self.throttle.call(self.throttle_key, attempt_write)
+
+    @staticmethod
+    def _get_entity_record(result) -> dict:
+        """
+        Convert an SDK entity into a plain dictionary of values
+        """
+        entity_record = dict(result)
+        for key, value in entity_record.items():
+            # Our columns are strings, only other values need converting
+            if type(value) is str:
+                continue
+
+            if isinstance(value, EntityProperty): 
+                entity_record[key] = value.value
+            elif isinstance(value, TablesEntityDatetime):
+                entity_record[key] = datetime.datetime(
+                    value.year, value.month, value.day,
+                    value.hour, value.minute, value.second,
+                    value.microsecond, value.tzinfo
+                )
+
+        return entity_record
+
+    @staticmethod
+    def odata_string(value:str) -> str:
+        """
+        Quote a string value for use in an OData filter.
+        """
+        return "'{}'".format(value.replace("'", "''"))
 
 
     def delete_records(self, table_name:str, records:typing.List[typing.Tuple[str,str]]) -> None:
@@ -59,54 +258,116 @@ class AzureTableStoreUtil:
 
     def add_record(self, table_name:str, entity:dict):
         """
-        Add a record to a table
+        Add a record to a table. Busy or failed connections are retried, 
+        any other error is printed and raised so the record is not lost 
+        without the caller knowing.
 
         Parameters:
         table_name - Name of table to add to
         entity - Dictionary of non list/dict data
         """
-        with self._create_table(table_name) as log_table:
+        def write(log_table: TableClient):
             try:
-                resp = log_table.create_entity(entity=entity)
+                return log_table.create_entity(entity=entity)
             except ResourceExistsError as ex:
-                resp = log_table.update_entity(entity=entity)
-            except Exception as ex:
-                print("Unknown table error")
-                print(str(ex))
+                return log_table.update_entity(entity=entity)
+
+        try:
+            self._write_table(table_name, write)
+        except Exception as ex:
+            print("Unknown table error")
+            print(str(ex))
+            raise
 
     def _create_table(self, table_name:str) -> TableClient:
         """
         Ensure a table exists in the table storage 
         """
-        with TableClient.from_connection_string(conn_str=self.connection_string, table_name=table_name) as table_client:
-            try:
-                table_client.create_table()
-            except Exception as ex:
-                pass
-                
-        return self._get_table_client(table_name)
+        with self.lock:
+            if table_name not in self.known_tables:
+                try:
+                    self._get_table_service().create_table(table_name)
+                except ResourceExistsError:
+                    pass
+                self.known_tables.add(table_name)
+
+        return self._get_cached_table_client(table_name)
 
     def _get_table_client(self, table_name: str) ->TableClient:
         """Searches for and returns a table client for the specified
-        table in this account. If not found throws an exception."""
+        table in this account. If not found throws an exception.
+        
+        Tables found are remembered so the service is only searched once
+        per table until _forget_table() is called."""
         return_client = None
 
-        with TableServiceClient.from_connection_string(conn_str=self.connection_string) as table_service:
-            name_filter = "TableName eq '{}'".format(table_name)
-            queried_tables = table_service.query_tables(name_filter)
+        with self.lock:
+            if table_name not in self.known_tables:
+                name_filter = "TableName eq '{}'".format(table_name)
+                queried_tables = self._get_table_service().query_tables(name_filter)
 
-            found_tables = []
-            for table in queried_tables:
-                # Have to do this as its an Item_Paged object
-                if table.name == table_name:
-                    found_tables.append(table)
-                    break 
-        
-            if found_tables and len(found_tables) == 1:
-                return_client = TableClient.from_connection_string(conn_str=self.connection_string, table_name=table_name)
+                for table in queried_tables:
+                    # Have to do this as its an Item_Paged object
+                    if table.name == table_name:
+                        self.known_tables.add(table_name)
+                        break 
+
+            if table_name in self.known_tables:
+                return_client = self._get_cached_table_client(table_name)
             else:
-                return_client = None
                 print("WARNING - Table {} not found".format(table_name))
                 # raise Exception("Table {} not found".format(table_name))
 
-        return return_client  
\ No newline at end of file
+        return return_client  
+
+    def _get_cached_table_client(self, table_name: str) -> TableClient:
+        """
+        Table clients share the service client's transport, so using one in 
+        a with block does not close the connection pool.
+        """
+        with self.lock:
+            if table_name not in self.table_clients:
+                self.table_clients[table_name] = self._get_table_service().get_table_client(table_name)
+            return self.table_clients[table_name]
+
+    def _get_table_service(self) -> TableServiceClient:
+        with self.lock:
+            if self.table_service is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=AzureTableStoreUtil.CONNECTION_POOL_SIZE,
+                    pool_maxsize=AzureTableStoreUtil.CONNECTION_POOL_SIZE
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+
+                self.table_service = TableServiceClient.from_connection_string(
+                    conn_str=self.connection_string,
+                    transport=RequestsTransport(session=session, session_owner=True),
+                    **RunMetrics.get().get_client_hooks()
+                )
+            return self.table_service
+
+    def _forget_table(self, table_name: str) -> None:
+        """
+        Called when the service reports the table does not exist (i.e. it was
+        deleted) so the next call looks for, or creates, it again.
+        """
+        with self.lock:
+            self.known_tables.discard(table_name)
+            self.table_clients.pop(table_name, None)
+
+    @staticmethod
+    def _is_table_not_found(ex: Exception) -> bool:
+        return getattr(ex, "error_code", None) == TableErrorCode.table_not_found
+
+    def close(self) -> None:
+        """
+        Close the connection pool shared by all table clients.
+        """
+        with self.lock:
+            if self.table_service is not None:
+                self.table_service.close()
+            self.table_service = None
+            self.table_clients = {}
+            self.known_tables = set()
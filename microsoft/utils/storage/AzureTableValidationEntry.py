@@ -2,20 +2,29 @@ import json
 import datetime
 
 class ProcessEntry:
+    # Entries are slotted, tables hold hundreds of thousands of them
+    __slots__ = ("table_name", "RowKey", "PartitionKey", "stored_keys")
+
+    # Properties written to the table, everything else is used locally
+    ENTITY_PROPERTIES = ("RowKey", "PartitionKey")
+
     def __init__(self, table_name:str, partition_key:str):
         self.table_name = table_name
         self.RowKey = datetime.datetime.utcnow().isoformat()
         self.PartitionKey = partition_key.replace("/","_")
+        # (PartitionKey, RowKey) the entry was read with, None if not from the table
+        self.stored_keys = None
 
     def get_entity(self):
         """
-        Entity is everyting in self.__dict__ EXCEPT the 
-        table name.
+        Entity is every property in ENTITY_PROPERTIES EXCEPT any 
+        property that is None (not set or not read from the table) 
+        so a merge leaves it untouched.
         """
         entity = {}
-        for prop in self.__dict__:
-            if prop != 'table_name':
-                prop_to_write = self.__dict__[prop] 
+        for prop in self.ENTITY_PROPERTIES:
+            prop_to_write = getattr(self, prop)
+            if prop_to_write is not None:
                 if not isinstance(prop_to_write, str):
                     prop_to_write = json.dumps(prop_to_write)
                 entity[prop] = prop_to_write
@@ -23,6 +32,45 @@ class ProcessEntry:
         return entity
 
 class StorageBlobValidationEntry(ProcessEntry):
+    __slots__ = (
+        "industry",
+        "md5",
+        "account",
+        "subscription",
+        "blob",
+        "actor",
+        "etag",
+        "last_modified",
+        "last_checked",
+        "last_full_check",
+        "content_hash",
+        "content_hash_algorithm",
+        # History is kept as the JSON read from the table until it is used
+        "_history",
+        "_history_raw"
+    )
+
+    # Columns needed to validate a blob, history is only needed to update one.
+    VALIDATION_COLUMNS = [
+        "PartitionKey",
+        "RowKey",
+        "industry",
+        "md5",
+        "account",
+        "subscription",
+        "blob",
+        "actor",
+        "etag",
+        "last_modified",
+        "last_checked",
+        "last_full_check",
+        "content_hash",
+        "content_hash_algorithm"
+    ]
+
+    # History is added to the entity separately
+    ENTITY_PROPERTIES = tuple(VALIDATION_COLUMNS)
+
     def __init__(self, table_name, blob_name):
         super().__init__(table_name, blob_name)
         self.industry = None
@@ -31,21 +79,127 @@ class StorageBlobValidationEntry(ProcessEntry):
         self.subscription = None
         self.blob = blob_name
         self.actor = None
-        self.history = []
+        # Blob version when the hash was recorded and when it was last 
+        # validated, used by incremental validation.
+        self.etag = None
+        self.last_modified = None
+        self.last_checked = None
+        self.last_full_check = None
+        # Digest of the blob content when content verification is used
+        self.content_hash = None
+        self.content_hash_algorithm = None
+        self._history = []
+        self._history_raw = None
+
+    @property
+    def history(self) -> list:
+        """
+        History is decoded from the JSON read from the table the first time
+        it is used. None if history was not read from the table.
+        """
+        if self._history_raw is not None:
+            self._history = json.loads(self._history_raw) if self._history_raw else []
+            self._history_raw = None
+        return self._history
+
+    @history.setter
+    def history(self, value: list):
+        self._history = value
+        self._history_raw = None
+
+    @property
+    def history_loaded(self) -> bool:
+        """
+        True if history was read from the table or set, without decoding it.
+        """
+        return self._history_raw is not None or self._history is not None
+
+    @property
+    def history_decoded(self) -> bool:
+        """
+        True if history has been used (and so may have changed) since it was read.
+        """
+        return self._history_raw is None and self._history is not None
+
+    def get_entity(self):
+        """
+        Adds history to the entity, history that was never decoded is written
+        back as it was read.
+        """
+        entity = super().get_entity()
+
+        if self._history_raw is not None:
+            entity["history"] = self._history_raw
+        elif self._history is not None:
+            entity["history"] = json.dumps(self._history)
+
+        return entity
+
+    def matches_state(self, state) -> bool:
+        """
+        True if a blob's current state (BlobState) matches what was recorded.
+        The Content-MD5 property must match and, if the content was read, so 
+        must the content digest. With no digest recorded yet an MD5 digest 
+        is checked against the recorded Content-MD5.
+
+        A blob without a Content-MD5 (recorded or current) only matches if
+        its content digest was compared, a missing hash is never a match.
+        """
+        if state is None or self.md5 != state.md5:
+            return False
+
+        if state.content_hash is not None:
+            if self.content_hash is not None:
+                return self.content_hash == state.content_hash and \
+                    self.content_hash_algorithm == state.content_hash_algorithm
+
+            if state.content_hash_algorithm == "md5" and self.md5 is not None:
+                return self.md5 == state.content_hash
+
+        # Nothing but the Content-MD5 was compared
+        return self.md5 is not None
 
     @staticmethod
     def create_from_record(table:str, settings:dict) -> object:
-        return_val = StorageBlobValidationEntry(table, settings["blob"])
-        return_val.RowKey = settings["RowKey"]
-        return_val.industry = settings["industry"]
-        return_val.md5 = settings["md5"]
-        return_val.account = settings["account"]
-        return_val.subscription = settings["subscription"]
-        return_val.blob = settings["blob"]
-        return_val.actor = settings["actor"]
-
-        return_val.history = settings["history"]
-        if return_val.history:
-            return_val.history = json.loads(return_val.history)
+        """
+        Create an entry from a table record, either a plain dictionary or the
+        entity returned by the SDK which is read directly without copying it.
+
+        Parameters:
+        table - Table the record was read from
+        settings - Record, columns that were not selected are None
+        """
+        # Skip the constructor, every slot is set from the record
+        return_val = StorageBlobValidationEntry.__new__(StorageBlobValidationEntry)
+        return_val.table_name = table
+
+        get = settings.get
+        return_val.blob = StorageBlobValidationEntry._get_value(settings["blob"])
+        return_val.RowKey = StorageBlobValidationEntry._get_value(settings["RowKey"])
+        partition_key = get("PartitionKey")
+        if partition_key is None:
+            partition_key = return_val.blob.replace("/","_")
+        return_val.PartitionKey = StorageBlobValidationEntry._get_value(partition_key)
+        return_val.stored_keys = (return_val.PartitionKey, return_val.RowKey)
+
+        # Keys were set above
+        for column in StorageBlobValidationEntry.VALIDATION_COLUMNS[2:]:
+            value = get(column)
+            if value is not None and type(value) is not str:
+                value = StorageBlobValidationEntry._get_value(value)
+            setattr(return_val, column, value)
+
+        # History is None when it was not selected in the query, otherwise
+        # it is decoded when first used.
+        return_val._history = None
+        return_val._history_raw = get("history")
 
         return return_val
+
+    @staticmethod
+    def _get_value(value):
+        """
+        Values the SDK wraps (i.e. 64 bit integers) are unwrapped, our 
+        columns are all strings so this is rarely needed.
+        """
+        return getattr(value, "value", value) if type(value) is not str else value
@@ -0,0 +1,41 @@
+import time
+import threading
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by every download so that, together, they do not
+    read more than bytes_per_second. A limit of None or 0 is unlimited.
+    """
+    def __init__(self, bytes_per_second: float = None):
+        self.bytes_per_second = bytes_per_second
+        self.available = bytes_per_second or 0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_megabytes(megabytes_per_second: float = None):
+        if not megabytes_per_second:
+            return BandwidthLimiter()
+        return BandwidthLimiter(megabytes_per_second * 1024 * 1024)
+
+    def consume(self, byte_count: int) -> None:
+        """
+        Account for bytes read, sleeping until the bucket has caught up if 
+        they take it past the limit.
+        """
+        if not self.bytes_per_second:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(
+                self.bytes_per_second,
+                self.available + (now - self.last_refill) * self.bytes_per_second
+            )
+            self.last_refill = now
+            self.available -= byte_count
+            wait = -self.available / self.bytes_per_second if self.available < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
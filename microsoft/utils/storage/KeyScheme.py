@@ -0,0 +1,136 @@
+import typing
+from .AzureTableStorage import AzureTableStoreUtil
+
+
+class KeyScheme:
+    """
+    Decides the PartitionKey and RowKey used for a validation entry.
+
+    blob             - (default) PartitionKey is the blob path, RowKey is the time 
+                       the entry was created. Finding an industry or blob needs
+                       a table scan.
+    industry         - PartitionKey is the industry, RowKey is account|blob
+    industry_account - PartitionKey is industry|account, RowKey is the blob
+
+    With either of the industry layouts an industry query only reads the
+    industry partition(s) and a single blob is a point lookup.
+    """
+    BLOB = "blob"
+    INDUSTRY = "industry"
+    INDUSTRY_ACCOUNT = "industry_account"
+    SCHEMES = [BLOB, INDUSTRY, INDUSTRY_ACCOUNT]
+
+    SEPARATOR = "|"
+    # Service limit on comparisons in a single filter
+    MAX_FILTER_COMPARISONS = 15
+    # Characters not allowed in keys, % is escaped so the escaping can't collide.
+    ESCAPED_CHARACTERS = {
+        "%" : "%25",
+        "/" : "%2F",
+        "\\" : "%5C",
+        "#" : "%23",
+        "?" : "%3F",
+        "|" : "%7C"
+    }
+
+    def __init__(self, scheme: str = BLOB):
+        if scheme not in KeyScheme.SCHEMES:
+            raise Exception("Unknown key scheme {}, expected one of {}".format(scheme, KeyScheme.SCHEMES))
+        self.scheme = scheme
+
+    @property
+    def is_legacy(self) -> bool:
+        return self.scheme == KeyScheme.BLOB
+
+    def get_keys(self, industry: str, account: str, blob: str) -> typing.Tuple[str, str]:
+        """
+        Returns (PartitionKey, RowKey) for a blob, not valid for the blob scheme
+        as the RowKey there is a timestamp.
+        """
+        if self.is_legacy:
+            raise Exception("Keys are not derived from the entry with the blob key scheme")
+
+        industry = KeyScheme.escape_key(industry)
+        account = KeyScheme.escape_key(account)
+        blob = KeyScheme.escape_key(KeyScheme.normalize_blob(blob))
+
+        if self.scheme == KeyScheme.INDUSTRY:
+            return industry, KeyScheme.SEPARATOR.join([account, blob])
+
+        return KeyScheme.SEPARATOR.join([industry, account]), blob
+
+    def apply(self, entry) -> bool:
+        """
+        Set the keys on an entry for this scheme, returns True if they changed.
+        """
+        if self.is_legacy:
+            return False
+
+        partition_key, row_key = self.get_keys(entry.industry, entry.account, entry.blob)
+        changed = entry.PartitionKey != partition_key or entry.RowKey != row_key
+
+        entry.PartitionKey = partition_key
+        entry.RowKey = row_key
+        return changed
+
+    def is_current(self, entry) -> bool:
+        """
+        True if the entry is already stored with this scheme's keys.
+        """
+        if self.is_legacy:
+            return True
+
+        return (entry.PartitionKey, entry.RowKey) == self.get_keys(entry.industry, entry.account, entry.blob)
+
+    def industry_filter(self, industry: str) -> str:
+        """
+        OData filter that finds all records for an industry.
+        """
+        if self.scheme == KeyScheme.INDUSTRY:
+            return "PartitionKey eq {}".format(
+                AzureTableStoreUtil.odata_string(KeyScheme.escape_key(industry))
+            )
+
+        if self.scheme == KeyScheme.INDUSTRY_ACCOUNT:
+            # All partitions starting with industry|
+            prefix = KeyScheme.escape_key(industry) + KeyScheme.SEPARATOR
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            return "PartitionKey ge {} and PartitionKey lt {}".format(
+                AzureTableStoreUtil.odata_string(prefix),
+                AzureTableStoreUtil.odata_string(upper)
+            )
+
+        return "industry eq {}".format(AzureTableStoreUtil.odata_string(industry))
+
+    def industries_filter(self, industries: typing.List[str]) -> str:
+        """
+        OData filter that finds all records for any of the industries, None
+        if it would need more comparisons than the service allows, in which
+        case the whole table has to be read and the records filtered locally.
+        """
+        filters = [self.industry_filter(industry) for industry in industries]
+        if len(filters) == 1:
+            return filters[0]
+
+        # Partition ranges take two comparisons
+        comparisons_per_industry = 2 if self.scheme == KeyScheme.INDUSTRY_ACCOUNT else 1
+        if len(filters) * comparisons_per_industry > KeyScheme.MAX_FILTER_COMPARISONS:
+            return None
+
+        return " or ".join(["({})".format(query_filter) for query_filter in filters])
+
+    @staticmethod
+    def normalize_blob(blob: str) -> str:
+        """
+        Blob paths are container/path, the same blob may be recorded with
+        back slashes or a leading slash.
+        """
+        blob = blob.replace("\\", "/")
+        while blob.startswith("/"):
+            blob = blob[1:]
+        return blob
+
+    @staticmethod
+    def escape_key(value: str) -> str:
+        value = "" if value is None else value
+        return "".join([KeyScheme.ESCAPED_CHARACTERS.get(c, c) for c in value if ord(c) >= 0x20])
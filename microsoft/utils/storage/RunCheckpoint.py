@@ -0,0 +1,185 @@
+import os
+import json
+import sqlite3
+import datetime
+import threading
+import typing
+
+
+class RunCheckpoint:
+    """
+    Local SQLite journal of a long running validate, rebase or ingest so an
+    interrupted run can be resumed.
+
+    The journal holds the keys of the blobs that are done and the table
+    writes that were queued but not yet written. A blob is marked done after
+    its write is queued, and the write is only removed from the journal
+    once the table has it, so on resume the pending writes are replayed and
+    the blobs that are done are skipped.
+
+    Changes are committed every commit_every operations, and when commit()
+    is called, anything not committed when the process dies is done again.
+    """
+    DEFAULT_COMMIT_EVERY = 500
+
+    def __init__(self, path: str, run_key: str, resume: bool = False, commit_every: int = DEFAULT_COMMIT_EVERY):
+        """
+        Parameters:
+        path - Journal file
+        run_key - Description of the run (action and what it runs on), a
+            journal can only be resumed by the same run
+        resume - Continue the run in the journal instead of starting again
+        commit_every - Operations between commits
+        """
+        self.path = path
+        self.run_key = run_key
+        self.commit_every = max(1, commit_every)
+        self.uncommitted = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS run (
+                    run_key TEXT NOT NULL,
+                    started TEXT)"""
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS completed (key TEXT PRIMARY KEY)"
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS pending (
+                    table_name TEXT NOT NULL,
+                    partition_key TEXT NOT NULL,
+                    row_key TEXT NOT NULL,
+                    entity TEXT NOT NULL,
+                    replaces TEXT,
+                    PRIMARY KEY (table_name, partition_key, row_key))"""
+            )
+
+            row = self.connection.execute("SELECT run_key, started FROM run").fetchone()
+
+            if resume and row is None:
+                print("WARNING - Nothing to resume in", path, "starting a new run")
+            elif resume and row[0] != run_key:
+                raise Exception("Checkpoint {} is for '{}' not '{}'".format(path, row[0], run_key))
+
+            if not resume or row is None:
+                self.connection.execute("DELETE FROM run")
+                self.connection.execute("DELETE FROM completed")
+                self.connection.execute("DELETE FROM pending")
+                self.connection.execute(
+                    "INSERT INTO run (run_key, started) VALUES (?, ?)",
+                    (run_key, datetime.datetime.utcnow().isoformat())
+                )
+
+            self.completed = set([x[0] for x in self.connection.execute("SELECT key FROM completed")])
+
+    @staticmethod
+    def get_key(account: str, blob: str) -> str:
+        return "{}|{}".format(account, blob)
+
+    def is_completed(self, key: str) -> bool:
+        """
+        True if the blob was done by an earlier attempt of the run, counted
+        in skipped.
+        """
+        with self.lock:
+            if key in self.completed:
+                self.skipped += 1
+                return True
+            return False
+
+    def complete(self, key: str) -> None:
+        """
+        Mark a blob done, any write for it must already be queued.
+        """
+        with self.lock:
+            self.completed.add(key)
+            self.connection.execute("INSERT OR IGNORE INTO completed (key) VALUES (?)", (key,))
+            self._count_operation()
+
+    def add_pending(self, table_name: str, entity: dict, replaces: typing.Tuple[str, str] = None) -> None:
+        """
+        Journal a table write that has been queued.
+        """
+        with self.lock:
+            self.connection.execute(
+                """INSERT OR REPLACE INTO pending
+                    (table_name, partition_key, row_key, entity, replaces)
+                    VALUES (?, ?, ?, ?, ?)""",
+                (
+                    table_name,
+                    entity["PartitionKey"],
+                    entity["RowKey"],
+                    json.dumps(entity, default=str),
+                    json.dumps(list(replaces)) if replaces else None
+                )
+            )
+            self._count_operation()
+
+    def remove_pending(self, table_name: str, entities: typing.List[dict]) -> None:
+        """
+        Forget table writes that have been written, use as the write
+        buffer's on_written callback.
+        """
+        with self.lock:
+            if self.connection is None:
+                return
+            self.connection.executemany(
+                "DELETE FROM pending WHERE table_name = ? AND partition_key = ? AND row_key = ?",
+                [(table_name, x["PartitionKey"], x["RowKey"]) for x in entities]
+            )
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def get_pending(self) -> typing.List[typing.Tuple[str, dict, typing.Tuple[str, str]]]:
+        """
+        Returns (table, entity, replaced keys) for every write not known to
+        have been written.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT table_name, entity, replaces FROM pending ORDER BY table_name, partition_key, row_key"
+            ).fetchall()
+
+        return [
+            (row[0], json.loads(row[1]), tuple(json.loads(row[2])) if row[2] else None)
+            for row in rows
+        ]
+
+    def pending_count(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def commit(self) -> None:
+        with self.lock:
+            if self.connection is None:
+                return
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def finish(self) -> bool:
+        """
+        Remove the journal if every write has been made, otherwise keep it
+        so the run can be resumed. Returns True if it was removed.
+        """
+        self.commit()
+        pending = self.pending_count()
+        if pending:
+            print("WARNING - {} table writes were not made, run again with -resume to retry them".format(pending))
+            return False
+
+        with self.lock:
+            self.connection.close()
+            self.connection = None
+        os.remove(self.path)
+        return True
+
+    def _count_operation(self):
+        # Called with the lock held
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.connection.commit()
+            self.uncommitted = 0
@@ -0,0 +1,188 @@
+import json
+import sqlite3
+import threading
+import typing
+
+
+class SnapshotCache:
+    """
+    Local SQLite copy of validation table records, so repeated runs only
+    download the records that changed since the last run.
+
+    Records are stored per table with their industry and the service 
+    Timestamp. The newest Timestamp seen for a (table, industry) is kept as
+    the point to sync from next time. Rows deleted in the table by another
+    process are only noticed when the industry is refreshed with clear().
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS records (
+                    table_name TEXT NOT NULL,
+                    partition_key TEXT NOT NULL,
+                    row_key TEXT NOT NULL,
+                    industry TEXT,
+                    timestamp TEXT,
+                    entity TEXT NOT NULL,
+                    PRIMARY KEY (table_name, partition_key, row_key))"""
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS records_industry ON records (table_name, industry)"
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS sync_state (
+                    table_name TEXT NOT NULL,
+                    industry TEXT NOT NULL,
+                    last_sync TEXT,
+                    PRIMARY KEY (table_name, industry))"""
+            )
+
+    def get_last_sync(self, table_name: str, industry: str) -> str:
+        """
+        Service Timestamp of the newest record synced for the industry, None 
+        if it has never been synced.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT last_sync FROM sync_state WHERE table_name = ? AND industry = ?",
+                (table_name, industry)
+            ).fetchone()
+        return row[0] if row else None
+
+    def sync(self, table_name: str, industry: str, entity_records: typing.Iterable[dict], timestamp_property: str) -> int:
+        """
+        Store the records returned by the service for an industry and move
+        the sync point to the newest Timestamp among them.
+
+        Returns the number of records stored.
+        """
+        last_sync = self.get_last_sync(table_name, industry)
+        count = 0
+
+        with self.lock, self.connection:
+            for entity_record in entity_records:
+                timestamp = entity_record.pop(timestamp_property, None)
+                self._put(table_name, entity_record, timestamp)
+                count += 1
+
+                # Service timestamps are fixed width ISO strings, compare as text
+                if timestamp and (last_sync is None or timestamp > last_sync):
+                    last_sync = timestamp
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sync_state (table_name, industry, last_sync) VALUES (?, ?, ?)",
+                (table_name, industry, last_sync)
+            )
+
+        return count
+
+    PAGE_SIZE = 1000
+
+    def get_records(self, table_name: str, industry: str) -> typing.List[dict]:
+        return list(self.iter_records(table_name, industry))
+
+    def iter_records(self, table_name: str, industry: str, page_size: int = PAGE_SIZE) -> typing.Iterator[dict]:
+        """
+        Yields the records for an industry in key order, reading a page at a
+        time. Each page continues after the last key read, so records written
+        through while iterating do not upset the iteration.
+        """
+        last_keys = None
+        while True:
+            with self.lock:
+                if last_keys is None:
+                    rows = self.connection.execute(
+                        """SELECT partition_key, row_key, entity FROM records 
+                        WHERE table_name = ? AND industry = ? 
+                        ORDER BY partition_key, row_key LIMIT ?""",
+                        (table_name, industry, page_size)
+                    ).fetchall()
+                else:
+                    rows = self.connection.execute(
+                        """SELECT partition_key, row_key, entity FROM records 
+                        WHERE table_name = ? AND industry = ? 
+                        AND (partition_key > ? OR (partition_key = ? AND row_key > ?))
+                        ORDER BY partition_key, row_key LIMIT ?""",
+                        (table_name, industry, last_keys[0], last_keys[0], last_keys[1], page_size)
+                    ).fetchall()
+
+            for row in rows:
+                yield json.loads(row[2])
+
+            if len(rows) < page_size:
+                return
+            last_keys = (rows[-1][0], rows[-1][1])
+
+    def merge(self, table_name: str, entity: dict, replaces: typing.Tuple[str, str] = None) -> None:
+        """
+        Write through a record being written to the table. Like the table 
+        write, properties are merged into any record already stored, and the
+        record it replaces (PartitionKey, RowKey) is removed.
+        """
+        with self.lock, self.connection:
+            existing = self.connection.execute(
+                "SELECT entity, timestamp FROM records WHERE table_name = ? AND partition_key = ? AND row_key = ?",
+                (table_name, entity["PartitionKey"], entity["RowKey"])
+            ).fetchone()
+
+            timestamp = None
+            merged = dict(entity)
+            if existing:
+                merged = json.loads(existing[0])
+                merged.update(entity)
+                timestamp = existing[1]
+
+            self._put(table_name, merged, timestamp)
+
+            if replaces and tuple(replaces) != (entity["PartitionKey"], entity["RowKey"]):
+                self._delete(table_name, replaces[0], replaces[1])
+
+    def delete(self, table_name: str, partition_key: str, row_key: str) -> None:
+        with self.lock, self.connection:
+            self._delete(table_name, partition_key, row_key)
+
+    def clear(self, table_name: str, industry: str = None) -> None:
+        """
+        Forget the records (and sync point) for an industry, or the whole
+        table, so the next sync downloads them all again.
+        """
+        with self.lock, self.connection:
+            if industry is None:
+                self.connection.execute("DELETE FROM records WHERE table_name = ?", (table_name,))
+                self.connection.execute("DELETE FROM sync_state WHERE table_name = ?", (table_name,))
+            else:
+                self.connection.execute(
+                    "DELETE FROM records WHERE table_name = ? AND industry = ?", (table_name, industry)
+                )
+                self.connection.execute(
+                    "DELETE FROM sync_state WHERE table_name = ? AND industry = ?", (table_name, industry)
+                )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+    def _put(self, table_name: str, entity_record: dict, timestamp: str):
+        self.connection.execute(
+            """INSERT OR REPLACE INTO records 
+                (table_name, partition_key, row_key, industry, timestamp, entity) 
+                VALUES (?, ?, ?, ?, ?, ?)""",
+            (
+                table_name,
+                entity_record["PartitionKey"],
+                entity_record["RowKey"],
+                entity_record.get("industry"),
+                timestamp,
+                json.dumps(entity_record, default=str)
+            )
+        )
+
+    def _delete(self, table_name: str, partition_key: str, row_key: str):
+        self.connection.execute(
+            "DELETE FROM records WHERE table_name = ? AND partition_key = ? AND row_key = ?",
+            (table_name, partition_key, row_key)
+        )
@@ -0,0 +1,127 @@
+import time
+import threading
+import typing
+from .AzCliStorage import AzCliStorageUtil, AzStorageAccount
+from .AzureBlobStorage import AzureBlobStorageUtils
+
+
+class CachedStorageAccount:
+    """
+    A resolved storage account (name/keys) along with the blob utility,
+    and the clients it holds, that were created from those keys.
+    """
+    def __init__(self, account: AzStorageAccount, create_blob_utils: typing.Callable = AzureBlobStorageUtils):
+        self.account = account
+        self.blob_utils = create_blob_utils(account.name, account.keys[0])
+        self.created = time.monotonic()
+
+    def expired(self, ttl_seconds: int) -> bool:
+        if ttl_seconds is None or ttl_seconds <= 0:
+            return False
+        return (time.monotonic() - self.created) > ttl_seconds
+
+
+class StorageAccountCache:
+    """
+    Cache of storage account keys and blob clients keyed on (account, subscription).
+
+    Resolving keys requires a call to the az cli or management API, so 
+    resolve each account once and reuse the keys and clients until the TTL 
+    expires or refresh() is called (i.e. keys were rotated and authentication
+    failed).
+
+    Keys are resolved under a lock for the account alone, so only callers
+    for that account wait on the lookup. A replaced entry's clients are not
+    closed as other threads may still be using them, they are released
+    once the last call using them is done.
+
+    get_storage_account resolves keys for (account, subscription), it
+    defaults to the az cli. create_blob_utils creates the blob utility from
+    (account name, key), it defaults to AzureBlobStorageUtils.
+    """
+    DEFAULT_TTL_SECONDS = 3600
+
+    def __init__(self, ttl_seconds: int = DEFAULT_TTL_SECONDS, get_storage_account: typing.Callable = None, create_blob_utils: typing.Callable = None):
+        self.ttl_seconds = ttl_seconds
+        self.get_storage_account = get_storage_account or AzCliStorageUtil.get_storage_account
+        self.create_blob_utils = create_blob_utils or AzureBlobStorageUtils
+        self.accounts: typing.Dict[typing.Tuple[str, str], CachedStorageAccount] = {}
+        # (account, subscription) -> lock held while its keys are resolved
+        self.account_locks: typing.Dict[typing.Tuple[str, str], threading.Lock] = {}
+        self.lock = threading.RLock()
+
+    def get_account(self, account: str, subscription: str) -> CachedStorageAccount:
+        cache_key = (account, subscription)
+
+        with self.lock:
+            cached = self.accounts.get(cache_key)
+        if cached is not None and not cached.expired(self.ttl_seconds):
+            return cached
+
+        with self._get_account_lock(cache_key):
+            # Another caller may have resolved the keys while this one waited
+            with self.lock:
+                cached = self.accounts.get(cache_key)
+            if cached is not None and not cached.expired(self.ttl_seconds):
+                return cached
+
+            return self._resolve(cache_key)
+
+    def refresh(self, account: str, subscription: str, replaced: CachedStorageAccount = None) -> CachedStorageAccount:
+        """
+        Resolve the keys again and replace anything held for the account. 
+
+        Parameters:
+        replaced - The entry a failed call used. If the account's entry is
+            no longer that one (another caller already refreshed it) the 
+            current entry is returned without resolving the keys again.
+        """
+        cache_key = (account, subscription)
+
+        with self._get_account_lock(cache_key):
+            if replaced is not None:
+                with self.lock:
+                    cached = self.accounts.get(cache_key)
+                if cached is not None and cached is not replaced:
+                    return cached
+
+            return self._resolve(cache_key)
+
+    def invalidate(self, account: str, subscription: str) -> None:
+        """
+        Drop the account's entry, calls already using its clients finish
+        with them.
+        """
+        with self.lock:
+            self.accounts.pop((account, subscription), None)
+
+    def clear(self) -> None:
+        """
+        Drop every entry and close their clients, only call this once no
+        requests are being made.
+        """
+        with self.lock:
+            cached_accounts = list(self.accounts.values())
+            self.accounts = {}
+
+        for cached in cached_accounts:
+            cached.blob_utils.close()
+
+    def _get_account_lock(self, cache_key: typing.Tuple[str, str]) -> threading.Lock:
+        with self.lock:
+            return self.account_locks.setdefault(cache_key, threading.Lock())
+
+    def _resolve(self, cache_key: typing.Tuple[str, str]) -> CachedStorageAccount:
+        """
+        Look up the keys, called holding the account's lock but not the
+        cache lock so other accounts are not held up.
+        """
+        cached = CachedStorageAccount(
+            self.get_storage_account(*cache_key),
+            self.create_blob_utils
+        )
+
+        with self.lock:
+            self.accounts[cache_key] = cached
+
+        return cached
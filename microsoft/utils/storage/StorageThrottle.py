@@ -0,0 +1,136 @@
+import time
+import random
+import threading
+import typing
+from .BandwidthLimiter import BandwidthLimiter
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+
+
+class AccountThrottle:
+    """
+    Concurrency limit for one account (and service) that adapts to how the
+    service is coping: additive increase, multiplicative decrease (AIMD).
+    Each successful call grows the limit by 1/limit, so by about one per
+    round of calls, and a throttled call halves it. Only calls started after
+    the last decrease can halve it again, so a burst of throttled calls that
+    were all in flight together only counts once.
+
+    An optional token bucket limits the requests started per second.
+    """
+    def __init__(self, max_concurrency: int, requests_per_second: float = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.active = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+        # Same bucket as for bytes, one token per request
+        self.rate_limiter = BandwidthLimiter(requests_per_second)
+
+    def acquire(self) -> float:
+        """
+        Wait for a slot, returns when the call started to pass to release().
+        """
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+        self.rate_limiter.consume(1)
+        return time.monotonic()
+
+    def release(self, started: float, throttled: bool = False) -> None:
+        with self.condition:
+            self.active -= 1
+
+            if throttled:
+                if started >= self.last_decrease:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = time.monotonic()
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+
+class StorageThrottle:
+    """
+    Retries storage calls that failed because the service was busy or the
+    connection failed, with exponential backoff and full jitter, and limits
+    the calls made at once against each account with an AccountThrottle.
+
+    Shared by the table and blob calls of a run so every call to the same
+    account backs off together. The SDK clients retry on their own first,
+    this layer handles what is left once they give up.
+    """
+    THROTTLE_STATUS = [429, 503]
+    RETRY_STATUS = [408, 429, 500, 502, 503, 504]
+    DEFAULT_MAX_CONCURRENCY = 32
+    DEFAULT_ATTEMPTS = 5
+    DEFAULT_BASE_SECONDS = 0.5
+    DEFAULT_MAX_SECONDS = 30
+
+    def __init__(self, max_concurrency: int = DEFAULT_MAX_CONCURRENCY, attempts: int = DEFAULT_ATTEMPTS, base_seconds: float = DEFAULT_BASE_SECONDS, max_seconds: float = DEFAULT_MAX_SECONDS, requests_per_second: float = None):
+        """
+        Parameters:
+        max_concurrency - Most calls made against one account at once
+        attempts - Times a call is made before its error is raised
+        base_seconds - Backoff before the first retry, doubled for each retry
+        max_seconds - Longest backoff
+        requests_per_second - Optional limit on calls started per account
+        """
+        self.max_concurrency = max_concurrency
+        self.attempts = max(1, attempts)
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.requests_per_second = requests_per_second
+        self.accounts: typing.Dict[str, AccountThrottle] = {}
+        self.lock = threading.Lock()
+
+    def get_account(self, account: str) -> AccountThrottle:
+        with self.lock:
+            if account not in self.accounts:
+                self.accounts[account] = AccountThrottle(self.max_concurrency, self.requests_per_second)
+            return self.accounts[account]
+
+    def call(self, account: str, call: typing.Callable):
+        """
+        Make a call against an account, retrying it if it fails with an
+        error the service says can be retried.
+
+        Parameters:
+        account - Account (or account and service) the call is made against
+        call - Callable with no arguments making the call
+        """
+        account_throttle = self.get_account(account)
+        attempt = 1
+
+        while True:
+            started = account_throttle.acquire()
+            throttled = False
+            try:
+                return call()
+            except Exception as ex:
+                throttled = StorageThrottle.is_throttled(ex)
+                if attempt >= self.attempts or not StorageThrottle.is_retryable(ex):
+                    raise
+            finally:
+                account_throttle.release(started, throttled)
+
+            time.sleep(self.get_backoff(attempt))
+            attempt += 1
+
+    def get_backoff(self, attempt: int) -> float:
+        """
+        Full jitter, anywhere up to the exponential backoff for the attempt
+        """
+        return random.uniform(0, min(self.max_seconds, self.base_seconds * (2 ** (attempt - 1))))
+
+    @staticmethod
+    def is_throttled(ex: Exception) -> bool:
+        return getattr(ex, "status_code", None) in StorageThrottle.THROTTLE_STATUS
+
+    @staticmethod
+    def is_retryable(ex: Exception) -> bool:
+        if isinstance(ex, (ServiceRequestError, ServiceResponseError)):
+            return True
+        return isinstance(ex, HttpResponseError) and ex.status_code in StorageThrottle.RETRY_STATUS
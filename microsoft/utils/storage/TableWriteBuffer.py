@@ -0,0 +1,186 @@
+import time
+import threading
+import typing
+from azure.data.tables import TableTransactionError, RequestTooLargeError
+from .AzureTableStorage import AzureTableStoreUtil
+
+
+class TableWriteFailure:
+    """
+    An entity that could not be written and the reason why.
+    """
+    def __init__(self, table_name: str, entity: dict, error: Exception):
+        self.table_name = table_name
+        self.entity = entity
+        self.error = error
+
+    def __str__(self):
+        return "{} {}/{} - {}".format(
+            self.table_name,
+            self.entity.get("PartitionKey"),
+            self.entity.get("RowKey"),
+            str(self.error).splitlines()[0] if str(self.error) else type(self.error).__name__
+        )
+
+
+class TableWriteBuffer:
+    """
+    Collects upserts per (table, PartitionKey) and writes them as transactions
+    of up to max_batch_size operations.
+
+    A partition is written as soon as it is full, everything is written when
+    flush_seconds have passed since the last full flush or flush() is called.
+    Failed writes are kept until flush() is called, which returns them.
+
+    Batching only saves requests when records share partitions (the industry
+    and industry_account key schemes). With the blob key scheme every blob
+    is its own partition and each transaction holds a single record.
+
+    An upsert can name the keys of a row it replaces (the record moved to new 
+    keys), that row is only deleted once the upsert has been written.
+
+    on_written, if set, is called with the table and entities of each
+    transaction that was written.
+    """
+    def __init__(self, table_store: AzureTableStoreUtil, max_batch_size: int = AzureTableStoreUtil.MAX_BATCH_SIZE, flush_seconds: float = 30):
+        self.table_store = table_store
+        self.max_batch_size = max(1, min(max_batch_size, AzureTableStoreUtil.MAX_BATCH_SIZE))
+        self.flush_seconds = flush_seconds
+        # (table, PartitionKey) -> {RowKey : (entity, [replaced (PartitionKey, RowKey)])}
+        self.pending_upserts: typing.Dict[typing.Tuple[str, str], typing.Dict[str, tuple]] = {}
+        # (table, PartitionKey) -> [(RowKey, PartitionKey)]
+        self.pending_deletes: typing.Dict[typing.Tuple[str, str], list] = {}
+        self.failures: typing.List[TableWriteFailure] = []
+        self.written = 0
+        self.requests = 0
+        self.last_flush = time.monotonic()
+        self.on_written: typing.Callable[[str, typing.List[dict]], None] = None
+        self.lock = threading.RLock()
+
+    def upsert(self, table_name: str, entity: dict, replaces: typing.Tuple[str, str] = None) -> None:
+        """
+        Queue an insert or merge of an entity.
+
+        Parameters:
+        table_name - Table to write to
+        entity - Entity to write
+        replaces - Optional (PartitionKey, RowKey) of a row to delete once the entity is written
+        """
+        with self.lock:
+            partition = (table_name, entity["PartitionKey"])
+            pending = self.pending_upserts.setdefault(partition, {})
+
+            # A transaction may only touch an entity once, last write wins but
+            # any rows replaced by the earlier write still need removing.
+            replaced = pending[entity["RowKey"]][1] if entity["RowKey"] in pending else []
+            if replaces and replaces != (entity["PartitionKey"], entity["RowKey"]):
+                replaced = replaced + [replaces]
+            pending[entity["RowKey"]] = (entity, replaced)
+
+            if len(self.pending_upserts[partition]) >= self.max_batch_size:
+                self._flush_upserts(partition)
+
+            if self.flush_seconds is not None and (time.monotonic() - self.last_flush) >= self.flush_seconds:
+                # Failures are kept for the caller's next flush()
+                self._flush_all()
+
+    def pending_count(self) -> int:
+        with self.lock:
+            return sum([len(x) for x in self.pending_upserts.values()]) + \
+                sum([len(x) for x in self.pending_deletes.values()])
+
+    def flush(self) -> typing.List[TableWriteFailure]:
+        """
+        Write everything that is pending, returns the failures since the 
+        last time flush was called.
+        """
+        with self.lock:
+            self._flush_all()
+
+            failures = self.failures
+            self.failures = []
+            return failures
+
+    def _flush_all(self):
+        for partition in list(self.pending_upserts.keys()):
+            self._flush_upserts(partition)
+
+        for partition in list(self.pending_deletes.keys()):
+            self._flush_deletes(partition)
+
+        self.last_flush = time.monotonic()
+
+    @staticmethod
+    def get_failed_index(ex: TableTransactionError, count: int) -> int:
+        """
+        Index of the operation that failed a transaction, None if the error
+        applies to the whole transaction. The service starts the message 
+        with the index when a single operation failed, the SDK reports 0 
+        when there is no index so it is read from the message here.
+        """
+        if isinstance(ex, RequestTooLargeError):
+            return None
+
+        message = getattr(ex, "message", None) or str(ex)
+        try:
+            index = int(message.split(":", 1)[0])
+        except ValueError:
+            return None
+
+        return index if 0 <= index < count else None
+
+    def _flush_upserts(self, partition: typing.Tuple[str, str]):
+        """
+        Write a partition's upserts. If the transaction fails because of 
+        a single entity, that entity is recorded as a failure and the rest 
+        are sent again. If it fails as a whole every entity is a failure.
+        """
+        pending = list(self.pending_upserts.pop(partition, {}).values())
+
+        while pending:
+            try:
+                self.requests += 1
+                self.table_store.upsert_batch(partition[0], [x[0] for x in pending])
+                self.written += len(pending)
+                if self.on_written is not None:
+                    self.on_written(partition[0], [x[0] for x in pending])
+            except TableTransactionError as ex:
+                failed_index = TableWriteBuffer.get_failed_index(ex, len(pending))
+                if failed_index is not None:
+                    self.failures.append(TableWriteFailure(partition[0], pending[failed_index][0], ex))
+                    del pending[failed_index]
+                    continue
+
+                for entity, replaced in pending:
+                    self.failures.append(TableWriteFailure(partition[0], entity, ex))
+                break
+            except Exception as ex:
+                for entity, replaced in pending:
+                    self.failures.append(TableWriteFailure(partition[0], entity, ex))
+                break
+
+            for entity, replaced in pending:
+                for keys in replaced:
+                    self._queue_delete(partition[0], keys)
+            break
+
+    def _queue_delete(self, table_name: str, keys: typing.Tuple[str, str]):
+        partition = (table_name, keys[0])
+        self.pending_deletes.setdefault(partition, []).append((keys[1], keys[0]))
+
+        if len(self.pending_deletes[partition]) >= self.max_batch_size:
+            self._flush_deletes(partition)
+
+    def _flush_deletes(self, partition: typing.Tuple[str, str]):
+        records = self.pending_deletes.pop(partition, [])
+        if not records:
+            return
+
+        try:
+            self.requests += 1
+            self.table_store.delete_batch(partition[0], records)
+        except Exception as ex:
+            for record in records:
+                self.failures.append(
+                    TableWriteFailure(partition[0], {"PartitionKey": record[1], "RowKey": record[0]}, ex)
+                )